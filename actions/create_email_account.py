@@ -9,7 +9,6 @@ Example::
 """
 import logging
 import asyncio
-import json
 import unidecode
 
 from krs.groups import get_group_membership
@@ -21,7 +20,7 @@ import actions.util
 logger = logging.getLogger('create_email_account')
 
 
-async def process(email_server, group_path, dryrun=False, keycloak_client=None):
+async def process(email_server, group_path, dryrun=False, incremental_maps=False, keycloak_client=None, agent=None, state=None):
     group_members = await get_group_membership(group_path, rest_client=keycloak_client)
     all_users = await list_users(rest_client=keycloak_client)
 
@@ -44,73 +43,60 @@ async def process(email_server, group_path, dryrun=False, keycloak_client=None):
             'gid': int(attrs['gidNumber']),
         }
 
-    script = f'''import subprocess
-import getpass
-import logging
-import os
-logging.basicConfig(level={logger.getEffectiveLevel()})
-
-users = {json.dumps(users)}
-with open('/etc/postfix/local_recipients') as f:
-    current_users = set([line.split()[0] for line in f.readlines() if line and 'OK' in line])
-dryrun = {dryrun}
-
-is_root = getpass.getuser() == 'root'
-if not is_root:
-    logging.debug('Running as user ' + getpass.getuser())
-    logging.debug('Will not chown')
-
-changes = False
-for username in sorted(set(users)-current_users):
-    logging.info('Adding email for user ' + username)
-    changes = True
-    user = users[username]
-    if not dryrun:
-        with open('/etc/postfix/canonical_sender', 'a') as f:
-            f.write(username+'     '+user['canonical']+'\\n')
-        with open('/etc/postfix/canonical_recipient', 'a') as f:
-            f.write(user['canonical']+'     '+username+'\\n')
-        with open('/etc/postfix/local_recipients', 'a') as f:
-            f.write(username+'     OK\\n')
-
-    path = '/mnt/mail/'+username
-    if not os.path.exists(path):
-        logging.debug('Creating directory ' + path)
-        if not dryrun:
-            os.makedirs(path, mode=0o755)
-        if is_root:
-            logging.debug('Changing ownership of %s to %d:%d', path,
-                          user['uid'], user['gid'])
-            if not dryrun:
-                os.chown(path, user['uid'], user['gid'])
-
-if changes and not dryrun:
-    logging.info('reloading postfix')
-    subprocess.check_call(['/usr/sbin/postmap', '/etc/postfix/canonical_recipient'])
-    subprocess.check_call(['/usr/sbin/postmap', '/etc/postfix/canonical_sender'])
-    subprocess.check_call(['/usr/sbin/postmap', '/etc/postfix/local_recipients'])
-    subprocess.check_call(['/usr/sbin/postfix', 'reload'])
-'''
-    actions.util.scp_and_run_sudo(email_server, script, script_name='create_email_accounts.py')
-
-
-def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
+    # only send users not already provisioned, unless it is time to verify
+    target = f'{email_server}:mail'
+    known = state.known(target) if state else None
+    if known is not None:
+        users = {u: users[u] for u in users if u not in known}
+        if not users:
+            logger.debug(f'no new email accounts for {target}')
+            return
+        logger.debug(f'checking {len(users)} new email accounts for {target}')
+
+    if agent:
+        ret = await agent.request('ensure_mailboxes', users=users, dryrun=dryrun, incremental=incremental_maps)
+        logger.info(f'added {len(ret["added"])} email accounts on {email_server}')
+    else:
+        args = {'users': users, 'dryrun': dryrun, 'incremental': incremental_maps}
+        script = actions.util.agent_script('ensure_mailboxes', args, log_level=logger.getEffectiveLevel())
+        await actions.util.run_remote_script(email_server, script, sudo=True)
+
+    if state and not dryrun:
+        state.update(target, users, verified=known is None)
+
+
+def action_config(group_path, dedup=1, agent=False, state_file=None, verify_interval=86400, **kwargs):
+    """Get the message action, routing key, and dedup interval for a listener"""
+    if agent:
+        kwargs['agent'] = actions.util.RemoteAgent(kwargs['email_server'], sudo=True)
+    if state_file:
+        kwargs['state'] = actions.util.ProvisionedState(state_file, verify_interval=verify_interval)
+
     async def action(message):
         logger.debug(f'{message}')
         if message['representation']['path'] == group_path:
             await process(group_path=group_path, **kwargs)
 
-    args = {
+    return {
+        'action': action,
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
     }
+
+
+def listener(group_path, address=None, exchange=None, **kwargs):
+    """Set up RabbitMQ listener"""
+    config = action_config(group_path, **kwargs)
+    args = {
+        'routing_key': config['routing_key'],
+        'dedup': config['dedup'],
+    }
     if address:
         args['address'] = address
     if exchange:
         args['exchange'] = exchange
 
-    return RabbitMQListener(action, **args)
+    return RabbitMQListener(config['action'], **args)
 
 
 def main():
@@ -123,6 +109,10 @@ def main():
     parser.add_argument('--listen', default=False, action='store_true', help='enable persistent RabbitMQ listener')
     parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
     parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
+    parser.add_argument('--agent', default=False, action='store_true', help='keep a remote agent running on the server (with --listen)')
+    parser.add_argument('--state-file', help='remember provisioned users in this file, and only send new ones')
+    parser.add_argument('--verify-interval', default=86400, type=float, help='seconds between full checks when using --state-file')
+    parser.add_argument('--incremental-maps', default=False, action='store_true', help='update postfix maps in place with postmap -i, without a reload')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
     args = vars(parser.parse_args())
 
@@ -133,13 +123,19 @@ def main():
     if args['listen']:
         ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
                        email_server=args['email_server'], group_path=args['group_path'],
+                       agent=args['agent'], state_file=args['state_file'],
+                       verify_interval=args['verify_interval'], incremental_maps=args['incremental_maps'],
                        keycloak_client=keycloak_client)
         loop = asyncio.get_event_loop()
         loop.create_task(ret.start())
         loop.run_forever()
     else:
+        state = None
+        if args['state_file']:
+            state = actions.util.ProvisionedState(args['state_file'], verify_interval=args['verify_interval'])
         asyncio.run(process(args['email_server'], args['group_path'],
-                            dryrun=args['dryrun'], keycloak_client=keycloak_client))
+                            dryrun=args['dryrun'], incremental_maps=args['incremental_maps'],
+                            keycloak_client=keycloak_client, state=state))
 
 
 if __name__ == '__main__':
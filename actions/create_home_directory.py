@@ -45,23 +45,33 @@ async def process(root_dir, keycloak_client=None):
                     logger.debug('skipping chown because we are not root')
 
 
-def listener(address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
+def action_config(dedup=1, **kwargs):
+    """Get the message action, routing key, and dedup interval for a listener"""
     async def action(message):
         logger.debug(f'{message}')
         if 'attributes' in message['representation'] and 'homeDirectory' in message['representation']['attributes']:
             await process(**kwargs)
 
-    args = {
+    return {
+        'action': action,
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.USER.#',
         'dedup': dedup,
     }
+
+
+def listener(address=None, exchange=None, **kwargs):
+    """Set up RabbitMQ listener"""
+    config = action_config(**kwargs)
+    args = {
+        'routing_key': config['routing_key'],
+        'dedup': config['dedup'],
+    }
     if address:
         args['address'] = address
     if exchange:
         args['exchange'] = exchange
 
-    return RabbitMQListener(action, **args)
+    return RabbitMQListener(config['action'], **args)
 
 
 def main():
@@ -56,23 +56,33 @@ async def process(group_path, root_dir, keycloak_client=None):
                         subprocess.check_call(QUOTAS[root_dir].format(**attrs), shell=True)
 
 
-def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
+def action_config(group_path, dedup=1, **kwargs):
+    """Get the message action, routing key, and dedup interval for a listener"""
     async def action(message):
         logger.debug(f'{message}')
         if message['representation']['path'] == group_path:
             await process(group_path=group_path, **kwargs)
 
-    args = {
+    return {
+        'action': action,
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
     }
+
+
+def listener(group_path, address=None, exchange=None, **kwargs):
+    """Set up RabbitMQ listener"""
+    config = action_config(group_path, **kwargs)
+    args = {
+        'routing_key': config['routing_key'],
+        'dedup': config['dedup'],
+    }
     if address:
         args['address'] = address
     if exchange:
         args['exchange'] = exchange
 
-    return RabbitMQListener(action, **args)
+    return RabbitMQListener(config['action'], **args)
 
 
 def main():
@@ -10,9 +10,15 @@ Example::
 
 This will create user dirs with directories like `/foo/bar/user1`.
 
+Several servers and root directories can be handled at once::
+
+    python -m actions.create_user_directory_ssh data.icecube.wisc.edu /posix \\
+        --root-dir /mnt/homework/homework \\
+        --target data.icecube.wisc.edu:/mnt/homework/public_html \\
+        --target lfs.icecube.wisc.edu:/mnt/lfs7/user
+
 """
 import asyncio
-import json
 import logging
 import pathlib
 
@@ -26,11 +32,19 @@ import actions.util
 logger = logging.getLogger('create_user_directory_ssh')
 
 
-async def process(server, group_path, root_dir, mode=0o755, dryrun=False, keycloak_client=None):
-    skip_roles = actions.util.INGORE_DIR_ROLES.get(str(root_dir), [])
-    group_members = await get_group_membership(group_path, rest_client=keycloak_client)
-    users = await list_users(rest_client=keycloak_client)
+def get_user_dirs(root_dir, group_members, users):
+    """
+    Get the user directories that should exist under a root directory.
+
+    Args:
+        root_dir (pathlib.Path): root directory
+        group_members (list): usernames in the group
+        users (dict): keycloak users
 
+    Returns:
+        dict: username: {path, uid, gid, username}
+    """
+    skip_roles = actions.util.INGORE_DIR_ROLES.get(str(root_dir), [])
     user_dirs = {}
     for username in group_members:
         attrs = users[username].get('attributes', {})
@@ -44,60 +58,168 @@ async def process(server, group_path, root_dir, mode=0o755, dryrun=False, keyclo
                 'gid': int(attrs['gidNumber']),
                 'username': username,
             }
+    return user_dirs
+
+
+async def provision(server, root_dir, user_dirs, mode=0o755, dryrun=False, agent=None, state=None):
+    """
+    Create user directories on a remote server.
+
+    Args:
+        server (str): remote server
+        root_dir (pathlib.Path): root directory
+        user_dirs (dict): user directories that should exist
+        mode (int): directory mode
+        dryrun (bool): only log changes
+        agent (RemoteAgent): (optional) persistent agent on the server
+        state (ProvisionedState): (optional) already provisioned users
+
+    Returns:
+        dict: {checked: number of users sent, created: usernames, or None if unknown}
+    """
+    # only send users not already provisioned, unless it is time to verify
+    target = f'{server}:{root_dir}'
+    known = state.known(target) if state else None
+    if known is not None:
+        user_dirs = {u: user_dirs[u] for u in user_dirs if u not in known}
+        if not user_dirs:
+            logger.debug(f'no new directories for {target}')
+            return {'checked': 0, 'created': []}
+        logger.debug(f'checking {len(user_dirs)} new directories for {target}')
+
+    args = {
+        'root_dir': str(root_dir),
+        'user_dirs': user_dirs,
+        'mode': mode,
+        'quota': actions.util.QUOTAS.get(str(root_dir)),
+        'dryrun': dryrun,
+        'full': known is None,
+    }
+    created = None
+    if agent:
+        created = (await agent.request('ensure_dirs', **args))['created']
+        logger.info(f'created {len(created)} directories on {server}')
+    else:
+        script = actions.util.agent_script('ensure_dirs', args, log_level=logger.getEffectiveLevel())
+        await actions.util.run_remote_script(server, script, sudo=True)
+
+    if state and not dryrun:
+        state.update(target, user_dirs, verified=known is None)
+    return {'checked': len(user_dirs), 'created': created}
+
+
+async def process(server, group_path, root_dir, mode=0o755, dryrun=False, keycloak_client=None, agent=None, state=None):
+    root_dir = pathlib.Path(root_dir)
+    group_members = await get_group_membership(group_path, rest_client=keycloak_client)
+    users = await list_users(rest_client=keycloak_client)
+
+    user_dirs = get_user_dirs(root_dir, group_members, users)
+    await provision(server, root_dir, user_dirs, mode=mode, dryrun=dryrun, agent=agent, state=state)
+
+
+async def process_targets(targets, group_path, mode=0o755, dryrun=False, keycloak_client=None, agents=None, state=None, host_concurrency=2):
+    """
+    Create user directories on several (server, root_dir) targets at once.
+
+    Keycloak is queried once for all targets.  Targets are provisioned
+    concurrently, with at most `host_concurrency` at a time per server.
+
+    Args:
+        targets (list): (server, root_dir) pairs
+        group_path (str): group path of users that get directories
+        mode (int): directory mode
+        dryrun (bool): only log changes
+        keycloak_client: keycloak rest client
+        agents (dict): (optional) server: RemoteAgent
+        state (ProvisionedState): (optional) already provisioned users
+        host_concurrency (int): max concurrent targets per server
+
+    Returns:
+        dict: `server:root_dir`: {checked, created, error}
+    """
+    group_members, users = await asyncio.gather(
+        get_group_membership(group_path, rest_client=keycloak_client),
+        list_users(rest_client=keycloak_client),
+    )
+
+    semaphores = {}
+    for server, _ in targets:
+        if server not in semaphores:
+            semaphores[server] = asyncio.Semaphore(host_concurrency)
+
+    async def run(server, root_dir):
+        root_dir = pathlib.Path(root_dir)
+        user_dirs = get_user_dirs(root_dir, group_members, users)
+        agent = agents.get(server) if agents else None
+        async with semaphores[server]:
+            ret = await provision(server, root_dir, user_dirs, mode=mode, dryrun=dryrun, agent=agent, state=state)
+        ret['error'] = None
+        return ret
+
+    results = await asyncio.gather(*(run(server, root_dir) for server, root_dir in targets), return_exceptions=True)
+
+    report = {}
+    for (server, root_dir), ret in zip(targets, results):
+        target = f'{server}:{root_dir}'
+        if isinstance(ret, Exception):
+            logger.warning(f'error creating directories on {target}', exc_info=ret)
+            ret = {'checked': 0, 'created': None, 'error': repr(ret)}
+        else:
+            created = 'unknown' if ret['created'] is None else len(ret['created'])
+            logger.info(f'{target}: checked {ret["checked"]}, created {created}')
+        report[target] = ret
+    return report
+
+
+def parse_target(value):
+    """Parse a `server:root_dir` target."""
+    server, _, root_dir = value.partition(':')
+    if not server or not root_dir:
+        raise ValueError(f'invalid target {value}')
+    return (server, pathlib.Path(root_dir))
+
+
+def action_config(group_path, dedup=1, agent=False, state_file=None, verify_interval=86400, targets=None, **kwargs):
+    """Get the message action, routing key, and dedup interval for a listener"""
+    if state_file:
+        kwargs['state'] = actions.util.ProvisionedState(state_file, verify_interval=verify_interval)
+    if targets:
+        # targets may come from a JSON config, as lists or `server:root_dir` strings
+        targets = [parse_target(t) if isinstance(t, str) else (t[0], pathlib.Path(t[1])) for t in targets]
+        kwargs['targets'] = targets
+        if agent:
+            kwargs['agents'] = {server: actions.util.RemoteAgent(server, sudo=True) for server, _ in targets}
+        process_fn = process_targets
+    else:
+        if agent:
+            kwargs['agent'] = actions.util.RemoteAgent(kwargs['server'], sudo=True)
+        process_fn = process
 
-    script = f'''import subprocess
-import os
-import getpass
-import logging
-logging.basicConfig(level={logger.getEffectiveLevel()})
-
-root_dir = '{root_dir}'
-user_dirs = {json.dumps(user_dirs)}
-QUOTAS = {json.dumps(actions.util.QUOTAS)}
-dryrun = {dryrun}
-
-existing = os.listdir(root_dir)
-is_root = getpass.getuser() == 'root'
-if not is_root:
-    logging.debug('Running as user ' + getpass.getuser())
-    logging.debug('Will not chown or set quota')
-
-for username in sorted(set(user_dirs).difference(existing)):
-    path = user_dirs[username]['path']
-    if not os.path.exists(path):
-        logging.info('Creating directory ' + path)
-        if not dryrun:
-            os.makedirs(path, mode={mode})
-        if is_root:
-            logging.debug('Changing ownership of %s to %d:%d', path,
-                          user_dirs[username]['uid'], user_dirs[username]['gid'])
-            if not dryrun:
-                os.chown(path, user_dirs[username]['uid'], user_dirs[username]['gid'])
-            if root_dir in QUOTAS:
-                logging.debug('Setting quota on directory ' + path)
-                if not dryrun:
-                    subprocess.check_call(QUOTAS[root_dir].format(**user_dirs[username]), shell=True)
-'''
-    actions.util.scp_and_run_sudo(server, script, script_name='create_directory.py')
-
-
-def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
     async def action(message):
         logger.debug(f'{message}')
         if message['representation']['path'] == group_path:
-            await process(group_path=group_path, **kwargs)
+            await process_fn(group_path=group_path, **kwargs)
 
-    args = {
+    return {
+        'action': action,
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
     }
+
+
+def listener(group_path, address=None, exchange=None, **kwargs):
+    """Set up RabbitMQ listener"""
+    config = action_config(group_path, **kwargs)
+    args = {
+        'routing_key': config['routing_key'],
+        'dedup': config['dedup'],
+    }
     if address:
         args['address'] = address
     if exchange:
         args['exchange'] = exchange
 
-    return RabbitMQListener(action, **args)
+    return RabbitMQListener(config['action'], **args)
 
 
 def auto_int(x):
@@ -112,10 +234,15 @@ def main():
     parser.add_argument('group_path', default='/posix', help='group path (/parentA/parentB/name)')
     parser.add_argument('--mode', default=0o755, type=auto_int, help='directory chmod mode (default: 755)')
     parser.add_argument('--root-dir', default='/', type=pathlib.Path, help='root directory to create home user directories in (default=/)')
+    parser.add_argument('--target', action='append', type=parse_target, help='additional server:root_dir to create directories in (can be repeated)')
+    parser.add_argument('--host-concurrency', default=2, type=int, help='max concurrent targets per server (with --target)')
     parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'), help='logging level')
     parser.add_argument('--listen', default=False, action='store_true', help='enable persistent RabbitMQ listener')
     parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
     parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
+    parser.add_argument('--agent', default=False, action='store_true', help='keep a remote agent running on the server (with --listen)')
+    parser.add_argument('--state-file', help='remember provisioned users in this file, and only send new ones')
+    parser.add_argument('--verify-interval', default=86400, type=float, help='seconds between full checks when using --state-file')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
     args = vars(parser.parse_args())
 
@@ -123,18 +250,40 @@ def main():
 
     keycloak_client = get_rest_client()
 
+    targets = None
+    if args['target']:
+        targets = [(args['server'], args['root_dir'])] + args['target']
+
     if args['listen']:
-        ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
-                       server=args['server'], group_path=args['group_path'],
-                       root_dir=args['root_dir'], mode=args['mode'],
-                       keycloak_client=keycloak_client)
+        if targets:
+            ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
+                           targets=targets, group_path=args['group_path'], mode=args['mode'],
+                           host_concurrency=args['host_concurrency'],
+                           agent=args['agent'], state_file=args['state_file'],
+                           verify_interval=args['verify_interval'], keycloak_client=keycloak_client)
+        else:
+            ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
+                           server=args['server'], group_path=args['group_path'],
+                           root_dir=args['root_dir'], mode=args['mode'],
+                           agent=args['agent'], state_file=args['state_file'],
+                           verify_interval=args['verify_interval'], keycloak_client=keycloak_client)
         loop = asyncio.get_event_loop()
         loop.create_task(ret.start())
         loop.run_forever()
     else:
-        asyncio.run(process(args['server'], args['group_path'], args['root_dir'],
-                            mode=args['mode'], dryrun=args['dryrun'],
-                            keycloak_client=keycloak_client))
+        state = None
+        if args['state_file']:
+            state = actions.util.ProvisionedState(args['state_file'], verify_interval=args['verify_interval'])
+        if targets:
+            report = asyncio.run(process_targets(targets, args['group_path'], mode=args['mode'],
+                                                 dryrun=args['dryrun'], keycloak_client=keycloak_client,
+                                                 state=state, host_concurrency=args['host_concurrency']))
+            if any(r['error'] for r in report.values()):
+                raise SystemExit(1)
+        else:
+            asyncio.run(process(args['server'], args['group_path'], args['root_dir'],
+                                mode=args['mode'], dryrun=args['dryrun'],
+                                keycloak_client=keycloak_client, state=state))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,285 @@
+"""
+Host several actions in one process, behind a single RabbitMQ listener.
+
+All hosted actions share one Keycloak client, one LDAP client, and a
+realm snapshot that caches Keycloak reads until the next event or write.
+Each action keeps its own routing key, dedup interval, and concurrency limit.
+
+The config file is a JSON list of actions.  `args` are passed to the
+action's `action_config()` function, minus the shared clients::
+
+    [
+        {"action": "create_posix_account", "args": {"group_path": "/posix"}},
+        {"action": "create_user_directory_ssh", "concurrency": 2,
+         "args": {"server": "data.icecube.wisc.edu", "group_path": "/posix",
+                  "root_dir": "/mnt/homework/homework", "agent": true}},
+        {"action": "sync_gws_accounts", "dedup": 5,
+         "args": {"sa_credentials": "sa.json", "sa_delegator": "admin@icecube.wisc.edu"}}
+    ]
+
+Example::
+
+    python -m actions.daemon daemon.json
+"""
+import asyncio
+import copy
+import importlib
+import inspect
+import json
+import logging
+import time
+
+from krs.ldap import LDAP
+from krs.rabbitmq import RabbitMQListener
+from krs.token import get_rest_client
+
+
+logger = logging.getLogger('daemon')
+
+
+def topic_match(pattern, routing_key):
+    """
+    Match a routing key against an AMQP topic pattern.
+
+    `*` matches exactly one word, `#` matches zero or more words.
+
+    Args:
+        pattern (str): topic pattern
+        routing_key (str): routing key of a message
+
+    Returns:
+        bool: True if the routing key matches
+    """
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == '#':
+            return any(match(p[1:], k[i:]) for i in range(len(k)+1))
+        if not k:
+            return False
+        return p[0] in ('*', k[0]) and match(p[1:], k[1:])
+    return match(pattern.split('.'), routing_key.split('.'))
+
+
+MAX_REFETCH = 3
+
+
+class RealmSnapshot:
+    """
+    Keycloak REST client wrapper that caches GET requests.
+
+    Identical GETs (same path and arguments), including concurrent ones,
+    share a single request.  Any other method goes straight through and
+    invalidates the snapshot, both before and after the request.  A GET
+    that was in flight during an invalidation is discarded and redone, up
+    to `MAX_REFETCH` times; after that the last fetched value is returned.
+
+    Args:
+        rest_client: keycloak rest client
+        max_age (float): seconds before a cached response is refetched
+    """
+    def __init__(self, rest_client, max_age=300):
+        self.rest_client = rest_client
+        self.max_age = max_age
+        self._cache = {}
+        self._generation = 0
+
+    def invalidate(self):
+        """Drop all cached responses, and any in flight."""
+        self._cache = {}
+        self._generation += 1
+
+    async def request(self, method, path, *args, **kwargs):
+        if method != 'GET':
+            self.invalidate()
+            try:
+                return await self.rest_client.request(method, path, *args, **kwargs)
+            finally:
+                self.invalidate()
+
+        key = (path, json.dumps([args, kwargs], sort_keys=True, default=str))
+        for _ in range(MAX_REFETCH + 1):
+            generation = self._generation
+            cache = self._cache
+            now = time.monotonic()
+            entry = cache.get(key)
+            if entry is None or now - entry[0] > self.max_age:
+                entry = (now, asyncio.ensure_future(self.rest_client.request(method, path, *args, **kwargs)))
+                cache[key] = entry
+            try:
+                ret = await asyncio.shield(entry[1])
+            except Exception:
+                if cache.get(key) is entry:
+                    del cache[key]
+                raise
+            if generation == self._generation:
+                break
+        # callers modify responses in-place, so hand out copies
+        return copy.deepcopy(ret)
+
+
+class HostedAction:
+    """
+    An action running inside the daemon.
+
+    Args:
+        name (str): action name
+        action (callable): message processing function
+        routing_key (str): routing key pattern the action listens to
+        dedup (int): deduplicate messages received over specified time interval
+        concurrency (int): max number of concurrent runs of the action
+    """
+    def __init__(self, name, action, routing_key, dedup=None, concurrency=1):
+        assert dedup is None or dedup >= 0
+        assert concurrency > 0
+        self.name = name
+        self.action = action
+        self.routing_key = routing_key
+        self.dedup = dedup
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._pending = None
+        self._tasks = set()
+
+    def matches(self, routing_key):
+        return topic_match(self.routing_key, routing_key)
+
+    async def submit(self, message):
+        """Run the action for a message, or schedule it if deduplicating."""
+        if not self.dedup:
+            await self._run(message)
+        elif self._pending is None:
+            self._pending = message
+            task = asyncio.create_task(self._dedup_helper())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._pending = message
+
+    async def _dedup_helper(self):
+        await asyncio.sleep(self.dedup)
+        message = self._pending
+        self._pending = None
+        await self._run(message)
+
+    async def _run(self, message):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            try:
+                await self.action(message)
+            except Exception:
+                logger.warning(f'error processing message in action {self.name}', exc_info=True)
+
+
+class Daemon:
+    """
+    Dispatch messages from a single RabbitMQ listener to hosted actions.
+
+    Args:
+        actions (list): HostedAction objects
+        snapshot (RealmSnapshot): shared realm snapshot, invalidated per event
+        address (str): RabbitMQ server address
+        exchange (str): exchange topic
+        routing_key (str): routing key pattern covering all hosted actions
+    """
+    def __init__(self, actions, snapshot=None, address=None, exchange=None, routing_key=None):
+        self.actions = actions
+        self.snapshot = snapshot
+
+        args = {'with_routing_key': True}
+        if address:
+            args['address'] = address
+        if exchange:
+            args['exchange'] = exchange
+        if routing_key:
+            args['routing_key'] = routing_key
+        self.listener = RabbitMQListener(self.dispatch, **args)
+
+    async def start(self):
+        await self.listener.start()
+
+    async def stop(self):
+        await self.listener.stop()
+
+    async def dispatch(self, message, routing_key):
+        logger.debug(f'{routing_key}: {message}')
+        if self.snapshot:
+            self.snapshot.invalidate()
+        matching = [a for a in self.actions if a.matches(routing_key)]
+        await asyncio.gather(*(a.submit(message) for a in matching))
+
+
+def load_actions(config, keycloak_client=None, ldap_client=None):
+    """
+    Create hosted actions from a daemon config.
+
+    Each action module's `action_config()` gives the message action,
+    routing key, and dedup interval, without creating a listener.
+    Shared clients are injected into any action whose `process()` takes them.
+    An LDAP client is created on demand if none is given.
+
+    Args:
+        config (list): action configs
+        keycloak_client: shared keycloak rest client
+        ldap_client (LDAP): shared ldap client
+
+    Returns:
+        list: HostedAction objects
+    """
+    ret = []
+    for entry in config:
+        name = entry['action']
+        module = importlib.import_module(f'actions.{name}')
+        params = inspect.signature(module.process).parameters
+        args = dict(entry.get('args', {}))
+
+        if 'keycloak_client' in params:
+            args['keycloak_client'] = keycloak_client
+        if 'ldap_client' in params:
+            if not ldap_client:
+                ldap_client = LDAP()
+            args['ldap_client'] = ldap_client
+        if 'gws_users_client' in params:
+            gws_directory = module.get_gws_directory(args.pop('sa_credentials'), args.pop('sa_delegator'))
+            args['gws_users_client'] = gws_directory.users()
+            if 'new_batch' in params:
+                args['new_batch'] = gws_directory.new_batch_http_request
+        if 'dedup' in entry:
+            args['dedup'] = entry['dedup']
+
+        action = module.action_config(**args)
+        ret.append(HostedAction(name, action['action'], action['routing_key'], dedup=action['dedup'],
+                                concurrency=entry.get('concurrency', 1)))
+        logger.info(f'hosting action {name} on {action["routing_key"]} routing key')
+    return ret
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run several actions in one RabbitMQ listener')
+    parser.add_argument('config', help='JSON config file listing actions')
+    parser.add_argument('--snapshot-max-age', default=300, type=float, help='max age in seconds of cached Keycloak reads')
+    parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'), help='logging level')
+    parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
+    parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
+
+    with open(args['config']) as f:
+        config = json.load(f)
+
+    snapshot = RealmSnapshot(get_rest_client(), max_age=args['snapshot_max_age'])
+    actions = load_actions(config, keycloak_client=snapshot)
+
+    daemon = Daemon(actions, snapshot=snapshot, address=args['listen_address'],
+                    exchange=args['listen_exchange'])
+    loop = asyncio.get_event_loop()
+    loop.create_task(daemon.start())
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
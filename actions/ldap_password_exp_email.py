@@ -2,16 +2,17 @@
 Send emails about password expiration.
 """
 import asyncio
-from datetime import datetime, timedelta
+from email.utils import format_datetime, localtime
 import logging
 from pprint import pprint
-import time
 
 from krs.token import get_rest_client
-from krs.email import send_email
+from krs.email import build_email, send_email, EmailTemplate, Mailer, Outbox
 from krs.ldap import LDAP
 from krs.users import modify_user
 
+from .shadow import build_table, classify_expiry, get_shadow_users
+
 
 logger = logging.getLogger('ldap_password_exp_email')
 
@@ -48,34 +49,37 @@ where you can reset your password.
 
 
 async def _get_expired_users(ldap_users, usernames):
-    today = int(time.time()/3600/24)
-    now = datetime.utcnow()
-
-    expiring_users = {}
-    expired_users = {}
-    disabled_users = {}
-
-    for uid in sorted(usernames):
-        user = ldap_users[uid]
-        logger.debug('processing user %s', uid)
-        if user.get('shadowExpire', 0) > 0 and user.get('shadowMax', 0) > 0:
-
-            days_remaining = int(user['shadowExpire']) - today
-            logger.debug('user %s has %d days remaining', uid, days_remaining)
-            exp_date = (now + timedelta(days=days_remaining)).date()
-
-            if days_remaining < -180:
-                disabled_users[uid] = exp_date
-            elif -7 < days_remaining <= 0:
-                expired_users[uid] = exp_date
-            elif 0 < days_remaining <= 28:
-                expiring_users[uid] = exp_date
-
-    return expiring_users, expired_users, disabled_users
+    table = build_table(ldap_users, usernames)
+    return classify_expiry(table)
+
+
+async def _send_emails(emails, mailer=None, outbox=None):
+    """
+    Send (description, message) pairs in bulk, logging any failures.
+
+    If an outbox is given, the messages are queued there instead.
+    """
+    if not emails:
+        return
+    if outbox:
+        queued = outbox.enqueue_many([msg for _, msg in emails])
+        logger.info(f'queued {queued} of {len(emails)} emails in outbox')
+        return
+    close_mailer = mailer is None
+    if close_mailer:
+        mailer = Mailer()
+    try:
+        results = await mailer.async_send_bulk([msg for _, msg in emails])
+    finally:
+        if close_mailer:
+            mailer.close()
+    for (desc, _), error in zip(emails, results):
+        if error:
+            logger.warning(f'error sending {desc}', exc_info=error)
 
 
-async def process(username=None, dryrun=False, ldap_client=None, keycloak_client=None):
-    ldap_users = ldap_client.list_users()
+async def process(username=None, dryrun=False, ldap_client=None, keycloak_client=None, mailer=None, outbox=None):
+    ldap_users = get_shadow_users(ldap_client, username)
 
     if username:
         usernames = [username]
@@ -92,18 +96,23 @@ async def process(username=None, dryrun=False, ldap_client=None, keycloak_client
         print('\ndisabled users')
         pprint(disabled_users)
 
+    emails = []
+    expiring_template = EmailTemplate('IceCube Password Expiring', EXPIRING_MSG)
+    expired_template = EmailTemplate('IceCube Password Has Expired', EXPIRED_MSG)
+    date_header = format_datetime(localtime())
+
     # send out expiring emails
     for uid in expiring_users:
         try:
             user = ldap_users[uid]
             name = user.get('givenName', uid)
             email_addr = user.get('mail', '')
-            msg = EXPIRING_MSG.format(uid=uid, date=expiring_users[uid])
             if email_addr:
                 if dryrun:
-                    print(msg)
+                    print(EXPIRING_MSG.format(uid=uid, date=expiring_users[uid]))
                 else:
-                    send_email({'name': name, 'email': email_addr}, 'IceCube Password Expiring', msg)
+                    fields = {'uid': uid, 'date': expiring_users[uid]}
+                    emails.append((f'expiring email to {uid}', expiring_template.render({'name': name, 'email': email_addr}, fields, date=date_header)))
         except Exception:
             logger.warning(f'error sending expiring email to {uid}', exc_info=True)
 
@@ -120,12 +129,11 @@ async def process(username=None, dryrun=False, ldap_client=None, keycloak_client
             user = ldap_users[uid]
             name = user.get('givenName', uid)
             email_addr = user.get('mail', '')
-            msg = EXPIRED_MSG.format(uid=uid)
             if email_addr:
                 if dryrun:
-                    print(msg)
+                    print(EXPIRED_MSG.format(uid=uid))
                 else:
-                    send_email({'name': name, 'email': email_addr}, 'IceCube Password Has Expired', msg)
+                    emails.append((f'expired email to {uid}', expired_template.render({'name': name, 'email': email_addr}, {'uid': uid}, date=date_header)))
         except Exception:
             logger.warning(f'error sending expired email to {uid}', exc_info=True)
 
@@ -139,7 +147,7 @@ async def process(username=None, dryrun=False, ldap_client=None, keycloak_client
         if dryrun:
             print(msg)
         else:
-            send_email({'name': 'IceCube Admin Team', 'email': 'admin@icecube.wisc.edu'}, 'Accounts Expiring Soon', msg)
+            emails.append(('admin expiring email', build_email({'name': 'IceCube Admin Team', 'email': 'admin@icecube.wisc.edu'}, 'Accounts Expiring Soon', msg)))
     except Exception:
         logger.warning('error sending admin expiring email', exc_info=True)
 
@@ -152,10 +160,12 @@ async def process(username=None, dryrun=False, ldap_client=None, keycloak_client
         if dryrun:
             print(msg)
         else:
-            send_email({'name': 'IceCube Admin Team', 'email': 'admin@icecube.wisc.edu'}, 'Expired Accounts', msg)
+            emails.append(('admin expired email', build_email({'name': 'IceCube Admin Team', 'email': 'admin@icecube.wisc.edu'}, 'Expired Accounts', msg)))
     except Exception:
         logger.warning('error sending admin expired email', exc_info=True)
 
+    await _send_emails(emails, mailer=mailer, outbox=outbox)
+
     return  # ignore disabled users for now
     try:
         msg = 'The following accounts are disabled.\n\n'
@@ -176,6 +186,7 @@ def main():
     parser.add_argument('--user', default=None, help='process a single user')
     parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'), help='logging level')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
+    parser.add_argument('--outbox', default=None, help='queue emails in this outbox instead of sending them')
     args = vars(parser.parse_args())
 
     logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
@@ -183,7 +194,9 @@ def main():
     ldap_client = LDAP()
     keycloak_client = get_rest_client()
 
-    asyncio.run(process(args['user'], dryrun=args['dryrun'], ldap_client=ldap_client, keycloak_client=keycloak_client))
+    outbox = Outbox(args['outbox']) if args['outbox'] else None
+
+    asyncio.run(process(args['user'], dryrun=args['dryrun'], ldap_client=ldap_client, keycloak_client=keycloak_client, outbox=outbox))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,267 @@
+"""
+Remote agent for the filesystem and mail server actions.
+
+Runs on the remote host, either deployed there or streamed over ssh by
+`actions.util.RemoteAgent`.  It reads JSON requests, one per line, from
+stdin and writes one JSON response per line to stdout::
+
+    {"op": "ensure_dirs", "args": {"root_dir": "/mnt/homework/homework", "user_dirs": {...}}}
+    {"ok": true, "result": {"created": ["user1"]}}
+
+The directory listing of each root dir and the postfix recipient list
+are cached in memory between requests, and only re-read when their
+mtime changes, so an event only costs a stat plus the actual changes.
+
+Only the standard library may be used here.
+
+Example::
+
+    python remote_agent.py --log-level info
+"""
+import getpass
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+# `zfs set` takes several properties at once
+ZFS_QUOTA = re.compile(r'^(\S*zfs) set (\S+=\S+) (\S+)$')
+
+
+def quota_commands(quota, users, batch_size=100):
+    """
+    Batch quota commands for many users.
+
+    A zfs quota becomes one `zfs set` per batch of users.  Other quota
+    commands are run as a single shell script.
+
+    Args:
+        quota (str): quota command template
+        users (list): user dicts to fill the template with
+        batch_size (int): max users per zfs command
+
+    Returns:
+        list: (args, stdin) tuples for subprocess
+    """
+    if not users:
+        return []
+    m = ZFS_QUOTA.match(quota)
+    if m:
+        zfs, prop, dataset = m.groups()
+        ret = []
+        for i in range(0, len(users), batch_size):
+            props = [prop.format(**u) for u in users[i:i+batch_size]]
+            ret.append(([zfs, 'set'] + props + [dataset], None))
+        return ret
+    return [(['/bin/sh', '-e'], '\n'.join(quota.format(**u) for u in users) + '\n')]
+
+
+class Agent:
+    """
+    Agent state and operations.
+
+    Args:
+        postfix_dir (str): postfix config directory
+        mail_dir (str): mailbox directory
+    """
+    def __init__(self, postfix_dir='/etc/postfix', mail_dir='/mnt/mail'):
+        self.postfix_dir = postfix_dir
+        self.mail_dir = mail_dir
+        self.is_root = getpass.getuser() == 'root'
+        self._listings = {}
+        self._recipients = None
+        if not self.is_root:
+            logging.debug('Running as user ' + getpass.getuser())
+            logging.debug('Will not chown or set quota')
+
+    def _listdir(self, root_dir):
+        """Cached os.listdir, refreshed when the directory mtime changes."""
+        mtime = os.stat(root_dir).st_mtime_ns
+        cached = self._listings.get(root_dir)
+        if cached is None or cached[0] != mtime:
+            logging.debug('Listing ' + root_dir)
+            cached = (mtime, set(os.listdir(root_dir)))
+            self._listings[root_dir] = cached
+        return cached[1]
+
+    def _local_recipients(self):
+        """Cached set of local recipients, refreshed when the file changes."""
+        filename = os.path.join(self.postfix_dir, 'local_recipients')
+        st = os.stat(filename)
+        key = (st.st_mtime_ns, st.st_size)
+        if self._recipients is None or self._recipients[0] != key:
+            logging.debug('Reading ' + filename)
+            with open(filename) as f:
+                users = set([line.split()[0] for line in f.readlines() if line and 'OK' in line])
+            self._recipients = (key, users)
+        return self._recipients[1]
+
+    def ensure_dirs(self, root_dir, user_dirs, mode=0o755, quota=None, dryrun=False, full=True):
+        """
+        Make sure user directories exist.
+
+        A full check lists the root directory.  Otherwise `user_dirs` is
+        expected to be a small delta, and only those paths are checked.
+
+        Args:
+            root_dir (str): root directory
+            user_dirs (dict): username: {path, uid, gid, username}
+            mode (int): directory mode
+            quota (str): (optional) quota command template
+            dryrun (bool): only log changes
+            full (bool): list the root directory (default: True)
+
+        Returns:
+            dict: {created: [usernames]}
+        """
+        created = []
+        quota_users = []
+        if full:
+            missing = set(user_dirs).difference(self._listdir(root_dir))
+        else:
+            missing = user_dirs
+        for username in sorted(missing):
+            path = user_dirs[username]['path']
+            if not os.path.exists(path):
+                logging.info('Creating directory ' + path)
+                created.append(username)
+                if not dryrun:
+                    os.makedirs(path, mode=mode)
+                if self.is_root:
+                    logging.debug('Changing ownership of %s to %d:%d', path,
+                                  user_dirs[username]['uid'], user_dirs[username]['gid'])
+                    if not dryrun:
+                        os.chown(path, user_dirs[username]['uid'], user_dirs[username]['gid'])
+                    if quota:
+                        quota_users.append(user_dirs[username])
+        if quota_users:
+            self._set_quotas(quota, quota_users, dryrun)
+        return {'created': created}
+
+    def _set_quotas(self, quota, users, dryrun=False):
+        start = time.time()
+        commands = quota_commands(quota, users)
+        for args, stdin in commands:
+            if dryrun:
+                logging.info('Would run: ' + ' '.join(args) + ('\n' + stdin if stdin else ''))
+            else:
+                subprocess.run(args, input=stdin, check=True, universal_newlines=True)
+        logging.info('Set quota for %d users with %d commands in %.3f seconds%s', len(users),
+                     len(commands), time.time()-start, ' (dryrun)' if dryrun else '')
+
+    def ensure_mailboxes(self, users, dryrun=False, incremental=False):
+        """
+        Make sure users have postfix entries and a mail directory.
+
+        New entries are appended with one write per map.  By default all
+        maps are rebuilt and postfix is reloaded.  In incremental mode,
+        only the new entries are added to the hashed maps with `postmap -i`,
+        and postfix is not reloaded, since it notices changed lookup tables
+        on its own.
+
+        Args:
+            users (dict): username: {canonical, uid, gid}
+            dryrun (bool): only log changes
+            incremental (bool): update hashed maps in place
+
+        Returns:
+            dict: {added: [usernames]}
+        """
+        added = []
+        entries = {'canonical_sender': [], 'canonical_recipient': [], 'local_recipients': []}
+        for username in sorted(set(users) - self._local_recipients()):
+            logging.info('Adding email for user ' + username)
+            added.append(username)
+            user = users[username]
+            entries['canonical_sender'].append(username+'     '+user['canonical']+'\n')
+            entries['canonical_recipient'].append(user['canonical']+'     '+username+'\n')
+            entries['local_recipients'].append(username+'     OK\n')
+
+            path = os.path.join(self.mail_dir, username)
+            if not os.path.exists(path):
+                logging.debug('Creating directory ' + path)
+                if not dryrun:
+                    os.makedirs(path, mode=0o755)
+                if self.is_root:
+                    logging.debug('Changing ownership of %s to %d:%d', path,
+                                  user['uid'], user['gid'])
+                    if not dryrun:
+                        os.chown(path, user['uid'], user['gid'])
+
+        if added and not dryrun:
+            for name in entries:
+                with open(os.path.join(self.postfix_dir, name), 'a') as f:
+                    f.write(''.join(entries[name]))
+            if incremental:
+                logging.info('updating postfix maps')
+                for name in ('canonical_recipient', 'canonical_sender', 'local_recipients'):
+                    subprocess.run(['/usr/sbin/postmap', '-i', os.path.join(self.postfix_dir, name)],
+                                   input=''.join(entries[name]), check=True, universal_newlines=True)
+            else:
+                logging.info('reloading postfix')
+                for name in ('canonical_recipient', 'canonical_sender', 'local_recipients'):
+                    subprocess.check_call(['/usr/sbin/postmap', os.path.join(self.postfix_dir, name)])
+                subprocess.check_call(['/usr/sbin/postfix', 'reload'])
+        return {'added': added}
+
+    def handle(self, request):
+        """
+        Handle one request.
+
+        Args:
+            request (dict): {op, args}
+
+        Returns:
+            dict: {ok: true, result} or {ok: false, error}
+        """
+        op = request.get('op')
+        if op not in ('ensure_dirs', 'ensure_mailboxes'):
+            return {'ok': False, 'error': 'unknown op ' + str(op)}
+        try:
+            return {'ok': True, 'result': getattr(self, op)(**request.get('args', {}))}
+        except Exception as e:
+            logging.warning('error handling ' + op, exc_info=True)
+            return {'ok': False, 'error': repr(e)}
+
+    def run_once(self, request):
+        """Handle a single request, exiting with an error if it fails."""
+        ret = self.handle(request)
+        if not ret['ok']:
+            raise SystemExit(ret['error'])
+        return ret['result']
+
+    def serve(self, infile=None, outfile=None):
+        """Handle requests until stdin is closed."""
+        if infile is None:
+            infile = sys.stdin
+        if outfile is None:
+            # keep stdout for responses, and send child process output to stderr
+            outfile = os.fdopen(os.dup(1), 'w')
+            os.dup2(2, 1)
+        for line in infile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                ret = {'ok': False, 'error': 'invalid request'}
+            else:
+                ret = self.handle(request)
+            outfile.write(json.dumps(ret) + '\n')
+            outfile.flush()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Remote agent for filesystem and mail server actions')
+    parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'), help='logging level')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
+
+    Agent().serve()
@@ -0,0 +1,143 @@
+"""
+Columnar classification of LDAP shadow password expiry.
+
+The shadow attributes of all users are loaded into columns, and the
+expiry checks run over whole columns at once.  NumPy is used if it is
+installed, with a pure-Python fallback.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+import time
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+#: LDAP attributes needed by the password expiry jobs
+SHADOW_ATTRS = ['uid', 'shadowExpire', 'shadowMax', 'shadowLastChange', 'mail', 'givenName']
+
+
+#: Shadow attribute columns.  Missing integer attributes are 0,
+#: and `complete` marks users with all three shadow attributes.
+ShadowTable = namedtuple('ShadowTable', ['uids', 'expire', 'max', 'last_change', 'complete'])
+
+
+def _entry_to_dict(entry):
+    entry = entry.entry_attributes_as_dict
+    return {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry if entry[k]}
+
+
+def get_shadow_users(ldap_client, username=None):
+    """
+    Get the shadow attributes of LDAP users.
+
+    A single user is fetched with a single lookup.
+
+    Args:
+        ldap_client (LDAP): ldap client
+        username (str): (optional) only get this user
+
+    Returns:
+        dict: username: attr dict
+    """
+    if username:
+        user = _entry_to_dict(ldap_client.get_user(username, attrs=SHADOW_ATTRS))
+        return {user.get('uid', username): user}
+    return ldap_client.list_users(SHADOW_ATTRS)
+
+
+def build_table(ldap_users, usernames=None):
+    """
+    Load the shadow attributes of users into columns.
+
+    Args:
+        ldap_users (dict): username: attr dict
+        usernames (list): (optional) usernames to include (default: all)
+
+    Returns:
+        ShadowTable: columns, in sorted username order
+    """
+    uids = sorted(ldap_users if usernames is None else usernames)
+    expire = []
+    max_ = []
+    last_change = []
+    complete = []
+    for uid in uids:
+        user = ldap_users[uid]
+        e = user.get('shadowExpire')
+        m = user.get('shadowMax')
+        c = user.get('shadowLastChange')
+        expire.append(int(e) if e is not None else 0)
+        max_.append(int(m) if m is not None else 0)
+        last_change.append(int(c) if c is not None else 0)
+        complete.append(e is not None and m is not None and c is not None)
+    if np is not None:
+        return ShadowTable(uids, np.array(expire, dtype=np.int64), np.array(max_, dtype=np.int64),
+                           np.array(last_change, dtype=np.int64), np.array(complete, dtype=bool))
+    return ShadowTable(uids, expire, max_, last_change, complete)
+
+
+def classify_expiry(table, today=None):
+    """
+    Find users with expiring, expired, and disabled passwords.
+
+    Args:
+        table (ShadowTable): shadow columns
+        today (int): (optional) days since the epoch
+
+    Returns:
+        tuple: (expiring, expired, disabled) dicts of username: expiration date
+    """
+    if today is None:
+        today = int(time.time()/3600/24)
+
+    if np is not None and isinstance(table.expire, np.ndarray):
+        days = table.expire - today
+        valid = (table.expire > 0) & (table.max > 0)
+        categories = [
+            np.flatnonzero(valid & (days > 0) & (days <= 28)),
+            np.flatnonzero(valid & (days > -7) & (days <= 0)),
+            np.flatnonzero(valid & (days < -180)),
+        ]
+        days = days.tolist()
+    else:
+        days = [e - today for e in table.expire]
+        categories = [[], [], []]
+        for i, (e, m, d) in enumerate(zip(table.expire, table.max, days)):
+            if e > 0 and m > 0:
+                if d < -180:
+                    categories[2].append(i)
+                elif -7 < d <= 0:
+                    categories[1].append(i)
+                elif 0 < d <= 28:
+                    categories[0].append(i)
+
+    # only build dates for the few users that match
+    now = datetime.utcnow()
+    return tuple({table.uids[i]: (now + timedelta(days=days[i])).date() for i in indexes}
+                 for indexes in categories)
+
+
+def expiry_updates(table):
+    """
+    Find users whose shadowExpire is older than their last password change allows.
+
+    Users without an expiration (shadowExpire <= 0) are skipped.
+
+    Args:
+        table (ShadowTable): shadow columns
+
+    Returns:
+        dict: username: new shadowExpire
+    """
+    if np is not None and isinstance(table.expire, np.ndarray):
+        new_expire = table.last_change + table.max
+        indexes = np.flatnonzero(table.complete & (table.expire > 0) & (table.expire < new_expire))
+        new_expire = new_expire.tolist()
+    else:
+        new_expire = [c + m for c, m in zip(table.last_change, table.max)]
+        indexes = [i for i, (ok, e, n) in enumerate(zip(table.complete, table.expire, new_expire))
+                   if ok and 0 < e < n]
+    return {table.uids[i]: new_expire[i] for i in indexes}
@@ -10,35 +10,67 @@ Example::
 This will sync eligible user accounts from KeyCloak to Google Workspace.
 """
 import asyncio
+import concurrent.futures
+from functools import partial
+import json
 import logging
+import os
 import random
 import string
 import time
 
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 
+from krs.ratelimit import TokenBucket
 from krs.ldap import LDAP
 from krs.rabbitmq import RabbitMQListener
 from krs.token import get_rest_client
-from krs.users import list_users
+from krs.users import list_users, user_info, UserDoesNotExist
 
 
 logger = logging.getLogger('sync_gws_accounts')
 SHADOWEXPIRE_DAYS_REMAINING_CUTOFF_FOR_ELIGIBILITY = -365 * 2
+GWS_DOMAIN = 'icecube.wisc.edu'
+GWS_INDEX_FIELDS = 'primaryEmail,etag'
+GWS_RECONCILE_FIELDS = 'primaryEmail,name(givenName,familyName),suspended'
 
+# the Google API client (httplib2) is not thread-safe, so all calls share one thread
+gws_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='gws')
 
-def get_gws_accounts(gws_users_client):
+
+def get_gws_directory(sa_credentials, sa_delegator):
+    """Build a Google Workspace Admin SDK Directory API client.
+
+    Args:
+        sa_credentials (str): path to file with service account credentials
+        sa_delegator (str): principal on whose behalf the service account will act
+
+    Returns:
+        googleapiclient.discovery.Resource: Directory API resource
+    """
+    creds = service_account.Credentials.from_service_account_file(
+        sa_credentials, subject=sa_delegator,
+        scopes=['https://www.googleapis.com/auth/admin.directory.user'])
+    return build('admin', 'directory_v1', credentials=creds, cache_discovery=False)
+
+
+def get_gws_accounts(gws_users_client, fields=None):
     """Return a dictionary with all Google Workspace user accounts.
 
     Args:
         gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource
+        fields (str): (optional) only return these user fields, like "primaryEmail,etag"
 
     Returns:
         Dict of Google Workspace account attributes keyed by username (not email).
     """
     user_list = []
-    request = gws_users_client.list(customer='my_customer', maxResults=500)
+    args = {'customer': 'my_customer', 'maxResults': 500}
+    if fields:
+        args['fields'] = f'nextPageToken,users({fields})'
+    request = gws_users_client.list(**args)
     while request is not None:
         response = request.execute()
         user_list.extend(response.get('users', []))
@@ -46,15 +78,88 @@ def get_gws_accounts(gws_users_client):
     return dict((u['primaryEmail'].split('@')[0], u) for u in user_list)
 
 
-def is_eligible(account_attrs, shadow_expire):
-    """Return True if the account is eligible for creation in Google Workspace.
+def get_gws_account(gws_users_client, username, fields=GWS_INDEX_FIELDS):
+    """Return the Google Workspace account of a single user.
+
+    Args:
+        gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource
+        username (str): username (not email)
+        fields (str): user fields to return
+
+    Returns:
+        Dict of account attributes, or None if the account does not exist
+    """
+    try:
+        return gws_users_client.get(userKey=f'{username}@{GWS_DOMAIN}', fields=fields).execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise
+
+
+class GwsIndex:
+    """Persisted index of Google Workspace accounts.
+
+    Maps username to `{primaryEmail, etag}`.  The full listing is only
+    redone once the index is older than `max_age`; in between, the index is
+    kept current from single-user lookups and our own inserts.
+
+    Args:
+        path (str): (optional) JSON file to persist the index in
+        max_age (float): seconds before the index needs a full listing
+    """
+    def __init__(self, path=None, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self.updated = 0
+        self.users = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.updated = data['updated']
+            self.users = data['users']
+
+    def stale(self):
+        """Return True if the index needs a full listing."""
+        return time.time() - self.updated > self.max_age
+
+    def refresh(self, gws_users_client):
+        """Replace the index with a full listing of accounts."""
+        accounts = get_gws_accounts(gws_users_client, fields=GWS_INDEX_FIELDS)
+        self.users = {u: {k: a[k] for k in ('primaryEmail', 'etag') if k in a} for u, a in accounts.items()}
+        self.updated = time.time()
+        self.save()
+        return self.users
+
+    def update(self, username, account, save=True):
+        """Record an account, or its absence if `account` is None.
+
+        With `save=False`, call `save()` once after a batch of updates.
+        """
+        if account is None:
+            self.users.pop(username, None)
+        else:
+            self.users[username] = {k: account[k] for k in ('primaryEmail', 'etag') if k in account}
+        if save:
+            self.save()
+
+    def save(self):
+        if self.path:
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'updated': self.updated, 'users': self.users}, f)
+            os.replace(tmp, self.path)
+
+
+def is_active(account_attrs, shadow_expire):
+    """Return True if the account is in active use.
 
     Args:
         account_attrs (dict): KeyCloak attribues of the account
         shadow_expire (float): value of shadowExpire LDAP attributes of the account
 
     Return:
-        Whether or not the account is eligible for creation
+        Whether or not the account is enabled, has a login shell, and is not too old
     """
     today = int(time.time()/3600/24)
     days_remaining = shadow_expire - today
@@ -62,12 +167,95 @@ def is_eligible(account_attrs, shadow_expire):
     shell = account_attrs.get('attributes', {}).get('loginShell')
     return (not old_account
             and account_attrs['enabled']
-            and shell not in ('/sbin/nologin', None)
+            and shell not in ('/sbin/nologin', None))
+
+
+def is_eligible(account_attrs, shadow_expire):
+    """Return True if the account is eligible for creation in Google Workspace.
+
+    Args:
+        account_attrs (dict): KeyCloak attribues of the account
+        shadow_expire (float): value of shadowExpire LDAP attributes of the account
+
+    Return:
+        Whether or not the account is eligible for creation
+    """
+    return (is_active(account_attrs, shadow_expire)
             and account_attrs.get('firstName') and account_attrs.get('lastName'))
 
 
+def new_account_body(username, attrs):
+    """Return the User resource body for a new account."""
+    return {'primaryEmail': f'{username}@{GWS_DOMAIN}',
+            'name': {
+                'givenName': attrs['firstName'],
+                'familyName': attrs['lastName'],},
+            'password': ''.join(random.choices(string.ascii_letters, k=12)),}
+
+
+def execute_requests(requests, new_batch=None, batch_size=50, limiter=None):
+    """Execute Directory API requests, using batch HTTP requests if possible.
+
+    Errors of individual requests are logged, not raised.
+
+    Args:
+        requests (list): (request_id, googleapiclient.http.HttpRequest) tuples
+        new_batch (callable): (optional) the `new_batch_http_request` method of the Directory API
+        batch_size (int): max requests per batch request
+        limiter (TokenBucket): (optional) rate limiter, one token per request
+
+    Returns:
+        List of request ids that failed
+    """
+    failed = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            logger.warning(f'error in request {request_id}: {exception}')
+            failed.append(request_id)
+
+    i = 0
+    while i < len(requests):
+        chunk = requests[i:i+batch_size] if new_batch else requests[i:i+1]
+        i += len(chunk)
+        if limiter:
+            tokens = 0
+            while tokens < len(chunk):
+                tokens += limiter.take(len(chunk) - tokens)
+        if new_batch:
+            batch = new_batch(callback=callback)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            batch.execute()
+        else:
+            request_id, request = chunk[0]
+            try:
+                request.execute()
+            except HttpError as e:
+                callback(request_id, None, e)
+    return failed
+
+
+def insert_accounts(gws_users_client, bodies, new_batch=None, batch_size=50):
+    """Insert Google Workspace accounts, using batch HTTP requests if possible.
+
+    Errors of individual inserts are logged, not raised.
+
+    Args:
+        gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource
+        bodies (list): User resource bodies
+        new_batch (callable): (optional) the `new_batch_http_request` method of the Directory API
+        batch_size (int): max inserts per batch request
+
+    Returns:
+        List of usernames that failed to insert
+    """
+    requests = [(body['primaryEmail'].split('@')[0], gws_users_client.insert(body=body)) for body in bodies]
+    return execute_requests(requests, new_batch=new_batch, batch_size=batch_size)
+
+
 def create_missing_eligible_accounts(gws_users_client, gws_accounts, ldap_accounts,
-                                     kc_accounts, dryrun):
+                                     kc_accounts, dryrun, new_batch=None, batch_size=50):
     """Create eligible KeyCloak accounts in Google Workspace if not there already.
 
     Google's documentation on account creation: https://developers.google.com/admin-sdk/directory/v1/guides/manage-users
@@ -79,57 +267,280 @@ def create_missing_eligible_accounts(gws_users_client, gws_accounts, ldap_accoun
         ldap_accounts (dict): LDAP accounts attributes keyed by username
         kc_accounts (dict): KeyCloak account attributes keyed by username
         dryrun (bool): perform a trial run with no changes made
+        new_batch (callable): (optional) the `new_batch_http_request` method of the Directory API
+        batch_size (int): max inserts per batch request
 
     Returns:
-        List of created usernames (used for unit testing)
+        List of created usernames, minus failed inserts (used for unit testing)
     """
     created_usernames = []  # used for unit testing
+    bodies = []
     for username,attrs in kc_accounts.items():
         shadow_expire = ldap_accounts[username].get('shadowExpire', float('-inf'))
         if username not in gws_accounts and is_eligible(attrs, shadow_expire):
-            body = {'primaryEmail': f'{username}@icecube.wisc.edu',
-                    'name': {
-                        'givenName': attrs['firstName'],
-                        'familyName': attrs['lastName'],},
-                    'password': ''.join(random.choices(string.ascii_letters, k=12)),}
+            body = new_account_body(username, attrs)
             created_usernames.append(username)
             logger.info(f'creating user {username}')
             sanitized_body = body.copy()
             sanitized_body['password'] = 'REDACTED'
             logger.debug(f'request body: {sanitized_body}')
-            if not dryrun:
-                gws_users_client.insert(body=body).execute()
+            bodies.append(body)
         else:
             logger.debug(f'ignoring user {username}')
+    if bodies and not dryrun:
+        failed = insert_accounts(gws_users_client, bodies, new_batch=new_batch, batch_size=batch_size)
+        created_usernames = [u for u in created_usernames if u not in failed]
     return created_usernames
 
 
-async def process(gws_users_client, ldap_client, keycloak_client, dryrun=False):
-    kc_accounts = await list_users(rest_client=keycloak_client)
-    gws_accounts = get_gws_accounts(gws_users_client)
-    ldap_accounts = ldap_client.list_users(attrs=['shadowExpire'])
+def plan_changes(kc_accounts, ldap_accounts, gws_accounts):
+    """Compute the changes that bring Google Workspace in line with KeyCloak and LDAP.
 
-    create_missing_eligible_accounts(gws_users_client, gws_accounts, ldap_accounts,
-                                     kc_accounts, dryrun)
+    A single pass over the KeyCloak accounts, in sorted order, with
+    constant-time lookups into the LDAP and Google Workspace accounts:
 
+    * eligible accounts missing from Google Workspace are created
+    * eligible accounts whose name differs are updated
+    * accounts that are no longer active are suspended
+
+    Accounts not in KeyCloak are never touched, and accounts missing from
+    LDAP are not suspended.  A missing `shadowExpire` never counts as
+    expired when deciding to suspend.
+
+    Args:
+        kc_accounts (dict): KeyCloak account attributes keyed by username
+        ldap_accounts (dict): LDAP accounts attributes keyed by username
+        gws_accounts (dict): GWS account attributes keyed by username,
+            including `name` and `suspended`
+
+    Returns:
+        dict: {create: [User bodies], update: [(username, patch body)], suspend: [usernames]}
+    """
+    plan = {'create': [], 'update': [], 'suspend': []}
+    for username in sorted(kc_accounts):
+        attrs = kc_accounts[username]
+        ldap_account = ldap_accounts.get(username)
+        shadow_expire = ldap_account.get('shadowExpire', float('-inf')) if ldap_account is not None else float('-inf')
+        gws_account = gws_accounts.get(username)
+        if gws_account is None:
+            if is_eligible(attrs, shadow_expire):
+                plan['create'].append(new_account_body(username, attrs))
+        elif is_eligible(attrs, shadow_expire):
+            name = {'givenName': attrs['firstName'], 'familyName': attrs['lastName']}
+            gws_name = gws_account.get('name', {})
+            if any(gws_name.get(k) != v for k, v in name.items()):
+                plan['update'].append((username, {'name': name}))
+        elif (ldap_account is not None and not gws_account.get('suspended', False)
+              and not is_active(attrs, ldap_account.get('shadowExpire', float('inf')))):
+            plan['suspend'].append(username)
+    return plan
+
+
+def log_plan(plan, dryrun=False):
+    """Log the changes in a plan, and a summary line."""
+    prefix = 'would ' if dryrun else ''
+    for body in plan['create']:
+        logger.info(f'{prefix}create user {body["primaryEmail"].split("@")[0]}')
+    for username, body in plan['update']:
+        logger.info(f'{prefix}update user {username} name to {body["name"]["givenName"]} {body["name"]["familyName"]}')
+    for username in plan['suspend']:
+        logger.info(f'{prefix}suspend user {username}')
+    logger.info(f'plan: {len(plan["create"])} create, {len(plan["update"])} update, {len(plan["suspend"])} suspend')
+
+
+def apply_plan(gws_users_client, plan, new_batch=None, batch_size=50, rate=20):
+    """Apply a plan from `plan_changes()`.
+
+    Args:
+        gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource
+        plan (dict): planned changes
+        new_batch (callable): (optional) the `new_batch_http_request` method of the Directory API
+        batch_size (int): max requests per batch request
+        rate (float): max requests per second (default: 20)
+
+    Returns:
+        dict: {create, update, suspend} lists of usernames that succeeded
+    """
+    requests = []
+    for body in plan['create']:
+        username = body['primaryEmail'].split('@')[0]
+        requests.append((f'create:{username}', gws_users_client.insert(body=body)))
+    for username, body in plan['update']:
+        requests.append((f'update:{username}', gws_users_client.patch(userKey=f'{username}@{GWS_DOMAIN}', body=body)))
+    for username in plan['suspend']:
+        requests.append((f'suspend:{username}', gws_users_client.patch(userKey=f'{username}@{GWS_DOMAIN}',
+                                                                       body={'suspended': True})))
+    limiter = TokenBucket(rate, max(batch_size, 1)) if rate else None
+    failed = set(execute_requests(requests, new_batch=new_batch, batch_size=batch_size, limiter=limiter))
+
+    ret = {'create': [], 'update': [], 'suspend': []}
+    for request_id, _ in requests:
+        if request_id not in failed:
+            op, username = request_id.split(':', 1)
+            ret[op].append(username)
+    return ret
+
+
+async def process(gws_users_client, ldap_client, keycloak_client, dryrun=False, new_batch=None, batch_size=50, index=None,
+                  reconcile=False, rate=20, max_suspend=100):
+    """Sync eligible accounts.
+
+    Keycloak, LDAP, and Google Workspace are read concurrently, with the
+    blocking LDAP client running in the default executor and the Google
+    API client in `gws_executor`, one call at a time.
+    With a fresh `index`, Google Workspace is not listed at all.
+
+    By default only missing accounts are created.  With `reconcile`, names
+    are also updated and inactive accounts suspended; see `plan_changes()`.
+    A plan that suspends more than `max_suspend` accounts is not applied.
+
+    Args:
+        gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource
+        ldap_client (LDAP): ldap client
+        keycloak_client: keycloak rest client
+        dryrun (bool): perform a trial run with no changes made
+        new_batch (callable): (optional) the `new_batch_http_request` method of the Directory API
+        batch_size (int): max inserts per batch request
+        index (GwsIndex): (optional) Google Workspace account index
+        reconcile (bool): also update names and suspend accounts
+        rate (float): max Directory API requests per second when reconciling
+        max_suspend (int): max accounts to suspend when reconciling (None for no limit)
+    """
+    loop = asyncio.get_running_loop()
+    if reconcile:
+        kc_accounts, gws_accounts, ldap_accounts = await asyncio.gather(
+            list_users(rest_client=keycloak_client),
+            loop.run_in_executor(gws_executor, partial(get_gws_accounts, gws_users_client, fields=GWS_RECONCILE_FIELDS)),
+            loop.run_in_executor(None, partial(ldap_client.list_users, attrs=['shadowExpire'])),
+        )
+        plan = plan_changes(kc_accounts, ldap_accounts, gws_accounts)
+        log_plan(plan, dryrun=dryrun)
+        if dryrun:
+            return
+        if max_suspend is not None and len(plan['suspend']) > max_suspend:
+            raise Exception(f'refusing to suspend {len(plan["suspend"])} accounts, more than {max_suspend}')
+        ret = await loop.run_in_executor(gws_executor, partial(
+            apply_plan, gws_users_client, plan, new_batch=new_batch, batch_size=batch_size, rate=rate))
+        if index is not None and ret['create']:
+            for username in ret['create']:
+                index.update(username, {'primaryEmail': f'{username}@{GWS_DOMAIN}'}, save=False)
+            index.save()
+        return
+
+    if index is None:
+        gws_listing = loop.run_in_executor(gws_executor, get_gws_accounts, gws_users_client)
+    elif index.stale():
+        gws_listing = loop.run_in_executor(gws_executor, index.refresh, gws_users_client)
+    else:
+        gws_listing = asyncio.sleep(0, index.users)
+    kc_accounts, gws_accounts, ldap_accounts = await asyncio.gather(
+        list_users(rest_client=keycloak_client),
+        gws_listing,
+        loop.run_in_executor(None, partial(ldap_client.list_users, attrs=['shadowExpire'])),
+    )
+
+    created = await loop.run_in_executor(gws_executor, partial(
+        create_missing_eligible_accounts, gws_users_client, gws_accounts, ldap_accounts,
+        kc_accounts, dryrun, new_batch=new_batch, batch_size=batch_size))
+    if index is not None and not dryrun and created:
+        for username in created:
+            index.update(username, {'primaryEmail': f'{username}@{GWS_DOMAIN}'}, save=False)
+        index.save()
+
+
+async def process_user(username, gws_users_client, ldap_client, keycloak_client, dryrun=False, index=None, **kwargs):
+    """Sync a single account.
+
+    Costs one Keycloak and one LDAP lookup, plus one Directory API call
+    if the account is not in the index.
+
+    Args:
+        username (str): username
+        gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource
+        ldap_client (LDAP): ldap client
+        keycloak_client: keycloak rest client
+        dryrun (bool): perform a trial run with no changes made
+        index (GwsIndex): (optional) Google Workspace account index
+    """
+    if index is not None and username in index.users:
+        logger.debug(f'user {username} already in the index')
+        return
+
+    def get_ldap_account():
+        try:
+            user = ldap_client.get_user(username, attrs=['shadowExpire'])
+        except KeyError:
+            return {}
+        return {k: v[0] for k, v in user.entry_attributes_as_dict.items() if v}
+
+    async def get_kc_account():
+        try:
+            return await user_info(username, rest_client=keycloak_client)
+        except UserDoesNotExist:
+            return None
+
+    loop = asyncio.get_running_loop()
+    kc_account, ldap_account, gws_account = await asyncio.gather(
+        get_kc_account(),
+        loop.run_in_executor(None, get_ldap_account),
+        loop.run_in_executor(gws_executor, get_gws_account, gws_users_client, username),
+    )
+    if kc_account is None:
+        logger.debug(f'user {username} is not in Keycloak')
+        return
+    if gws_account is not None:
+        if index is not None:
+            index.update(username, gws_account)
+        return
+
+    created = await loop.run_in_executor(gws_executor, partial(
+        create_missing_eligible_accounts, gws_users_client, {}, {username: ldap_account},
+        {username: kc_account}, dryrun))
+    if index is not None and created and not dryrun:
+        index.update(username, {'primaryEmail': f'{username}@{GWS_DOMAIN}'})
+
+
+def action_config(dedup=1, index_file=None, index_max_age=86400, **kwargs):
+    """Get the message action, routing key, and dedup interval for a listener
+
+    With an index file, events for a single user only check that user.
+    Deduplication is then disabled, since it would drop users.
+    """
+    if index_file:
+        kwargs['index'] = GwsIndex(index_file, max_age=index_max_age)
+        dedup = None
 
-def listener(address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
     async def action(message):
         logger.debug(f'{message}')
-        if message['representation']:
+        representation = message['representation']
+        if not representation:
+            return
+        username = representation.get('username') if isinstance(representation, dict) else None
+        if username and 'index' in kwargs:
+            await process_user(username, **kwargs)
+        else:
             await process(**kwargs)
 
-    args = {
+    return {
+        'action': action,
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.USER.#',
         'dedup': dedup,
     }
+
+
+def listener(address=None, exchange=None, **kwargs):
+    """Set up RabbitMQ listener"""
+    config = action_config(**kwargs)
+    args = {
+        'routing_key': config['routing_key'],
+        'dedup': config['dedup'],
+    }
     if address:
         args['address'] = address
     if exchange:
         args['exchange'] = exchange
 
-    return RabbitMQListener(action, **args)
+    return RabbitMQListener(config['action'], **args)
 
 
 def main():
@@ -150,6 +561,18 @@ def main():
                         help='file with service account credentials')
     parser.add_argument('--sa-delegator', metavar='ACCOUNT', required=True,
                         help='principal on whose behalf the service account will act')
+    parser.add_argument('--batch-size', default=50, type=int,
+                        help='max account inserts per batch request')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='also update names and suspend inactive accounts')
+    parser.add_argument('--rate', default=20, type=float,
+                        help='max Directory API requests per second when reconciling')
+    parser.add_argument('--max-suspend', default=100, type=int,
+                        help='refuse to apply a reconcile plan that suspends more accounts than this')
+    parser.add_argument('--index-file', metavar='PATH',
+                        help='persist an index of Google Workspace accounts, and only check single users on events')
+    parser.add_argument('--index-max-age', default=86400, type=float,
+                        help='seconds before the index is fully refreshed')
     parser.add_argument('--listen', default=False, action='store_true',
                         help='enable persistent RabbitMQ listener')
     parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
@@ -162,21 +585,25 @@ def main():
     keycloak_client = get_rest_client()
     ldap_client = LDAP()
 
-    creds = service_account.Credentials.from_service_account_file(
-        args['sa_credentials'], subject=args['sa_delegator'],
-        scopes=['https://www.googleapis.com/auth/admin.directory.user'])
-    gws_directory = build('admin', 'directory_v1', credentials=creds, cache_discovery=False)
+    gws_directory = get_gws_directory(args['sa_credentials'], args['sa_delegator'])
     gws_users_client = gws_directory.users()
 
     if args['listen']:
         ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
                        keycloak_client=keycloak_client, gws_users_client=gws_users_client,
-                       ldap_client=ldap_client, dryrun=args['dryrun'])
+                       ldap_client=ldap_client, dryrun=args['dryrun'],
+                       new_batch=gws_directory.new_batch_http_request, batch_size=args['batch_size'],
+                       index_file=args['index_file'], index_max_age=args['index_max_age'],
+                       reconcile=args['reconcile'], rate=args['rate'], max_suspend=args['max_suspend'])
         loop = asyncio.get_event_loop()
         loop.create_task(ret.start())
         loop.run_forever()
     else:
-        asyncio.run(process(gws_users_client, ldap_client, keycloak_client, dryrun=args['dryrun']))
+        index = GwsIndex(args['index_file'], max_age=args['index_max_age']) if args['index_file'] else None
+        asyncio.run(process(gws_users_client, ldap_client, keycloak_client, dryrun=args['dryrun'],
+                            new_batch=gws_directory.new_batch_http_request, batch_size=args['batch_size'],
+                            index=index, reconcile=args['reconcile'], rate=args['rate'],
+                            max_suspend=args['max_suspend']))
 
 
 if __name__ == '__main__':
@@ -8,6 +8,8 @@ import string
 from krs.ldap import LDAP
 from krs.rabbitmq import RabbitMQListener
 
+from .shadow import build_table, expiry_updates, get_shadow_users
+
 
 logger = logging.getLogger('update_ldap_shadow_expire')
 
@@ -22,43 +24,49 @@ def flatten_group_name(path):
 
 
 async def process(username=None, dryrun=False, ldap_client=None):
-    ldap_users = ldap_client.list_users()
-
-    if username:
-        usernames = [username]
-    else:
-        usernames = list(ldap_users)
+    ldap_users = get_shadow_users(ldap_client, username)
+    table = build_table(ldap_users)
 
-    for uid in sorted(usernames):
+    updates = {}
+    for uid, newExpire in expiry_updates(table).items():
         user = ldap_users[uid]
-        if 'shadowExpire' in user and 'shadowLastChange' in user and 'shadowMax' in user:
+        logger.debug(f'old expire = {user["shadowExpire"]}, lastChange = {user["shadowLastChange"]}')
+        logger.info(f'updating expiry for user {uid} to {newExpire}')
+        updates[uid] = {'shadowExpire': newExpire}
 
-            oldExpire = int(user['shadowExpire'])
-            newExpire = int(user['shadowLastChange'])+int(user['shadowMax'])
+    if updates and not dryrun:
+        ret = ldap_client.modify_users(updates)
+        for uid, error in ret.items():
+            if error:
+                logger.warning(f'error updating expiry for user {uid}: {error}')
 
-            if oldExpire > 0 and oldExpire < newExpire:
-                logger.debug(f'old expire = {oldExpire}, lastChange = {user["shadowLastChange"]}')
-                logger.info(f'updating expiry for user {uid} to {newExpire}')
-                if not dryrun:
-                    ldap_client.modify_user(uid, {'shadowExpire': newExpire})
 
-
-def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
+def action_config(dedup=1, **kwargs):
+    """Get the message action, routing key, and dedup interval for a listener"""
     async def action(message):
         logger.debug(f'{message}')
         await process(message['representation']['username'], **kwargs)
 
-    args = {
+    return {
+        'action': action,
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.USER.#',
         'dedup': dedup,
     }
+
+
+def listener(address=None, exchange=None, **kwargs):
+    """Set up RabbitMQ listener"""
+    config = action_config(**kwargs)
+    args = {
+        'routing_key': config['routing_key'],
+        'dedup': config['dedup'],
+    }
     if address:
         args['address'] = address
     if exchange:
         args['exchange'] = exchange
 
-    return RabbitMQListener(action, **args)
+    return RabbitMQListener(config['action'], **args)
 
 
 def main():
@@ -1,6 +1,15 @@
+import asyncio
+import json
+import logging
+import os
 import pathlib
+import shlex
 import subprocess
 import tempfile
+import time
+
+
+logger = logging.getLogger('actions.util')
 
 
 QUOTAS = {
@@ -29,6 +38,13 @@ INGORE_DIR_ROLES = {
 
 ssh_opts = ['-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no']
 
+# share one persistent ssh connection per host between commands
+ssh_mux_opts = [
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPath=' + os.path.join(tempfile.gettempdir(), 'krs-ssh-%C'),
+    '-o', 'ControlPersist=10m',
+]
+
 
 def ssh(host, *args):
     """Run command on remote machine via ssh."""
@@ -64,3 +80,207 @@ def scp_and_run_sudo(host, script_data, script_name='create.py'):
         ssh(host, 'sudo', 'python', f'/tmp/{script_name}')
     finally:
         ssh(host, 'rm', f'/tmp/{script_name}')
+
+
+async def run_remote_script(host, script_data, sudo=False):
+    """
+    Run a python script on a remote machine.
+
+    The script is streamed over stdin, using a multiplexed ssh connection
+    that stays open between calls, so repeated runs skip the ssh handshake.
+
+    Args:
+        host (str): remote host
+        script_data (str): python script
+        sudo (bool): run the script as root (default: False)
+
+    Raises:
+        subprocess.CalledProcessError: if the script fails
+    """
+    cmd = ['ssh'] + ssh_opts + ssh_mux_opts + [host]
+    if sudo:
+        cmd.append('sudo')
+    cmd += ['python', '-']
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.PIPE)
+    await proc.communicate(script_data.encode('utf-8'))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+AGENT_PATH = pathlib.Path(__file__).parent / 'remote_agent.py'
+
+# read the agent source from stdin, then serve requests on the rest of stdin
+AGENT_BOOTSTRAP = 'import sys; exec(sys.stdin.read(int(sys.stdin.readline())))'
+
+
+def agent_script(op, args, log_level=logging.INFO):
+    """
+    Build a one-shot script that runs a single remote agent request.
+
+    Args:
+        op (str): agent operation
+        args (dict): operation arguments
+        log_level (int): logging level on the remote side
+
+    Returns:
+        str: python script
+    """
+    source = AGENT_PATH.read_text()
+    source = source[:source.index("if __name__ == '__main__':")]
+    request = json.dumps({'op': op, 'args': args})
+    return source + f'''logging.basicConfig(level={log_level})
+REQUEST = json.loads({json.dumps(request)})
+Agent().run_once(REQUEST)
+'''
+
+
+class RemoteAgentError(Exception):
+    pass
+
+
+class RemoteAgent:
+    """
+    Client for a long-running `actions/remote_agent.py` on a remote host.
+
+    The agent is started over ssh on first use and kept running, so it
+    can cache remote state between requests.  Unless `agent_path` points
+    to a deployed copy, the agent source is streamed over the connection.
+
+    Args:
+        host (str): remote host
+        sudo (bool): run the agent as root (default: False)
+        agent_path (str): (optional) path to the agent on the remote host
+        log_level (str): agent logging level
+    """
+    def __init__(self, host, sudo=False, agent_path=None, log_level='info'):
+        self.host = host
+        self.sudo = sudo
+        self.agent_path = agent_path
+        self.log_level = log_level
+        self._proc = None
+        self._lock = None
+
+    def _command(self):
+        cmd = ['ssh'] + ssh_opts + ssh_mux_opts + [self.host]
+        if self.sudo:
+            cmd.append('sudo')
+        if self.agent_path:
+            cmd += ['python', '-u', self.agent_path]
+        else:
+            cmd += ['python', '-u', '-c', shlex.quote(AGENT_BOOTSTRAP)]
+        return cmd + ['--log-level', self.log_level]
+
+    async def start(self):
+        logger.info(f'starting remote agent on {self.host}')
+        self._proc = await asyncio.create_subprocess_exec(*self._command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        if not self.agent_path:
+            source = AGENT_PATH.read_text()
+            self._proc.stdin.write(f'{len(source)}\n{source}'.encode('utf-8'))
+
+    async def close(self):
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        if proc.returncode is None:
+            proc.stdin.close()
+            try:
+                await asyncio.wait_for(proc.wait(), 10)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+
+    async def _request(self, line):
+        if self._proc is None or self._proc.returncode is not None:
+            await self.start()
+        self._proc.stdin.write(line)
+        await self._proc.stdin.drain()
+        ret = await self._proc.stdout.readline()
+        if not ret:
+            raise ConnectionError(f'remote agent on {self.host} exited')
+        return json.loads(ret)
+
+    async def request(self, op, **args):
+        """
+        Send a request to the agent, restarting it once if it has died.
+
+        Args:
+            op (str): agent operation
+            **args: operation arguments
+
+        Returns:
+            dict: operation result
+
+        Raises:
+            RemoteAgentError: if the operation fails
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        line = (json.dumps({'op': op, 'args': args}) + '\n').encode('utf-8')
+        async with self._lock:
+            try:
+                ret = await self._request(line)
+            except (ConnectionError, ValueError):
+                logger.info(f'remote agent on {self.host} failed, restarting', exc_info=True)
+                await self.close()
+                ret = await self._request(line)
+        if not ret['ok']:
+            raise RemoteAgentError(ret['error'])
+        return ret['result']
+
+
+class ProvisionedState:
+    """
+    Record of users already provisioned on each target.
+
+    Lets actions send only users that are not yet known to exist.  A
+    target is fully re-verified after `verify_interval` seconds, in case
+    something was removed behind our back.
+
+    Args:
+        path (str): (optional) JSON file to persist the state in
+        verify_interval (float): seconds between full verifications
+    """
+    def __init__(self, path=None, verify_interval=86400):
+        self.path = path
+        self.verify_interval = verify_interval
+        self._state = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+
+    def known(self, target):
+        """
+        Get the users provisioned on a target.
+
+        Args:
+            target (str): target name, like `host:/root/dir`
+
+        Returns:
+            set: usernames, or None if the target needs a full verification
+        """
+        entry = self._state.get(target)
+        if not entry or time.time() - entry['verified'] > self.verify_interval:
+            return None
+        return set(entry['users'])
+
+    def update(self, target, usernames, verified=False):
+        """
+        Record users as provisioned on a target.
+
+        Args:
+            target (str): target name
+            usernames (iterable): provisioned usernames
+            verified (bool): the usernames are the full, verified set
+        """
+        if verified:
+            self._state[target] = {'users': sorted(usernames), 'verified': time.time()}
+        elif target in self._state:
+            entry = self._state[target]
+            entry['users'] = sorted(set(entry['users']) | set(usernames))
+        else:
+            return  # wait for a full verification
+        if self.path:
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f)
+            os.replace(tmp, self.path)
@@ -0,0 +1,55 @@
+"""
+Compare per-message email building against a precompiled EmailTemplate.
+
+Example::
+
+    python -m benchmarks.email_render -n 10000
+"""
+import time
+from datetime import datetime, timedelta
+
+from krs.email import build_email, EmailTemplate
+
+
+CONTENT = """IceCube Account Password Expiring
+
+Your IceCube account password is expiring soon.  Please reset it
+before {date:%Y-%m-%d}.
+
+Username: {uid}
+"""
+
+
+def bench(name, fn, users):
+    start = time.perf_counter()
+    for user in users:
+        fn(user)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {len(users)/elapsed:10.0f} messages/sec')
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark email rendering')
+    parser.add_argument('-n', '--num', default=10000, type=int, help='number of messages')
+    args = parser.parse_args()
+
+    expires = datetime.now() + timedelta(days=10)
+    users = [{'uid': f'user{i}', 'name': f'User {i}', 'email': f'user{i}@icecube.wisc.edu'} for i in range(args.num)]
+
+    def build(user):
+        content = CONTENT.format(uid=user['uid'], date=expires)
+        return bytes(build_email(user, 'IceCube Password Expiring', content))
+
+    template = EmailTemplate('IceCube Password Expiring', CONTENT)
+
+    def render(user):
+        return template.render(user, {'uid': user['uid'], 'date': expires}).data
+
+    bench('build', build, users)
+    bench('template', render, users)
+
+
+if __name__ == '__main__':
+    main()
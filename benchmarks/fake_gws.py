@@ -0,0 +1,157 @@
+"""
+A local fake of the Google Workspace Directory API users endpoints.
+
+Supports paged `users.list`, `users.insert`, `users.patch`, and the batch HTTP endpoint,
+with a configurable per-request latency.  Clients are built from the
+bundled discovery document pointed at the local server.
+
+Example::
+
+    with FakeDirectory(latency=.02) as fake:
+        gws_directory = fake.client()
+        gws_directory.users().list(customer='my_customer').execute()
+"""
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse, parse_qs, unquote
+
+import googleapiclient
+from googleapiclient.discovery import build_from_document
+import httplib2
+
+
+USERS_PATH = '/admin/directory/v1/users'
+
+
+def load_discovery(root_url):
+    """Load the Directory API discovery document, pointed at `root_url`."""
+    path = os.path.join(os.path.dirname(googleapiclient.__file__), 'discovery_cache',
+                        'documents', 'admin.directory_v1.json')
+    with open(path) as f:
+        doc = json.load(f)
+    doc['rootUrl'] = root_url
+    doc['baseUrl'] = root_url + doc['servicePath']
+    doc['batchPath'] = 'batch'
+    return doc
+
+
+class FakeDirectory:
+    """
+    Fake Directory API server, running in a background thread.
+
+    Args:
+        users (dict): initial users, keyed by primary email
+        latency (float): seconds to wait before answering each HTTP request
+    """
+    def __init__(self, users=None, latency=0):
+        self.users = dict(users) if users else {}
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.root_url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self):
+        """Directory API client talking to this server."""
+        return build_from_document(load_discovery(self.root_url), http=httplib2.Http())
+
+    def list_users(self, query):
+        max_results = int(query.get('maxResults', ['100'])[0])
+        start = int(query.get('pageToken', ['0'])[0])
+        emails = sorted(self.users)
+        ret = {'users': [self.users[e] for e in emails[start:start+max_results]]}
+        if start + max_results < len(emails):
+            ret['nextPageToken'] = str(start + max_results)
+        return 200, ret
+
+    def insert_user(self, body):
+        user = json.loads(body)
+        email = user.get('primaryEmail')
+        with self.lock:
+            if email in self.users:
+                return 409, {'error': {'code': 409, 'message': 'Entity already exists.'}}
+            user.pop('password', None)
+            user['suspended'] = False
+            self.users[email] = user
+        return 200, user
+
+    def patch_user(self, email, body):
+        with self.lock:
+            if email not in self.users:
+                return 404, {'error': {'code': 404, 'message': 'Resource Not Found: userKey'}}
+            self.users[email].update(json.loads(body))
+            return 200, self.users[email]
+
+    def call(self, method, path, body):
+        url = urlparse(path)
+        if url.path == USERS_PATH and method == 'GET':
+            return self.list_users(parse_qs(url.query))
+        if url.path == USERS_PATH and method == 'POST':
+            return self.insert_user(body)
+        if url.path.startswith(USERS_PATH+'/') and method == 'PATCH':
+            return self.patch_user(unquote(url.path[len(USERS_PATH)+1:]), body)
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
+
+    def batch(self, content_type, body):
+        msg = Parser().parsestr(f'Content-Type: {content_type}\r\n\r\n' + body)
+        boundary = 'batch_response'
+        parts = []
+        for part in msg.get_payload():
+            request = part.get_payload()
+            head, _, req_body = request.replace('\r\n', '\n').partition('\n\n')
+            method, path, _ = head.split('\n', 1)[0].split(' ', 2)
+            status, ret = self.call(method, path, req_body)
+            content_id = part['Content-ID'].replace('<', '<response-', 1)
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n'
+                         f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n'
+                         f'{json.dumps(ret)}\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(parts) + f'--{boundary}--\r\n'
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, content_type, data):
+                data = data.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self):
+                with fake.lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                if self.path == '/batch':
+                    content_type, data = fake.batch(self.headers['Content-Type'], body)
+                    self._respond(200, content_type, data)
+                else:
+                    status, ret = fake.call(self.command, self.path, body)
+                    self._respond(status, 'application/json', json.dumps(ret))
+
+            do_GET = _handle
+            do_POST = _handle
+            do_PATCH = _handle
+
+        return Handler
@@ -0,0 +1,192 @@
+"""
+An in-process fake of the Keycloak admin REST API.
+
+Covers the realm endpoints used for groups, users, memberships, apps,
+roles, role mappings, and partial imports, with a configurable latency
+per request.  It stands in for the `rest_client` of the `krs` functions.
+
+Example::
+
+    kc = FakeKeycloak(latency=.005)
+    await krs.groups.create_group('/posix', rest_client=kc)
+"""
+import asyncio
+import copy
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeKeycloak:
+    """
+    Fake Keycloak realm.
+
+    Args:
+        latency (float): seconds to wait before answering each request
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.groups = {}
+        self.users = {}
+        self.clients = {}
+        self.members = {}
+        self.mappings = {}
+        self.requests = 0
+        self.writes = 0
+        self._count = 0
+        self._group_ids = {}
+        self._user_ids = {}
+
+    def _new_id(self):
+        self._count += 1
+        return f'id{self._count}'
+
+    def add_group(self, path, attributes=None):
+        parent, name = path.rsplit('/', 1)
+        parent_id = self.group_id(parent) if parent else None
+        if self.group_id(path):
+            raise Exception(f'409 group {path} exists')
+        gid = self._new_id()
+        self.groups[gid] = {'id': gid, 'name': name, 'path': path, 'parent': parent_id,
+                            'attributes': copy.deepcopy(attributes or {})}
+        self.members[gid] = set()
+        self._group_ids[path] = gid
+        return gid
+
+    def add_client(self, client_id, roles=(), url='', access='public', service_account=False, builtin_scopes=()):
+        cid = self._new_id()
+        self.clients[cid] = {'id': cid, 'clientId': client_id, 'rootUrl': url,
+                             'attributes': {'app': 'true'}, 'roles': list(roles),
+                             'serviceAccountsEnabled': service_account, 'defaultClientScopes': [],
+                             'optionalClientScopes': list(builtin_scopes), 'access': access}
+        return cid
+
+    def add_user(self, user):
+        if self.user_id(user['username']):
+            raise Exception(f'409 user {user["username"]} exists')
+        uid = self._new_id()
+        self.users[uid] = dict({k: v for k, v in user.items() if k != 'groups'}, id=uid)
+        self._user_ids[user['username']] = uid
+        for path in user.get('groups', []):
+            self.members[self.group_id(path)].add(uid)
+        return uid
+
+    def group_id(self, path):
+        return self._group_ids.get(path)
+
+    def user_id(self, username):
+        return self._user_ids.get(username)
+
+    def _group_tree(self, parent):
+        return [dict(g, subGroups=self._group_tree(gid)) for gid, g in self.groups.items() if g['parent'] == parent]
+
+    def _roles(self, cid):
+        return [{'id': f'{cid}-{r}', 'name': r} for r in self.clients[cid]['roles']]
+
+    async def request(self, method, path, args=None):
+        self.requests += 1
+        if method != 'GET':
+            self.writes += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return copy.deepcopy(self._request(method, path, copy.deepcopy(args)))
+
+    def _request(self, method, path, args):
+        url = urlparse(path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = url.path.split('/')[1:]
+        first = int(query.get('first', 0))
+        max_ = int(query.get('max', 100))
+
+        if parts[0] == 'groups':
+            if len(parts) == 1:
+                if method == 'POST':
+                    self.add_group('/' + args['name'], args.get('attributes'))
+                    return {}
+                return self._group_tree(None)
+            gid = parts[1]
+            if len(parts) == 2:
+                if method == 'PUT':
+                    self.groups[gid]['attributes'] = args.get('attributes', {})
+                    return {}
+                return dict(self.groups[gid], subGroups=self._group_tree(gid))
+            if parts[2] == 'children' and method == 'POST':
+                self.add_group(self.groups[gid]['path'] + '/' + args['name'], args.get('attributes'))
+                return {}
+            if parts[2] == 'members':
+                uids = sorted(self.members[gid])[first:first+max_]
+                return [self.users[uid] for uid in uids]
+            if parts[2] == 'role-mappings':
+                mappings = self.mappings.setdefault(gid, {})
+                if len(parts) == 3:
+                    return {'clientMappings': {
+                        self.clients[cid]['clientId']: {'id': cid, 'client': self.clients[cid]['clientId'],
+                                                        'mappings': [r for r in self._roles(cid) if r['name'] in roles]}
+                        for cid, roles in mappings.items() if roles}}
+                cid = parts[4]
+                if method == 'POST':
+                    mappings.setdefault(cid, set()).update(r['name'] for r in args)
+                    return {}
+                return [r for r in self._roles(cid) if r['name'] in mappings.get(cid, ())]
+
+        if parts[0] == 'users':
+            if len(parts) == 1:
+                if method == 'POST':
+                    self.add_user(args)
+                    return {}
+                if 'username' in query:
+                    uid = self.user_id(query['username'])
+                    return [self.users[uid]] if uid else []
+                if 'search' in query:
+                    return [u for u in self.users.values() if query['search'] in u['username']][first:first+max_]
+                return list(self.users.values())[first:first+max_]
+            uid = parts[1]
+            if uid == 'count':
+                return len(self.users)
+            if len(parts) == 2:
+                if method == 'PUT':
+                    self.users[uid] = dict(args, id=uid)
+                    return {}
+                return self.users[uid]
+            if parts[2] == 'groups':
+                if len(parts) == 3:
+                    return [{'id': gid, 'name': g['name'], 'path': g['path']}
+                            for gid, g in self.groups.items() if uid in self.members[gid]]
+                if method == 'PUT':
+                    self.members[parts[3]].add(uid)
+                elif method == 'DELETE':
+                    self.members[parts[3]].discard(uid)
+                return {}
+
+        if parts[0] == 'clients':
+            if len(parts) == 1:
+                clients = [c for c in self.clients.values()
+                           if 'clientId' not in query or c['clientId'] == query['clientId']]
+                return [{k: v for k, v in c.items() if k not in ('roles', 'access')} for c in clients]
+            cid = parts[1]
+            if parts[2] == 'roles':
+                if method == 'POST':
+                    self.clients[cid]['roles'].append(args['name'])
+                    return {}
+                return self._roles(cid)
+            if parts[2] == 'client-secret':
+                return {}
+
+        if parts[0] == 'client-scopes' and len(parts) == 1:
+            return [{'id': f'{cid}-scope', 'name': c['clientId'], 'protocol': 'openid-connect',
+                     'attributes': {'app': 'app', 'access': c['access']}} for cid, c in self.clients.items()]
+
+        if parts[0] == 'partialImport':
+            ret = {'added': 0, 'skipped': 0, 'results': []}
+            for user in args.get('users', []):
+                uid = self.user_id(user['username'])
+                if uid:
+                    ret['skipped'] += 1
+                    action = 'SKIPPED'
+                else:
+                    uid = self.add_user(user)
+                    ret['added'] += 1
+                    action = 'ADDED'
+                ret['results'].append({'action': action, 'resourceType': 'USER',
+                                       'resourceName': user['username'], 'id': uid})
+            return ret
+
+        raise Exception(f'404 {method} {path}')
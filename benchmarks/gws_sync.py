@@ -0,0 +1,85 @@
+"""
+Compare one-by-one and batched account inserts against a fake Directory API,
+and time reconciliation planning over a large directory.
+
+Example::
+
+    python -m benchmarks.gws_sync -n 500 --latency .02 --accounts 50000
+"""
+import random
+import time
+
+from actions.sync_gws_accounts import get_gws_accounts, insert_accounts, plan_changes, apply_plan
+
+from .fake_gws import FakeDirectory
+
+
+def bench(name, fn, *args, **kwargs):
+    start = time.perf_counter()
+    ret = fn(*args, **kwargs)
+    print(f'{name:>10}: {time.perf_counter()-start:.3f} seconds')
+    return ret
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark Google Workspace account inserts')
+    parser.add_argument('-n', '--num', default=500, type=int, help='number of accounts to insert')
+    parser.add_argument('--existing', default=2000, type=int, help='number of existing accounts')
+    parser.add_argument('--latency', default=.02, type=float, help='seconds of latency per HTTP request')
+    parser.add_argument('--batch-size', default=50, type=int, help='inserts per batch request')
+    parser.add_argument('--accounts', default=50000, type=int, help='number of accounts to reconcile')
+    parser.add_argument('--changes', default=.01, type=float, help='fraction of accounts that need a change')
+    args = parser.parse_args()
+
+    existing = {f'old{i}@icecube.wisc.edu': {'primaryEmail': f'old{i}@icecube.wisc.edu'}
+                for i in range(args.existing)}
+
+    def bodies(prefix):
+        return [{'primaryEmail': f'{prefix}{i}@icecube.wisc.edu', 'password': 'x',
+                 'name': {'givenName': 'F', 'familyName': 'L'}} for i in range(args.num)]
+
+    with FakeDirectory(existing, latency=args.latency) as fake:
+        gws_directory = fake.client()
+        gws_users_client = gws_directory.users()
+
+        ret = bench('list', get_gws_accounts, gws_users_client)
+        assert len(ret) == args.existing
+
+        fake.requests = 0
+        bench('serial', insert_accounts, gws_users_client, bodies('serial'))
+        print(f'{"":>10}  {fake.requests} requests')
+
+        fake.requests = 0
+        failed = bench('batched', insert_accounts, gws_users_client, bodies('batch'),
+                       new_batch=gws_directory.new_batch_http_request, batch_size=args.batch_size)
+        print(f'{"":>10}  {fake.requests} requests')
+        assert not failed
+        assert len(fake.users) == args.existing + 2*args.num
+
+    today = int(time.time()/3600/24)
+    name = {'givenName': 'F', 'familyName': 'L'}
+    kc_accounts = {}
+    ldap_accounts = {}
+    gws_accounts = {}
+    for i in range(args.accounts):
+        username = f'user{i}'
+        change = random.random() < args.changes
+        kc_accounts[username] = {'attributes': {'loginShell': '/bin/bash'}, 'enabled': True,
+                                 'firstName': 'G' if change else 'F', 'lastName': 'L'}
+        ldap_accounts[username] = {'shadowExpire': today + 100}
+        gws_accounts[username] = {'primaryEmail': f'{username}@icecube.wisc.edu', 'name': name, 'suspended': False}
+    plan = bench('plan', plan_changes, kc_accounts, ldap_accounts, gws_accounts)
+    print(f'{"":>10}  {len(plan["update"])} updates for {args.accounts} accounts')
+
+    with FakeDirectory({a['primaryEmail']: dict(a) for a in gws_accounts.values()}, latency=args.latency) as fake:
+        gws_directory = fake.client()
+        ret = bench('apply', apply_plan, gws_directory.users(), plan, rate=None,
+                    new_batch=gws_directory.new_batch_http_request, batch_size=args.batch_size)
+        print(f'{"":>10}  {fake.requests} requests')
+        assert len(ret['update']) == len(plan['update'])
+
+
+if __name__ == '__main__':
+    main()
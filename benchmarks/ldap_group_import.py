@@ -0,0 +1,86 @@
+"""
+Time the LDAP to Keycloak posix group import against a fake LDAP and a
+fake Keycloak with request latency, compared with adding the same /posix
+members one at a time with `add_user_group()`.
+
+Example::
+
+    python -m benchmarks.ldap_group_import -n 8000 --groups 1000 --latency .002
+"""
+import asyncio
+import random
+import time
+from unittest import mock
+
+from krs.groups import add_user_group
+from keycloak_setup import icecube_ldap
+
+from .fake_keycloak import FakeKeycloak
+
+
+class FakeLDAP:
+    def __init__(self, users, groups):
+        self.users = users
+        self.groups = groups
+
+    def list_users(self, attrs=None):
+        return self.users
+
+    def list_groups(self, groupbase=None, attrs=None):
+        return self.groups
+
+
+def make_data(num_users, num_groups, latency):
+    users = {f'user{i}': {'uid': f'user{i}', 'loginShell': '/bin/bash' if i % 10 else '/sbin/nologin'}
+             for i in range(num_users)}
+    groups = {}
+    for i in range(num_groups):
+        members = random.sample(sorted(users), min(20, num_users))
+        groups[f'group{i}'] = {'cn': f'group{i}', 'gidNumber': str(20000+i), 'memberUid': members}
+
+    kc = FakeKeycloak(latency=latency)
+    kc.add_group('/posix')
+    for username in users:
+        kc.add_user({'username': username})
+    return users, groups, kc
+
+
+async def run(args):
+    users, groups, kc = make_data(args.num, args.groups, args.latency)
+    with mock.patch.object(icecube_ldap, 'LDAP', lambda: FakeLDAP(users, groups)):
+        start = time.perf_counter()
+        await icecube_ldap.import_ldap_groups(kc, ldap_setup=False, concurrency=args.concurrency)
+        print(f'{"import":>10}: {time.perf_counter()-start:.3f} seconds, {kc.requests} requests')
+        assert len(kc.members[kc.group_id('/posix')]) == sum(1 for u in users.values() if u['loginShell'] != '/sbin/nologin')
+
+        kc.requests = 0
+        start = time.perf_counter()
+        await icecube_ldap.import_ldap_groups(kc, ldap_setup=False, concurrency=args.concurrency)
+        print(f'{"reimport":>10}: {time.perf_counter()-start:.3f} seconds, {kc.requests} requests')
+
+    if args.serial:
+        _, _, kc = make_data(args.serial, 0, args.latency)
+        start = time.perf_counter()
+        for username in sorted(kc._user_ids):
+            await add_user_group('/posix', username, rest_client=kc)
+        print(f'{"serial":>10}: {time.perf_counter()-start:.3f} seconds for {args.serial} /posix members, {kc.requests} requests')
+
+
+def main():
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description='Benchmark the LDAP to Keycloak group import')
+    parser.add_argument('-n', '--num', default=8000, type=int, help='number of users')
+    parser.add_argument('--groups', default=1000, type=int, help='number of posix groups')
+    parser.add_argument('--latency', default=.002, type=float, help='seconds of latency per request')
+    parser.add_argument('--concurrency', default=16, type=int, help='max concurrent requests')
+    parser.add_argument('--serial', default=200, type=int, help='number of users to add one at a time (0 to skip)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
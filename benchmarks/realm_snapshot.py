@@ -0,0 +1,92 @@
+"""
+Compare copying a realm with the per-object `krs` functions against
+a snapshot export and import, using a fake Keycloak with request latency.
+
+Example::
+
+    python -m benchmarks.realm_snapshot -n 2000 --latency .002
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+from krs import groups, users
+from krs.snapshot import export_realm, import_realm
+
+from .fake_keycloak import FakeKeycloak
+
+
+def make_realm(num_users, num_groups, latency):
+    kc = FakeKeycloak(latency=latency)
+    kc.add_group('/institutions')
+    kc.add_group('/institutions/IceCube')
+    for i in range(num_groups):
+        kc.add_group(f'/institutions/IceCube/inst{i}', {'name': [f'Inst {i}'], 'cite': [f'Inst {i}, Earth']})
+    kc.add_group('/posix')
+    for i in range(num_users):
+        kc.add_user({'username': f'user{i}', 'firstName': 'F', 'lastName': 'L', 'email': f'user{i}@icecube',
+                     'enabled': True, 'attributes': {'uidNumber': [str(10000+i)]},
+                     'groups': ['/posix', f'/institutions/IceCube/inst{i % num_groups}']})
+    return kc
+
+
+async def serial_copy(src, dest):
+    """Copy groups, users, and memberships with the krs functions."""
+    for g in sorted(src.groups.values(), key=lambda g: g['path']):
+        attrs = {k: v[0] for k, v in g['attributes'].items()}
+        await groups.create_group(g['path'], attrs=attrs, rest_client=dest)
+    for u in src.users.values():
+        await users.create_user(u['username'], u['firstName'], u['lastName'], u['email'],
+                                u['attributes'], rest_client=dest)
+    for gid, uids in src.members.items():
+        for uid in uids:
+            await groups.add_user_group(src.groups[gid]['path'], src.users[uid]['username'], rest_client=dest)
+
+
+async def bench(name, dest, coro):
+    dest.requests = 0
+    start = time.perf_counter()
+    ret = await coro
+    print(f'{name:>10}: {time.perf_counter()-start:.3f} seconds, {dest.requests} requests')
+    return ret
+
+
+async def run(args):
+    src = make_realm(args.num, args.groups, args.latency)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'realm.ndjson.gz')
+        await bench('export', src, export_realm(filename, rest_client=src))
+        print(f'{"":>10}  {os.path.getsize(filename)} bytes')
+
+        dest = FakeKeycloak(latency=args.latency)
+        await bench('import', dest, import_realm(filename, batch_size=args.batch_size,
+                                                 concurrency=args.concurrency, rest_client=dest))
+        await bench('reimport', dest, import_realm(filename, batch_size=args.batch_size,
+                                                   concurrency=args.concurrency, rest_client=dest))
+        assert len(dest.users) == args.num
+
+    if args.serial:
+        dest = FakeKeycloak(latency=args.latency)
+        await bench('serial', dest, serial_copy(src, dest))
+
+
+def main():
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description='Benchmark realm snapshot export and import')
+    parser.add_argument('-n', '--num', default=2000, type=int, help='number of users')
+    parser.add_argument('--groups', default=50, type=int, help='number of institution groups')
+    parser.add_argument('--latency', default=.002, type=float, help='seconds of latency per request')
+    parser.add_argument('--batch-size', default=100, type=int, help='users per import request')
+    parser.add_argument('--concurrency', default=8, type=int, help='max concurrent requests')
+    parser.add_argument('--no-serial', dest='serial', default=True, action='store_false', help='skip the serial copy')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare the per-user expiry loop against the columnar classification.
+
+Example::
+
+    python -m benchmarks.shadow_classify -n 100000
+"""
+from datetime import datetime, timedelta
+import random
+import time
+
+from actions import shadow
+
+
+def loop_classify(ldap_users, usernames):
+    """The original per-user loop."""
+    today = int(time.time()/3600/24)
+    now = datetime.utcnow()
+    expiring_users = {}
+    expired_users = {}
+    disabled_users = {}
+    for uid in sorted(usernames):
+        user = ldap_users[uid]
+        if user.get('shadowExpire', 0) > 0 and user.get('shadowMax', 0) > 0:
+            days_remaining = int(user['shadowExpire']) - today
+            exp_date = (now + timedelta(days=days_remaining)).date()
+            if days_remaining < -180:
+                disabled_users[uid] = exp_date
+            elif -7 < days_remaining <= 0:
+                expired_users[uid] = exp_date
+            elif 0 < days_remaining <= 28:
+                expiring_users[uid] = exp_date
+    return expiring_users, expired_users, disabled_users
+
+
+def columnar_classify(ldap_users, usernames):
+    return shadow.classify_expiry(shadow.build_table(ldap_users, usernames))
+
+
+def bench(name, fn, *args):
+    start = time.perf_counter()
+    ret = fn(*args)
+    print(f'{name:>10}: {time.perf_counter()-start:.3f} seconds')
+    return ret
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark password expiry classification')
+    parser.add_argument('-n', '--num', default=100000, type=int, help='number of users')
+    args = parser.parse_args()
+
+    today = int(time.time()/3600/24)
+    ldap_users = {}
+    for i in range(args.num):
+        last_change = today - random.randint(0, 400)
+        ldap_users[f'user{i}'] = {
+            'uid': f'user{i}',
+            'shadowLastChange': last_change,
+            'shadowMax': 180,
+            'shadowExpire': last_change + 180,
+        }
+
+    print(f'numpy: {"yes" if shadow.np is not None else "no"}')
+    expected = bench('loop', loop_classify, ldap_users, list(ldap_users))
+    ret = bench('columnar', columnar_classify, ldap_users, list(ldap_users))
+    assert ret == expected
+
+
+if __name__ == '__main__':
+    main()
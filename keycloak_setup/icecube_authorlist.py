@@ -1,16 +1,20 @@
 import argparse
 import asyncio
 from collections import defaultdict
+import functools
 from xml.etree import ElementTree
 from html import unescape
+import io
 import logging
 
 import requests
+import unidecode
 
-from krs.users import list_users, modify_user
-from krs.groups import add_user_group
+from krs.users import modify_user
+from krs.state import gather_limited
 from krs.token import get_rest_client
 
+from .icecube_ldap import get_keycloak_snapshot, apply_membership_changes
 from .institution_list import ICECUBE_INSTS, GEN2_INSTS
 
 logger = logging.getLogger('import_authorlist')
@@ -28,39 +32,165 @@ def get_attr_as_list(group, name, default=None):
     return [val]
 
 
-async def import_authorlist_insts(keycloak_conn, base_group='/institutions/IceCube', INSTS=ICECUBE_INSTS, dryrun=False):
-    # get authorlist data
-    url = f'https://authorlist.icecube.wisc.edu/api/authors?formatting=inspire&collab={base_group.split("/")[-1]}'
-    r = requests.get(url)
-    inspire_xml = unescape(r.json()['inspire']['format_text'])
-    author_data = ElementTree.fromstring(inspire_xml)
+FOAF = '{http://xmlns.com/foaf/0.1/}'
+CAL = '{http://inspirehep.net/info/HepNames/tools/authors_xml/}'
+
+
+def normalize(name):
+    """
+    Normalize a name for matching.
+
+    Transliterates to ASCII, lowercases, and drops punctuation and spaces.
+
+    Args:
+        name (str): name
+
+    Returns:
+        str: normalized name
+    """
+    if not name:
+        return ''
+    return ''.join(c for c in unidecode.unidecode(name).lower() if c.isalnum())
+
+
+@functools.lru_cache(maxsize=8)
+def parse_authorlist(inspire_xml):
+    """
+    Parse an INSPIRE author list.
+
+    Organization and Person elements are processed, then cleared and
+    detached from their parent, as they are read.  Results are cached by
+    the XML text, so an unchanged author list is only parsed once.
+
+    Args:
+        inspire_xml (str): author list in INSPIRE XML format
+
+    Returns:
+        tuple: (organization id: name dict, list of author dicts)
+    """
     author_insts = {}
     author_users = []
-    for el in author_data.iter():
-        if el.tag == '{http://xmlns.com/foaf/0.1/}Organization':
-            author_insts[el.attrib['id']] = el.find('{http://xmlns.com/foaf/0.1/}name').text
-        elif el.tag == '{http://xmlns.com/foaf/0.1/}Person':
-            aff = el.find('{http://inspirehep.net/info/HepNames/tools/authors_xml/}authorAffiliations')
-            ids = el.find('{http://inspirehep.net/info/HepNames/tools/authors_xml/}authorids')
+    parents = []
+    for event, el in ElementTree.iterparse(io.BytesIO(inspire_xml.encode('utf-8')), events=('start', 'end')):
+        if event == 'start':
+            parents.append(el)
+            continue
+        parents.pop()
+        if el.tag == FOAF+'Organization':
+            author_insts[el.attrib['id']] = el.find(FOAF+'name').text
+        elif el.tag == FOAF+'Person':
+            aff = el.find(CAL+'authorAffiliations')
+            ids = el.find(CAL+'authorids')
             author_users.append({
-                'first': el.find('{http://xmlns.com/foaf/0.1/}givenName').text,
-                'last': el.find('{http://xmlns.com/foaf/0.1/}familyName').text,
-                'author': el.find('{http://inspirehep.net/info/HepNames/tools/authors_xml/}authorNamePaper').text,
+                'first': el.find(FOAF+'givenName').text,
+                'last': el.find(FOAF+'familyName').text,
+                'author': el.find(CAL+'authorNamePaper').text,
                 'insts': [e.attrib['organizationid'] for e in aff if 'connection' not in e.attrib],
                 'thanks': [e.attrib['organizationid'] for e in aff if 'connection' in e.attrib],
-                'email': [e.text for e in ids if e.attrib['source'] == 'INTERNAL'],
+                'email': [e.text for e in ids if e.attrib['source'] == 'INTERNAL'] if ids is not None else [],
             })
+        else:
+            continue
+        el.clear()
+        if parents:
+            parents[-1].remove(el)
+    return author_insts, author_users
+
+
+def get_authorlist(collab):
+    """
+    Get and parse the author list of a collaboration.
+
+    Args:
+        collab (str): collaboration name
+
+    Returns:
+        tuple: (organization id: name dict, list of author dicts)
+    """
+    url = f'https://authorlist.icecube.wisc.edu/api/authors?formatting=inspire&collab={collab}'
+    r = requests.get(url)
+    r.raise_for_status()
+    return parse_authorlist(unescape(r.json()['inspire']['format_text']))
+
+
+class AuthorMatcher:
+    """
+    Match authors to Keycloak users.
+
+    Keycloak users are indexed once by their normalized `author_name`
+    attribute, username, last+first name, and last name.  An author is
+    matched by the first of those that gives a single user, trying the
+    author name, the icecube.wisc.edu email local part, the full name,
+    and then the last name.
+
+    Args:
+        keycloak_users (dict): username: user info
+    """
+    def __init__(self, keycloak_users):
+        self.by_author_name = defaultdict(list)
+        self.by_username = {}
+        self.by_name = defaultdict(list)
+        self.by_last = defaultdict(list)
+        for ku in keycloak_users.values():
+            author_name = ku.get('attributes', {}).get('author_name')
+            if isinstance(author_name, str):
+                self.by_author_name[normalize(author_name)].append(ku)
+            self.by_username[ku['username']] = ku
+            last = normalize(ku.get('lastName'))
+            self.by_name[(last, normalize(ku.get('firstName')))].append(ku)
+            self.by_last[last].append(ku)
+
+    def match(self, author):
+        """
+        Find the Keycloak user for an author.
+
+        Args:
+            author (dict): author, from `parse_authorlist()`
+
+        Returns:
+            dict: user info, or None if there is no unique match
+        """
+        ku = self.by_author_name.get(normalize(author['author']), [])
+        if len(ku) == 1:
+            return ku[0]
+        for email in author['email']:
+            parts = (email or '').split('@')
+            if len(parts) == 2 and parts[1] == 'icecube.wisc.edu' and parts[0] in self.by_username:
+                return self.by_username[parts[0]]
+        last = normalize(author['last'])
+        for ku in (self.by_name.get((last, normalize(author['first'])), []), self.by_last.get(last, [])):
+            if len(ku) == 1:
+                return ku[0]
+        return None
+
+
+async def import_authorlist_insts(keycloak_conn, base_group='/institutions/IceCube', INSTS=ICECUBE_INSTS, dryrun=False, concurrency=16):
+    """
+    Import authorlist memberships and author names into Keycloak.
+
+    Keycloak is read once, and only missing memberships and changed
+    `author_name` attributes are written.
+
+    Args:
+        keycloak_conn: keycloak rest client
+        base_group (str): experiment group holding the institutions
+        INSTS (dict): Keycloak institutions
+        dryrun (bool): only log the changes
+        concurrency (int): max concurrent Keycloak requests
+    """
+    author_insts, author_users = get_authorlist(base_group.split('/')[-1])
 
     authors_by_inst = defaultdict(list)
     for user in author_users:
         for inst in user['insts']:
             authors_by_inst[author_insts[inst]].append(user)
 
-    keycloak_users = await list_users(rest_client=keycloak_conn)
-    keycloak_by_last = defaultdict(list)
-    for ku in keycloak_users.values():
-        keycloak_by_last[ku['lastName']].append(ku)
+    paths = [f'{base_group}/{inst}/authorlist' for inst in INSTS]
+    snapshot = await get_keycloak_snapshot(keycloak_conn, paths, concurrency=concurrency, details=True)
+    matcher = AuthorMatcher(snapshot['user_details'])
 
+    adds = []
+    author_names = {}
     for inst in INSTS:
         group_name = f'{base_group}/{inst}/authorlist'
         cite = INSTS[inst]['cite']
@@ -71,48 +201,48 @@ async def import_authorlist_insts(keycloak_conn, base_group='/institutions/IceCu
         if not authors_by_inst[cite]:
             logger.warning(f'inst {inst} has no authors')
             continue
+        if group_name not in snapshot['groups']:
+            logger.warning(f'skipping inst {inst}, group {group_name} does not exist')
+            continue
 
         for user in authors_by_inst[cite]:
-            # figure out who this is
-            if user['last'] in keycloak_by_last:
-                ku = keycloak_by_last[user['last']]
-                if len(ku) == 1:
-                    keycloak_user = ku[0]
-                else:
-                    for u in ku:
-                        if u['firstName'] == user['first']:
-                            keycloak_user = u
-                            break
-                        parts = user['email'].split('@')
-                        if len(parts) == 2 and parts[1] == 'icecube.wisc.edu' and parts[0] == u['username']:
-                            keycloak_user = u
-                            break
-                    else:
-                        logger.warning(f'unknown user {user["first"]} {user["last"]} in {inst}')
-                        continue
-            else:
+            keycloak_user = matcher.match(user)
+            if not keycloak_user:
                 logger.warning(f'unknown user {user["first"]} {user["last"]} in {inst}')
                 continue
 
-            logger.info(f'adding {user["first"]} {user["last"]}: {keycloak_user["username"]} to {inst}')  # lgtm [py/clear-text-logging-sensitive-data]
-            if not dryrun:
-                await add_user_group(group_name, keycloak_user['username'], rest_client=keycloak_conn)
-                attrs = {'author_name': user['author']}
-                await modify_user(keycloak_user['username'], attrs, rest_client=keycloak_conn)
+            username = keycloak_user['username']
+            if username not in snapshot['members'][group_name]:
+                logger.info(f'adding {user["first"]} {user["last"]}: {username} to {inst}')  # lgtm [py/clear-text-logging-sensitive-data]
+                adds.append((group_name, username))
+            if keycloak_user.get('attributes', {}).get('author_name') != user['author']:
+                author_names[username] = user['author']
+
+    logger.info(f'{len(adds)} authorlist members to add, {len(author_names)} author names to set')
+    if dryrun:
+        return
+
+    await apply_membership_changes(snapshot, adds, [], concurrency=concurrency, keycloak_conn=keycloak_conn)
+
+    async def set_author_name(username):
+        logger.info(f'setting author_name for {username}')
+        await modify_user(username, attribs={'author_name': author_names[username]}, rest_client=keycloak_conn)
+    await gather_limited(set_author_name, sorted(author_names), concurrency)
 
 
 def main():
     parser = argparse.ArgumentParser(description='IceCube Keycloak setup')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
+    parser.add_argument('--concurrency', default=16, type=int, help='max concurrent Keycloak requests')
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
     rest_client = get_rest_client()
-    asyncio.run(import_authorlist_insts(rest_client, dryrun=args.dryrun))
-    asyncio.run(import_authorlist_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=ICECUBE_INSTS, dryrun=args.dryrun))
-    asyncio.run(import_authorlist_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=GEN2_INSTS, dryrun=args.dryrun))
+    asyncio.run(import_authorlist_insts(rest_client, dryrun=args.dryrun, concurrency=args.concurrency))
+    asyncio.run(import_authorlist_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=ICECUBE_INSTS, dryrun=args.dryrun, concurrency=args.concurrency))
+    asyncio.run(import_authorlist_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=GEN2_INSTS, dryrun=args.dryrun, concurrency=args.concurrency))
 
 
 if __name__ == '__main__':
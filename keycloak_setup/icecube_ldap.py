@@ -1,11 +1,14 @@
 import argparse
 import asyncio
 import logging
+import time
 
 from krs.ldap import LDAP, get_ldap_members
-from krs.users import UserDoesNotExist
-from krs.groups import list_groups, create_group, modify_group, add_user_group, remove_user_group
+from krs.groups import list_groups, create_group
 from krs.bootstrap import get_token
+from krs.snapshot import get_paged
+from krs.users import fix_attributes
+from krs.state import apply_state, gather_limited
 from krs.token import get_rest_client
 
 from .institution_list import ICECUBE_INSTS, GEN2_INSTS
@@ -25,7 +28,152 @@ def get_attr_as_list(group, name, default=None):
     return [val]
 
 
-async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False):
+class Progress:
+    """
+    Log the progress and throughput of a batch of changes.
+
+    Args:
+        name (str): name of the step
+        total (int): number of changes expected
+        interval (float): seconds between progress messages
+    """
+    def __init__(self, name, total, interval=10):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.start = time.monotonic()
+        self._last = self.start
+
+    def add(self, n=1):
+        self.count += n
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            logger.info(f'{self.name}: {self.count}/{self.total} changes, {self.rate():.1f}/s')
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.count / elapsed if elapsed > 0 else 0.
+
+    def done(self):
+        logger.info(f'{self.name}: {self.count} changes in {time.monotonic()-self.start:.1f}s, {self.rate():.1f}/s')
+
+
+async def get_keycloak_snapshot(keycloak_conn, paths, page_size=100, concurrency=16, details=False):
+    """
+    Read the Keycloak groups, users, and the members of some groups, once.
+
+    Args:
+        keycloak_conn: keycloak rest client
+        paths (iterable): group paths to get members of
+        page_size (int): results per request
+        concurrency (int): max concurrent requests
+        details (bool): also keep the full user info, including attributes
+
+    Returns:
+        dict: {groups: {path: group}, users: {username: id}, members: {path: set(usernames)},
+               user_details: {username: user info} (if requested)}
+    """
+    groups, count = await asyncio.gather(
+        list_groups(rest_client=keycloak_conn),
+        keycloak_conn.request('GET', '/users/count'),
+    )
+
+    async def get_users(first):
+        brief = 'false' if details else 'true'
+        return await keycloak_conn.request('GET', f'/users?briefRepresentation={brief}&first={first}&max={page_size}')
+    pages = await gather_limited(get_users, range(0, count, page_size), concurrency)
+    users = {u['username']: u['id'] for page in pages for u in page}
+
+    async def get_members(path):
+        members = await get_paged(f'/groups/{groups[path]["id"]}/members?briefRepresentation=true',
+                                  page_size, keycloak_conn)
+        return {u['username'] for u in members}
+    paths = [p for p in paths if p in groups]
+    members = dict(zip(paths, await gather_limited(get_members, paths, concurrency)))
+
+    logger.info(f'keycloak snapshot: {len(groups)} groups, {len(users)} users, members of {len(members)} groups')
+    ret = {'groups': groups, 'users': users, 'members': members}
+    if details:
+        ret['user_details'] = {}
+        for page in pages:
+            for u in page:
+                fix_attributes(u)
+                ret['user_details'][u['username']] = u
+    return ret
+
+
+async def apply_membership_changes(snapshot, adds, removes, concurrency=16, keycloak_conn=None):
+    """
+    Add and remove group members, `concurrency` requests at a time.
+
+    Adds are done for parent groups before their children.  A user who is
+    already in a subgroup is temporarily removed from it while being added
+    to the parent, as in `add_user_group()`.
+    See https://issues.redhat.com/browse/KEYCLOAK-11298.
+
+    The snapshot is updated with the changes.
+
+    Args:
+        snapshot (dict): keycloak snapshot, from `get_keycloak_snapshot()`
+        adds (list): (group path, username) memberships to add
+        removes (list): (group path, username) memberships to remove
+        concurrency (int): max concurrent changes
+        keycloak_conn: keycloak rest client
+    """
+    groups = snapshot['groups']
+    users = snapshot['users']
+    user_groups = {}
+    for path, members in snapshot['members'].items():
+        for username in members:
+            user_groups.setdefault(username, set()).add(path)
+    progress = Progress('group membership', len(adds) + len(removes))
+
+    async def add(item):
+        path, username = item
+        url = f'/users/{users[username]}/groups/'
+        children = [p for p in user_groups.get(username, ()) if p.startswith(path + '/')]
+        for child in children:
+            await keycloak_conn.request('DELETE', url + groups[child]['id'])
+        await keycloak_conn.request('PUT', url + groups[path]['id'])
+        for child in children:
+            await keycloak_conn.request('PUT', url + groups[child]['id'])
+        snapshot['members'].setdefault(path, set()).add(username)
+        user_groups.setdefault(username, set()).add(path)
+        logger.debug(f'user {username} added to {path}')
+        progress.add()
+
+    async def remove(item):
+        path, username = item
+        await keycloak_conn.request('DELETE', f'/users/{users[username]}/groups/{groups[path]["id"]}')
+        snapshot['members'][path].discard(username)
+        user_groups[username].discard(path)
+        logger.debug(f'user {username} removed from {path}')
+        progress.add()
+
+    await gather_limited(remove, removes, concurrency)
+    levels = {}
+    for path, username in adds:
+        levels.setdefault(path.count('/'), []).append((path, username))
+    for depth in sorted(levels):
+        await gather_limited(add, levels[depth], concurrency)
+    progress.done()
+
+
+async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False, concurrency=16):
+    """
+    Import LDAP posix groups and memberships into Keycloak.
+
+    Keycloak is read once.  Membership changes are worked out in memory,
+    and only those are applied.
+
+    Args:
+        keycloak_conn: keycloak rest client
+        ldap_setup (bool): link Keycloak to LDAP and sync users first
+        dryrun (bool): only log the changes
+        concurrency (int): max concurrent Keycloak requests
+    """
     ldap_conn = LDAP()
 
     if ldap_setup:
@@ -33,7 +181,7 @@ async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False):
         await ldap_conn.keycloak_ldap_link(get_token())
         await ldap_conn.force_keycloak_sync(keycloak_client=keycloak_conn)
 
-    ldap_users = ldap_conn.list_users()
+    ldap_users = ldap_conn.list_users(['loginShell'])
     ldap_groups = ldap_conn.list_groups()
 
     keycloak_groups = await list_groups(rest_client=keycloak_conn)
@@ -43,18 +191,8 @@ async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False):
         logger.info('creating /posix group')
         if not dryrun:
             await create_group('/posix', rest_client=keycloak_conn)
-    if not dryrun:
-        for member in ldap_users:
-            try:
-                if 'loginShell' in ldap_users[member] and ldap_users[member]['loginShell'] != '/sbin/nologin':
-                    logger.info(f'add {member} to /posix')
-                    await add_user_group('/posix', member, rest_client=keycloak_conn)
-                else:
-                    logger.info(f'remove {member} from /posix')
-                    await remove_user_group('/posix', member, rest_client=keycloak_conn)
-            except UserDoesNotExist:
-                logger.info(f'skipping user {member} for group /posix - user does not exist')
 
+    new_groups = {}
     for group_name in sorted(ldap_groups):
         members = get_ldap_members(ldap_groups[group_name])
         gidNumber = ldap_groups[group_name]['gidNumber']
@@ -65,33 +203,83 @@ async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False):
             logger.info(f'skipping empty group {group_name}')
         elif f'/posix/{group_name}' in keycloak_groups:
             logger.info(f'skipping existing group {group_name}')
-        elif group_name in ldap_users:
-            # this is a user group
-            if members == [group_name]:
-                logger.info(f'skipping 1:1 user group {group_name}')
-            else:
-                logger.info(f'creating user group /posix/{group_name} with members {members}')
-                if not dryrun:
-                    await create_group(f'/posix/{group_name}', {'gidNumber': gidNumber}, rest_client=keycloak_conn)
-                    for member in members:
-                        try:
-                            await add_user_group(f'/posix/{group_name}', member, rest_client=keycloak_conn)
-                        except UserDoesNotExist:
-                            logger.info(f'skipping user {member} for group /posix/{group_name} - user does not exist')
+        elif group_name in ldap_users and members == [group_name]:
+            logger.info(f'skipping 1:1 user group {group_name}')
         else:
-            logger.info(f'creating non-user group /posix/{group_name} with members {members}')
-            if not dryrun:
-                await create_group(f'/posix/{group_name}', {'gidNumber': gidNumber}, rest_client=keycloak_conn)
-                for member in members:
-                    try:
-                        await add_user_group(f'/posix/{group_name}', member, rest_client=keycloak_conn)
-                    except UserDoesNotExist:
-                        logger.info(f'skipping user {member} for group /posix/{group_name} - user does not exist')
+            kind = 'user' if group_name in ldap_users else 'non-user'
+            logger.info(f'creating {kind} group /posix/{group_name} with members {members}')
+            new_groups[f'/posix/{group_name}'] = (gidNumber, members)
+
+    if new_groups and not dryrun:
+        state = {'group_attrs': {path: {'gidNumber': gid} for path, (gid, _) in new_groups.items()}}
+        await apply_state(state, concurrency=concurrency, rest_client=keycloak_conn)
+
+    posix_paths = [p for p in keycloak_groups if p == '/posix' or p.startswith('/posix/')]
+    snapshot = await get_keycloak_snapshot(keycloak_conn, posix_paths, concurrency=concurrency)
+    kc_users = snapshot['users']
+    posix_members = snapshot['members'].get('/posix', set())
+
+    adds = []
+    removes = []
+    for member in sorted(ldap_users):
+        if member not in kc_users:
+            logger.info(f'skipping user {member} for group /posix - user does not exist')
+        elif 'loginShell' in ldap_users[member] and ldap_users[member]['loginShell'] != '/sbin/nologin':
+            if member not in posix_members:
+                logger.info(f'add {member} to /posix')
+                adds.append(('/posix', member))
+        elif member in posix_members:
+            logger.info(f'remove {member} from /posix')
+            removes.append(('/posix', member))
+
+    for path, (_, members) in new_groups.items():
+        for member in members:
+            if member in kc_users:
+                adds.append((path, member))
+            else:
+                logger.info(f'skipping user {member} for group {path} - user does not exist')
+
+    logger.info(f'{len(new_groups)} new groups, {len(adds)} members to add, {len(removes)} to remove')
+    if not dryrun:
+        await apply_membership_changes(snapshot, adds, removes, concurrency=concurrency, keycloak_conn=keycloak_conn)
+
 
+def index_users_by_o(ldap_users):
+    """
+    Index LDAP users by their institution.
 
-async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', INSTS=ICECUBE_INSTS, dryrun=False):
+    A user with several `o` values is indexed under each of them.
+
+    Args:
+        ldap_users (dict): username: attr dict
+
+    Returns:
+        dict: `o` DN: sorted list of usernames
+    """
+    ret = {}
+    for username in sorted(ldap_users):
+        for o in get_attr_as_list(ldap_users[username], 'o', default=[]):
+            if o:
+                ret.setdefault(o, []).append(username)
+    return ret
+
+
+async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', INSTS=ICECUBE_INSTS, dryrun=False, concurrency=16):
+    """
+    Import LDAP institution attributes and memberships into Keycloak.
+
+    LDAP users are indexed by institution once, and Keycloak is read once.
+    Only attributes that differ and memberships that are missing are written.
+
+    Args:
+        keycloak_conn: keycloak rest client
+        base_group (str): experiment group holding the institutions
+        INSTS (dict): Keycloak institutions
+        dryrun (bool): only log the changes
+        concurrency (int): max concurrent Keycloak requests
+    """
     ldap_conn = LDAP()
-    ldap_users = ldap_conn.list_users()
+    users_by_o = index_users_by_o(ldap_conn.list_users(['o']))
 
     # now handle institutions
     keycloak_insts_by_o = {}
@@ -103,6 +291,8 @@ async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', I
         else:
             logger.info(f'skipping Keycloak inst {name}')
 
+    group_attrs = {}
+    memberships = []
     inst_groups = ldap_conn.list_groups('ou=Institutions,dc=icecube,dc=wisc,dc=edu')
     for inst_cn in sorted(inst_groups, key=lambda x: inst_groups[x]['o']):
         inst = inst_groups[inst_cn]
@@ -116,40 +306,59 @@ async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', I
             inst_security_contact = get_attr_as_list(inst, 'collaboratorSecurityContact', default=[])
             inst_admin = get_attr_as_list(inst, 'institutionLeadUid', default=[])
 
-            attrs = {
+            group_attrs[keycloak_group] = {
                 'collaboratorSecurityContact': inst_security_contact,
                 'institutionLeadUid': inst_admin,
             }
-            if not dryrun:
-                logger.info(f'modify inst with attrs {attrs}')
-                await modify_group(keycloak_group, attrs, rest_client=keycloak_conn)
             for user in inst_admin:
-                logger.debug(f'adding admin user {user} to {keycloak_group}/_admin')
-                if not dryrun:
-                    await add_user_group(keycloak_group+'/_admin', user, rest_client=keycloak_conn)
+                memberships.append((keycloak_group+'/_admin', user))
             inst_full_o = f'o={inst_o},ou=Institutions,dc=icecube,dc=wisc,dc=edu'
-            for user in ldap_users:
-                if ldap_users[user].get('o', None) == inst_full_o:
-                    logger.debug(f'adding user {user} to {keycloak_group}')
-                    if not dryrun:
-                        await add_user_group(keycloak_group, user, rest_client=keycloak_conn)
+            for user in users_by_o.get(inst_full_o, []):
+                memberships.append((keycloak_group, user))
         else:
             logger.info(f'skipping LDAP inst {inst["o"]}')
 
+    paths = set(group_attrs) | {path for path, _ in memberships}
+    snapshot = await get_keycloak_snapshot(keycloak_conn, paths, concurrency=concurrency)
+
+    # only modify existing inst groups
+    for path in sorted(group_attrs):
+        if path not in snapshot['groups']:
+            logger.info(f'group "{path}" does not exist')
+            del group_attrs[path]
+    if group_attrs:
+        state = {'group_attrs': group_attrs}
+        await apply_state(state, dryrun=dryrun, concurrency=concurrency, update_attrs=True, rest_client=keycloak_conn)
+
+    adds = []
+    for path, user in dict.fromkeys(memberships):
+        if path not in snapshot['groups']:
+            logger.info(f'skipping user {user} for group {path} - group does not exist')
+        elif user not in snapshot['users']:
+            logger.info(f'skipping user {user} for group {path} - user does not exist')
+        elif user not in snapshot['members'][path]:
+            logger.debug(f'adding user {user} to {path}')
+            adds.append((path, user))
+
+    logger.info(f'{len(adds)} institution members to add')
+    if not dryrun:
+        await apply_membership_changes(snapshot, adds, [], concurrency=concurrency, keycloak_conn=keycloak_conn)
+
 
 def main():
     parser = argparse.ArgumentParser(description='IceCube Keycloak setup')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
+    parser.add_argument('--concurrency', default=16, type=int, help='max concurrent Keycloak requests')
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
     rest_client = get_rest_client()
-    asyncio.run(import_ldap_groups(rest_client, ldap_setup=False, dryrun=args.dryrun))
-    asyncio.run(import_ldap_insts(rest_client, dryrun=args.dryrun))
-    asyncio.run(import_ldap_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=ICECUBE_INSTS, dryrun=args.dryrun))
-    asyncio.run(import_ldap_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=GEN2_INSTS, dryrun=args.dryrun))
+    asyncio.run(import_ldap_groups(rest_client, ldap_setup=False, dryrun=args.dryrun, concurrency=args.concurrency))
+    asyncio.run(import_ldap_insts(rest_client, dryrun=args.dryrun, concurrency=args.concurrency))
+    asyncio.run(import_ldap_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=ICECUBE_INSTS, dryrun=args.dryrun, concurrency=args.concurrency))
+    asyncio.run(import_ldap_insts(rest_client, base_group='/institutions/IceCube-Gen2', INSTS=GEN2_INSTS, dryrun=args.dryrun, concurrency=args.concurrency))
 
 
 if __name__ == '__main__':
@@ -16,8 +16,7 @@ import sys
 
 # local imports
 from krs.bootstrap import bootstrap, get_token, user_mgmt_app
-from krs.groups import create_group
-from krs.institutions import create_inst
+from krs.state import apply_state
 from krs.token import get_rest_client
 
 from .institution_list import ICECUBE_INSTS, GEN2_INSTS
@@ -55,6 +54,7 @@ def main():
     parser.add_argument('--keycloak_realm', default='IceCube', help='Keycloak realm')
     parser.add_argument('-u', '--username', default='admin', help='Keycloak admin username')
     parser.add_argument('-p', '--password', default='admin', help='Keycloak admin password')
+    parser.add_argument('--dryrun', default=False, action='store_true', help='only print the group and institution changes')
 
     args = parser.parse_args()
 
@@ -75,23 +75,17 @@ def main():
     os.environ['KEYCLOAK_CLIENT_SECRET'] = secret
     rest_client = get_rest_client(retries=1, timeout=30)
 
-    # set up basic group structure
-    async def create_subgroups(root, values):
-        for name in values:
-            groupname = root+'/'+name
-            await create_group(groupname, rest_client=rest_client)
-            if isinstance(values, dict) and values[name]:
-                await create_subgroups(groupname, values[name])
-    asyncio.run(create_subgroups('', GROUPS))
-
-    # set up institutions
-    async def create_insts(exp, inst_list):
-        for name in inst_list:
-            attrs = {k: inst_list[name][k] for k in inst_list[name] if not k.startswith('_')}
-            await create_inst(exp, name, attrs, rest_client)
-    asyncio.run(create_insts('IceCube', ICECUBE_INSTS))
-    asyncio.run(create_insts('IceCube-Gen2', ICECUBE_INSTS))
-    asyncio.run(create_insts('IceCube-Gen2', GEN2_INSTS))
+    # set up basic group structure and institutions
+    state = {
+        'groups': GROUPS,
+        'institutions': {
+            'IceCube': ICECUBE_INSTS,
+            'IceCube-Gen2': dict(ICECUBE_INSTS, **GEN2_INSTS),
+        },
+    }
+    asyncio.run(apply_state(state, dryrun=args.dryrun, rest_client=rest_client))
+    if args.dryrun:
+        return
 
     if args.ldap_url:
         # sync ldap groups
@@ -21,13 +21,12 @@ App structure:
 Also available: a generic "public" app for public access to scopes,
 if the application scope is allowed to be public.
 """
-import os
 import asyncio
 import logging
 
 import requests
 
-from .token import get_rest_client
+from .token import get_rest_client, TokenVerifier
 from .groups import list_groups, group_info
 
 
@@ -47,10 +46,33 @@ async def list_apps(rest_client=None):
     for c in clients:
         if 'app' not in c['attributes'] or not c['attributes']['app']:
             continue
-        ret[c['clientId']] = {k: c[k] for k in c if k in ('clientId', 'defaultClientScopes', 'id', 'optionalClientScopes', 'rootUrl', 'serviceAccountsEnabled')}
+        ret[c['clientId']] = _app_info(c)
     return ret
 
 
+def _app_info(client):
+    return {k: client[k] for k in client if k in ('clientId', 'defaultClientScopes', 'id', 'optionalClientScopes', 'rootUrl', 'serviceAccountsEnabled')}
+
+
+async def _find_client(appname, required=False, rest_client=None):
+    """
+    Get the client representation of an app, in a single request.
+
+    Args:
+        appname (str): app name ("clientID")
+        required (bool): raise if the app does not exist
+
+    Returns:
+        dict: client representation, or None
+    """
+    ret = await rest_client.request('GET', f'/clients?clientId={appname}')
+    if not ret:
+        if required:
+            raise Exception(f'app "{appname}" does not exist')
+        return None
+    return ret[0]
+
+
 async def app_info(appname, rest_client=None):
     """
     Get application ("client") information.
@@ -125,132 +147,164 @@ async def create_app(appname, appurl, roles=['read', 'write'], builtin_scopes=[]
         raise Exception('bad appurl')
 
     # create app
-    try:
-        await app_info(appname, rest_client=rest_client)
-    except Exception:
-        logger.info(f'creating app "{appname}"')
+    if await _find_client(appname, rest_client=rest_client):
+        logger.info(f'app "{appname}" already exists')
+        return
+
+    logger.info(f'creating app "{appname}"')
+    args = {
+        'access': {'configure': True, 'manage': True, 'view': True},
+        'adminUrl': appurl,
+        'attributes': {
+            'app': 'true',
+            'display.on.consent.screen': 'false',
+            'exclude.session.state.from.auth.response': 'false',
+            'saml.assertion.signature': 'false',
+            'saml.authnstatement': 'false',
+            'saml.client.signature': 'false',
+            'saml.encrypt': 'false',
+            'saml.force.post.binding': 'false',
+            'saml.multivalued.roles': 'false',
+            'saml.onetimeuse.condition': 'false',
+            'saml.server.signature': 'false',
+            'saml.server.signature.keyinfo.ext': 'false',
+            'saml_force_name_id_format': 'false',
+            'tls.client.certificate.bound.access.tokens': 'false',
+        },
+        'authenticationFlowBindingOverrides': {},
+        'bearerOnly': False,
+        'clientAuthenticatorType': 'client-secret',
+        'clientId': appname,
+        'consentRequired': True,
+        'defaultClientScopes': [],
+        'directAccessGrantsEnabled': False,
+        'enabled': True,
+        'frontchannelLogout': False,
+        'fullScopeAllowed': True,
+        'implicitFlowEnabled': False,
+        'nodeReRegistrationTimeout': -1,
+        'notBefore': 0,
+        'optionalClientScopes': [],
+        'protocol': 'openid-connect',
+        'publicClient': False,
+        'redirectUris': [f'{appurl}/*'],
+        'rootUrl': appurl,
+        'serviceAccountsEnabled': service_account,
+        'standardFlowEnabled': True,
+        'surrogateAuthRequired': False,
+        'webOrigins': [appurl],
+    }
+    await rest_client.request('POST', '/clients', args)
+    client_id = (await _find_client(appname, rest_client=rest_client))['id']
+
+    async def create_roles():
+        url = f'/clients/{client_id}/roles'
+        await asyncio.gather(*(rest_client.request('POST', url, {'name': name}) for name in roles))
+
+    async def create_scope():
+        all_scopes = await list_scopes(rest_client=rest_client)
+        if appname in all_scopes:
+            return all_scopes[appname]['id']
         args = {
-            'access': {'configure': True, 'manage': True, 'view': True},
-            'adminUrl': appurl,
             'attributes': {
-                'app': 'true',
+                'app': 'app',
+                'access': access,
                 'display.on.consent.screen': 'false',
-                'exclude.session.state.from.auth.response': 'false',
-                'saml.assertion.signature': 'false',
-                'saml.authnstatement': 'false',
-                'saml.client.signature': 'false',
-                'saml.encrypt': 'false',
-                'saml.force.post.binding': 'false',
-                'saml.multivalued.roles': 'false',
-                'saml.onetimeuse.condition': 'false',
-                'saml.server.signature': 'false',
-                'saml.server.signature.keyinfo.ext': 'false',
-                'saml_force_name_id_format': 'false',
-                'tls.client.certificate.bound.access.tokens': 'false',
+                'include.in.token.scope': 'true',
             },
-            'authenticationFlowBindingOverrides': {},
-            'bearerOnly': False,
-            'clientAuthenticatorType': 'client-secret',
-            'clientId': appname,
-            'consentRequired': True,
-            'defaultClientScopes': [],
-            'directAccessGrantsEnabled': False,
-            'enabled': True,
-            'frontchannelLogout': False,
-            'fullScopeAllowed': True,
-            'implicitFlowEnabled': False,
-            'nodeReRegistrationTimeout': -1,
-            'notBefore': 0,
-            'optionalClientScopes': [],
+            'name': appname,
             'protocol': 'openid-connect',
-            'publicClient': False,
-            'redirectUris': [f'{appurl}/*'],
-            'rootUrl': appurl,
-            'serviceAccountsEnabled': service_account,
-            'standardFlowEnabled': True,
-            'surrogateAuthRequired': False,
-            'webOrigins': [appurl],
         }
-        await rest_client.request('POST', '/clients', args)
-
-        ret = await app_info(appname, rest_client=rest_client)
-        client_id = ret['id']
-
-        # create roles
-        url = f'/clients/{client_id}/roles'
-        for name in roles:
-            args = {'name': name}
-            await rest_client.request('POST', url, args)
-
-        # create scope
+        await rest_client.request('POST', '/client-scopes', args)
         all_scopes = await list_scopes(rest_client=rest_client)
-        if appname not in all_scopes:
-            args = {
-                'attributes': {
-                    'app': 'app',
-                    'access': access,
-                    'display.on.consent.screen': 'false',
-                    'include.in.token.scope': 'true',
-                },
-                'name': appname,
-                'protocol': 'openid-connect',
-            }
-            await rest_client.request('POST', '/client-scopes', args)
-            all_scopes = await list_scopes(rest_client=rest_client)
-            scope_id = all_scopes[appname]['id']
-
-            url = f'/client-scopes/{scope_id}/protocol-mappers/models'
-            args = {
-                'config': {
-                    'access.token.claim': 'true',
-                    'claim.name': f'roles.{appname}',
-                    'id.token.claim': 'false',
-                    'jsonType.label': 'String',
-                    'multivalued': 'true',
-                    'userinfo.token.claim': 'false',
-                    'usermodel.clientRoleMapping.clientId': appname,
-                },
-                'name': 'role-mapper',
-                'protocol': 'openid-connect',
-                'protocolMapper': 'oidc-usermodel-client-role-mapper'
-            }
-            await rest_client.request('POST', url, args)
-
-        # apply scope to client
         scope_id = all_scopes[appname]['id']
-        url = f'/clients/{client_id}/optional-client-scopes/{scope_id}'
-        await rest_client.request('PUT', url)
 
+        url = f'/client-scopes/{scope_id}/protocol-mappers/models'
+        args = {
+            'config': {
+                'access.token.claim': 'true',
+                'claim.name': f'roles.{appname}',
+                'id.token.claim': 'false',
+                'jsonType.label': 'String',
+                'multivalued': 'true',
+                'userinfo.token.claim': 'false',
+                'usermodel.clientRoleMapping.clientId': appname,
+            },
+            'name': 'role-mapper',
+            'protocol': 'openid-connect',
+            'protocolMapper': 'oidc-usermodel-client-role-mapper'
+        }
+        await rest_client.request('POST', url, args)
+        return scope_id
+
+    async def apply_scope(scope_id):
+        # apply scope to client, and to the "public" app and all "apps" depending on access
+        client_ids = {client_id}
         if access == 'public':
-            # apply scope to "public" app
-            ret = await app_info("public", rest_client=rest_client)
-            url = f'/clients/{ret["id"]}/optional-client-scopes/{scope_id}'
-            await rest_client.request('PUT', url)
+            client_ids.add((await _find_client('public', required=True, rest_client=rest_client))['id'])
         if access in ('public', 'apps'):
-            # apply scope to all "apps"
             ret = await list_apps(rest_client=rest_client)
-            for app in ret.values():
-                if appname not in app['optionalClientScopes']:
-                    url = f'/clients/{app["id"]}/optional-client-scopes/{scope_id}'
-                    await rest_client.request('PUT', url)
-
-        if service_account:
-            # get service account
-            url = f'/clients/{client_id}/service-account-user'
-            svc_user = await rest_client.request('GET', url)
-
-            # get service roles
-            url = f'/users/{svc_user["id"]}/role-mappings/clients/{client_id}'
-            svc_roles = await rest_client.request('GET', url)
-
-            for role in svc_roles:
-                if role['name'] == 'uma_authorization':  # delete this to prevent self-administration
-                    url = f'/users/{svc_user["id"]}/role-mappings/clients/{client_id}'
-                    await rest_client.request('DELETE', url)
-
-        logger.info(f'app "{appname}" created')
-    else:
-        logger.info(f'app "{appname}" already exists')
+            client_ids.update(app['id'] for app in ret.values() if appname not in app['optionalClientScopes'])
+        await asyncio.gather(*(rest_client.request('PUT', f'/clients/{cid}/optional-client-scopes/{scope_id}')
+                               for cid in client_ids))
+
+    async def fix_service_account():
+        # get service account
+        url = f'/clients/{client_id}/service-account-user'
+        svc_user = await rest_client.request('GET', url)
+
+        # get service roles
+        url = f'/users/{svc_user["id"]}/role-mappings/clients/{client_id}'
+        svc_roles = await rest_client.request('GET', url)
+
+        for role in svc_roles:
+            if role['name'] == 'uma_authorization':  # delete this to prevent self-administration
+                url = f'/users/{svc_user["id"]}/role-mappings/clients/{client_id}'
+                await rest_client.request('DELETE', url)
+
+    async def scope_chain():
+        await apply_scope(await create_scope())
+
+    # roles, scope, and service account only depend on the client
+    tasks = [create_roles(), scope_chain()]
+    if service_account:
+        tasks.append(fix_service_account())
+    await asyncio.gather(*tasks)
+
+    logger.info(f'app "{appname}" created')
+
+
+async def create_apps(apps, concurrency=4, rest_client=None):
+    """
+    Create many applications ("clients") in Keycloak.
+
+    Apps are created `concurrently` at a time.  Since apps created at the
+    same time cannot see each other, the app scopes are attached to all
+    apps again at the end.
+
+    Args:
+        apps (list): dicts of `create_app()` arguments
+        concurrency (int): max apps to create at once (default: 4)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(app_args):
+        async with semaphore:
+            await create_app(rest_client=rest_client, **app_args)
+    await asyncio.gather(*(create(a) for a in apps))
+
+    # attach the scopes of the new apps to apps created alongside them
+    shared = {a['appname'] for a in apps if a.get('access', 'public') in ('public', 'apps')}
+    if shared:
+        all_apps, all_scopes = await asyncio.gather(
+            list_apps(rest_client=rest_client),
+            list_scopes(rest_client=rest_client),
+        )
+        await asyncio.gather(*(
+            rest_client.request('PUT', f'/clients/{app["id"]}/optional-client-scopes/{all_scopes[name]["id"]}')
+            for app in all_apps.values() for name in shared
+            if name not in app['optionalClientScopes'] and name in all_scopes
+        ))
 
 
 async def delete_app(appname, rest_client=None):
@@ -260,42 +314,78 @@ async def delete_app(appname, rest_client=None):
     Args:
         appname (str): appname ("clientId') of application to delete
     """
-    ret = await list_scopes(rest_client=rest_client)
-    if appname in ret:
-        scope_id = ret[appname]['id']
+    scopes, apps, client, public = await asyncio.gather(
+        list_scopes(rest_client=rest_client),
+        list_apps(rest_client=rest_client),
+        _find_client(appname, rest_client=rest_client),
+        _find_client('public', rest_client=rest_client),
+    )
+
+    tasks = []
+    if appname in scopes:
+        scope_id = scopes[appname]['id']
+
         # delete scope usage in apps
-        apps = await list_apps(rest_client=rest_client)
-        for app in apps.values():
-            if appname in app['optionalClientScopes']:
-                url = f'/clients/{app["id"]}/optional-client-scopes/{scope_id}'
-                await rest_client.request('DELETE', url)
-        ret = await app_info('public', rest_client=rest_client)
-        if appname in ret['optionalClientScopes']:
-            url = f'/clients/{ret["id"]}/optional-client-scopes/{scope_id}'
-            await rest_client.request('DELETE', url)
+        if public is None:
+            raise Exception('app "public" does not exist')
+        users = [app['id'] for app in apps.values() if appname in app['optionalClientScopes']]
+        if appname in public['optionalClientScopes']:
+            users.append(public['id'])
+        await asyncio.gather(*(rest_client.request('DELETE', f'/clients/{cid}/optional-client-scopes/{scope_id}')
+                               for cid in set(users)))
 
         # delete scope
-        url = f'/client-scopes/{scope_id}'
-        await rest_client.request('DELETE', url)
+        tasks.append(rest_client.request('DELETE', f'/client-scopes/{scope_id}'))
 
-    try:
-        ret = await app_info(appname, rest_client=rest_client)
-    except Exception:
+    if client is None:
         logger.info(f'app "{appname}" does not exist')
     else:
-        client_id = ret['id']
-        url = f'/clients/{client_id}'
-        await rest_client.request('DELETE', url)
+        tasks.append(rest_client.request('DELETE', f'/clients/{client["id"]}'))
+    await asyncio.gather(*tasks)
+    if client is not None:
         logger.info(f'app "{appname}" deleted')
 
 
-async def get_app_role_mappings(appname, role=None, rest_client=None):
+async def _get_role_groups(client_id, role, max_results=100, rest_client=None):
+    """
+    Get the groups with a client role, using the role's reverse lookup.
+
+    Args:
+        client_id (str): client uuid
+        role (str): client role name
+        max_results (int): page size
+
+    Returns:
+        list: group paths
+    """
+    ret = []
+    first = 0
+    while True:
+        url = f'/clients/{client_id}/roles/{role}/groups?first={first}&max={max_results}&briefRepresentation=true'
+        groups = await rest_client.request('GET', url)
+        ret.extend(g['path'] for g in groups)
+        if len(groups) < max_results:
+            return ret
+        first += max_results
+
+
+def _in_subtree(path, group_path):
+    return (not group_path) or path == group_path or path.startswith(group_path.rstrip('/')+'/')
+
+
+async def get_app_role_mappings(appname, role=None, group_path=None, concurrency=16, rest_client=None):
     """
     Get an application's role-group mappings.
 
+    For a single role, this asks Keycloak for the groups with that role
+    directly.  Otherwise, or if Keycloak does not support that lookup, the
+    role mappings of each group are fetched, `concurrency` at a time.
+
     Args:
         appname (str): appname ("clientId") of application
         role (str): application role name (optional, default: all roles)
+        group_path (str): only look in this group and its subgroups (optional, default: all groups)
+        concurrency (int): max concurrent requests when scanning groups (default: 16)
 
     Returns:
         dict: role: list of groups
@@ -310,13 +400,28 @@ async def get_app_role_mappings(appname, role=None, rest_client=None):
 
     client_id = app_data['id']
 
-    groups_with_role = {}
+    if role:
+        try:
+            paths = await _get_role_groups(client_id, role, rest_client=rest_client)
+        except Exception:
+            logger.debug('role groups lookup failed, falling back to a scan of groups', exc_info=True)
+        else:
+            paths = sorted(p for p in paths if _in_subtree(p, group_path))
+            return {role: paths} if paths else {}
+
     groups = await list_groups(rest_client=rest_client)
-    for g in groups:
-        gid = groups[g]['id']
+    paths = [g for g in groups if _in_subtree(g, group_path)]
+    semaphore = asyncio.Semaphore(concurrency)
 
-        url = f'/groups/{gid}/role-mappings/clients/{client_id}'
-        ret = await rest_client.request('GET', url)
+    async def get_mappings(path):
+        async with semaphore:
+            url = f'/groups/{groups[path]["id"]}/role-mappings/clients/{client_id}'
+            return await rest_client.request('GET', url)
+
+    results = await asyncio.gather(*(get_mappings(g) for g in paths))
+
+    groups_with_role = {}
+    for g, ret in zip(paths, results):
         for mapping in ret:
             role_name = mapping['name']
             if (not role) or role == role_name:
@@ -409,10 +514,234 @@ async def delete_app_role_mapping(appname, role, group, rest_client=None):
         logger.info(f'app "{appname}" role mapping {role}-{group} deleted')
 
 
-def get_public_token(username, password, scopes=None, openid_url=None, client='public', secret=None, raw=False, **kwargs):
-    import jwt
-    import json
+class AppIndex:
+    """
+    In-memory index of apps, roles, scopes, and group role mappings.
 
+    `load()` reads everything once: apps, their roles, scopes, groups, and
+    the role mappings of each group (one request per group, covering all
+    apps).  Both directions of the role mappings are then answered from
+    memory:
+
+        index.groups_with_role('myapp', 'read')  # -> ['/groupA', '/groupB']
+        index.group_roles('/groupA')             # -> {'myapp': ['read']}
+
+    Admin events passed to `handle_event()` refresh only what they touched.
+    To keep the index current, start its listener alongside `load()`:
+
+        await index.load()
+        await index.listener().start()
+
+    Args:
+        rest_client: keycloak rest client
+        concurrency (int): max concurrent requests while loading (default: 16)
+    """
+    def __init__(self, rest_client=None, concurrency=16):
+        self.rest_client = rest_client
+        self.concurrency = concurrency
+        self.apps = {}
+        self.scopes = {}
+        self.groups = {}
+        self._app_names = {}
+        self._group_paths = {}
+        self._mappings = {}
+        self._reverse = {}
+
+    async def _gather(self, fn, items):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(item):
+            async with semaphore:
+                return await fn(item)
+        return await asyncio.gather(*(run(i) for i in items))
+
+    async def load(self):
+        """Load the whole index."""
+        await asyncio.gather(self.refresh_apps(), self.refresh_groups(mappings=False))
+        await self._gather(self.refresh_group_mappings, list(self._group_paths))
+
+    async def refresh_apps(self):
+        """Reload apps, their roles, and scopes."""
+        apps, self.scopes = await asyncio.gather(
+            list_apps(rest_client=self.rest_client),
+            list_scopes(rest_client=self.rest_client),
+        )
+
+        async def get_roles(appname):
+            ret = await self.rest_client.request('GET', f'/clients/{apps[appname]["id"]}/roles')
+            return [r['name'] for r in ret]
+        names = list(apps)
+        for appname, roles in zip(names, await self._gather(get_roles, names)):
+            apps[appname]['roles'] = roles
+
+        # drop mappings to deleted apps and roles
+        for gid, mappings in list(self._mappings.items()):
+            pruned = {a: r & set(apps[a]['roles']) for a, r in mappings.items() if a in apps}
+            if pruned != mappings:
+                self._set_mappings(gid, pruned)
+        self.apps = apps
+        self._app_names = {a['id']: name for name, a in apps.items()}
+
+    async def refresh_app(self, client_id):
+        """Reload a single app and its roles, by client id."""
+        client, roles = await asyncio.gather(
+            self.rest_client.request('GET', f'/clients/{client_id}'),
+            self.rest_client.request('GET', f'/clients/{client_id}/roles'),
+        )
+        if not client or not client.get('attributes', {}).get('app'):
+            self._drop_app(client_id)
+            return
+        appname = client['clientId']
+        old_name = self._app_names.get(client_id)
+        if old_name and old_name != appname:
+            self._drop_app(client_id)
+        app = _app_info(client)
+        app['roles'] = [r['name'] for r in roles]
+        self.apps[appname] = app
+        self._app_names[client_id] = appname
+
+        # drop mappings to deleted roles
+        for gid, mappings in list(self._mappings.items()):
+            if appname in mappings and not mappings[appname] <= set(app['roles']):
+                self._set_mappings(gid, dict(mappings, **{appname: mappings[appname] & set(app['roles'])}))
+
+    def _drop_app(self, client_id):
+        appname = self._app_names.pop(client_id, None)
+        if appname:
+            self.apps.pop(appname, None)
+            self.scopes.pop(appname, None)
+            for gid, mappings in list(self._mappings.items()):
+                if appname in mappings:
+                    self._set_mappings(gid, {a: r for a, r in mappings.items() if a != appname})
+
+    async def refresh_scope(self, scope_id):
+        """Reload a single app scope, by scope id."""
+        scope = await self.rest_client.request('GET', f'/client-scopes/{scope_id}')
+        self._drop_scope(scope_id)
+        if scope and scope.get('protocol') == 'openid-connect' and 'app' in scope.get('attributes', {}):
+            self.scopes[scope['name']] = {k: scope[k] for k in scope if k in ('id', 'name', 'attributes')}
+
+    def _drop_scope(self, scope_id):
+        for name in [n for n, s in self.scopes.items() if s['id'] == scope_id]:
+            del self.scopes[name]
+
+    async def refresh_groups(self, mappings=True):
+        """Reload the group tree, and the mappings of any new groups."""
+        groups = await list_groups(rest_client=self.rest_client)
+        self.groups = {path: g['id'] for path, g in groups.items()}
+        paths = {g['id']: path for path, g in groups.items()}
+        for gid in set(self._mappings) - set(paths):
+            self._set_mappings(gid, {})
+            del self._mappings[gid]
+        new_groups = set(paths) - set(self._group_paths)
+        self._group_paths = paths
+        if mappings and new_groups:
+            await self._gather(self.refresh_group_mappings, list(new_groups))
+
+    async def refresh_group_mappings(self, gid):
+        """Reload the client role mappings of a group."""
+        ret = await self.rest_client.request('GET', f'/groups/{gid}/role-mappings')
+        mappings = {}
+        for client in ret.get('clientMappings', {}).values():
+            appname = self._app_names.get(client['id'])
+            if appname:
+                mappings[appname] = {r['name'] for r in client['mappings']}
+        self._set_mappings(gid, mappings)
+
+    def _set_mappings(self, gid, mappings):
+        old = self._mappings.get(gid, {})
+        for appname, roles in old.items():
+            for role in roles:
+                self._reverse.get((appname, role), set()).discard(gid)
+        for appname, roles in mappings.items():
+            for role in roles:
+                self._reverse.setdefault((appname, role), set()).add(gid)
+        self._mappings[gid] = mappings
+
+    def app(self, appname):
+        """
+        Get app info, like `app_info()` without the secret.
+
+        Returns:
+            dict: app info, or None if it does not exist
+        """
+        return self.apps.get(appname)
+
+    def groups_with_role(self, appname, role):
+        """
+        Get the groups with an app role.
+
+        Returns:
+            list: group paths
+        """
+        return sorted(self._group_paths[gid] for gid in self._reverse.get((appname, role), ()))
+
+    def group_roles(self, group_path):
+        """
+        Get the app roles granted by a group.
+
+        Returns:
+            dict: appname: list of roles
+        """
+        gid = self.groups.get(group_path)
+        return {a: sorted(r) for a, r in self._mappings.get(gid, {}).items() if r}
+
+    def listener(self, address=None, exchange=None, routing_key='KK.EVENT.ADMIN.#'):
+        """
+        Get a RabbitMQ listener that passes admin events to `handle_event()`.
+
+        Args:
+            address (str): (optional) RabbitMQ address, including user/pass
+            exchange (str): (optional) RabbitMQ exchange name
+            routing_key (str): routing key pattern (default: all admin events)
+
+        Returns:
+            RabbitMQListener: listener, not yet started
+        """
+        from .rabbitmq import RabbitMQListener
+        return RabbitMQListener(self.handle_event, address=address, exchange=exchange,
+                                routing_key=routing_key, with_routing_key=True)
+
+    async def handle_event(self, message, routing_key=None):
+        """
+        Refresh the index from a Keycloak admin event.
+
+        Client, role, and scope events only reload the client or scope in
+        their resource path.  Paths that do not name one (like role
+        changes through `roles-by-id`) reload all apps.
+
+        Args:
+            message (dict): admin event
+            routing_key (str): (optional) RabbitMQ routing key of the event
+        """
+        resource_type = message.get('resourceType')
+        if not resource_type and routing_key:
+            resource_type = routing_key.split('.')[-2]
+        path = message.get('resourcePath', '').split('/')
+
+        if resource_type == 'CLIENT_ROLE_MAPPING':
+            if path[0] == 'groups' and len(path) > 1:
+                await self.refresh_group_mappings(path[1])
+        elif resource_type in ('CLIENT', 'CLIENT_ROLE') and path[0] == 'clients' and len(path) > 1:
+            if resource_type == 'CLIENT' and message.get('operationType') == 'DELETE' and len(path) == 2:
+                self._drop_app(path[1])
+            else:
+                await self.refresh_app(path[1])
+        elif resource_type == 'CLIENT_SCOPE' and path[0] == 'client-scopes' and len(path) == 2:
+            if message.get('operationType') == 'DELETE':
+                self._drop_scope(path[1])
+            else:
+                await self.refresh_scope(path[1])
+        elif resource_type in ('CLIENT', 'CLIENT_ROLE', 'CLIENT_SCOPE'):
+            await self.refresh_apps()
+        elif resource_type == 'GROUP':
+            await self.refresh_groups()
+
+
+_verifiers = {}
+
+
+def get_public_token(username, password, scopes=None, openid_url=None, client='public', secret=None, raw=False, **kwargs):
     if not scopes:
         scopes = []
 
@@ -421,26 +750,11 @@ def get_public_token(username, password, scopes=None, openid_url=None, client='p
         import getpass
         password = getpass.getpass()
 
-    # discovery
-    r = requests.get(os.path.join(openid_url, '.well-known/openid-configuration'))
-    r.raise_for_status()
-    provider_info = r.json()
-
-    # get keys
-    r = requests.get(provider_info['jwks_uri'])
-    r.raise_for_status()
-    public_keys = {}
-    for jwk in r.json()['keys']:
-        kid = jwk['kid']
-        public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
-
-    def decode(encoded):
-        header = jwt.get_unverified_header(encoded)
-        if header['kid'] in public_keys:
-            key = public_keys[header['kid']]
-            return jwt.decode(encoded, key, algorithms=['RS256', 'RS512'], options={'verify_aud': False})
-        else:
-            raise Exception('key not found')
+    # discovery and keys are cached between calls
+    if openid_url not in _verifiers:
+        _verifiers[openid_url] = TokenVerifier(openid_url)
+    verifier = _verifiers[openid_url]
+    provider_info = verifier.provider_info()
 
     # actually get an access token
     data = {
@@ -467,7 +781,7 @@ def get_public_token(username, password, scopes=None, openid_url=None, client='p
     if raw:
         return tokens['access_token']
     else:
-        return decode(tokens['access_token'])
+        return verifier.verify(tokens['access_token'])
 
 
 def main():
@@ -490,12 +804,18 @@ def main():
     parser_create.add_argument('appname', help='application name')
     parser_create.add_argument('appurl', help='app base url')
     parser_create.set_defaults(func=create_app)
+    parser_create_apps = subparsers.add_parser('create_apps', help='create many apps from a JSON list of create arguments')
+    parser_create_apps.add_argument('apps', help='JSON file, like [{"appname": "myapp", "appurl": "https://myapp"}]')
+    parser_create_apps.add_argument('--concurrency', type=int, default=4, help='max apps to create at once')
+    parser_create_apps.set_defaults(func=create_apps)
     parser_delete = subparsers.add_parser('delete', help='delete an app')
     parser_delete.add_argument('appname', help='application name')
     parser_delete.set_defaults(func=delete_app)
     parser_get_role_mappings = subparsers.add_parser('get_role_mappings', help='get app role-group mappings')
     parser_get_role_mappings.add_argument('appname', help='application name')
     parser_get_role_mappings.add_argument('-r', '--role', help='role name')
+    parser_get_role_mappings.add_argument('--group-path', help='only look in this group subtree')
+    parser_get_role_mappings.add_argument('--concurrency', type=int, default=16, help='max concurrent requests when scanning groups')
     parser_get_role_mappings.set_defaults(func=get_app_role_mappings)
     parser_add_role_mapping = subparsers.add_parser('add_role_mapping', help='add an app role-group mapping')
     parser_add_role_mapping.add_argument('appname', help='application name')
@@ -529,6 +849,10 @@ def main():
         args['openid_url'] = f'{config["KEYCLOAK_URL"]}/auth/realms/{config["KEYCLOAK_REALM"]}'
         ret = func(**args)
     else:
+        if func == create_apps:
+            import json
+            with open(args['apps']) as f:
+                args['apps'] = json.load(f)
         ret = asyncio.run(func(rest_client=rest_client, **args))
     if ret is not None:
         pprint(ret)
@@ -1,27 +1,139 @@
 """
 Bootstrap a Keycloak instance with an admin role account for REST access.
+
+`bootstrap()` runs the steps one after another.  `bootstrap_async()`
+reads the current state first, then creates only the missing pieces,
+running independent steps concurrently over a single HTTP session.
 """
+import asyncio
 import time
 import requests
 
 from wipac_dev_tools import from_environment
+from rest_tools.client import RestClient
+
+
+#: master realm roles given to the service account
+SERVICE_ROLES = ('create-client', 'manage-clients', 'manage-users', 'query-clients', 'view-clients', 'view-users', 'view-realm')
+
+
+def _service_client_args(client_id):
+    return {
+        'authorizationServicesEnabled': False,
+        'clientId': client_id,
+        'consentRequired': False,
+        'defaultClientScopes': ['web-origins', 'roles'],
+        'directAccessGrantsEnabled': True,
+        'enabled': True,
+        'fullScopeAllowed': True,
+        'implicitFlowEnabled': False,
+        'optionalClientScopes': ['offline_access', 'microprofile-jwt'],
+        'serviceAccountsEnabled': True,
+        'standardFlowEnabled': False,
+    }
+
+
+def _public_app_args():
+    appname = 'public'
+    appurl = ''
+    return {
+        'access': {'configure': True, 'manage': True, 'view': True},
+        'adminUrl': appurl,
+        'attributes': {
+            'display.on.consent.screen': 'false',
+            'exclude.session.state.from.auth.response': 'false',
+            'saml.assertion.signature': 'false',
+            'saml.authnstatement': 'false',
+            'saml.client.signature': 'false',
+            'saml.encrypt': 'false',
+            'saml.force.post.binding': 'false',
+            'saml.multivalued.roles': 'false',
+            'saml.onetimeuse.condition': 'false',
+            'saml.server.signature': 'false',
+            'saml.server.signature.keyinfo.ext': 'false',
+            'saml_force_name_id_format': 'false',
+            'tls.client.certificate.bound.access.tokens': 'false',
+        },
+        'authenticationFlowBindingOverrides': {},
+        'bearerOnly': False,
+        'clientAuthenticatorType': 'client-secret',
+        'clientId': appname,
+        'consentRequired': False,
+        'defaultClientScopes': [],
+        'directAccessGrantsEnabled': True,
+        'enabled': True,
+        'frontchannelLogout': False,
+        'fullScopeAllowed': True,
+        'implicitFlowEnabled': False,
+        'nodeReRegistrationTimeout': -1,
+        'notBefore': 0,
+        'optionalClientScopes': ['profile'],
+        'protocol': 'openid-connect',
+        'publicClient': True,
+        'redirectUris': [f'{appurl}/*'],
+        'serviceAccountsEnabled': False,
+        'standardFlowEnabled': False,
+        'surrogateAuthRequired': False,
+        'webOrigins': [],
+    }
+
+
+def _backoff(initial_delay, max_delay):
+    delay = initial_delay
+    while True:
+        yield delay
+        delay = min(delay * 2, max_delay)
+
+
+def _probe(url, timeout=5):
+    try:
+        r = requests.get(url, timeout=timeout)
+        r.raise_for_status()
+    except requests.exceptions.RequestException:
+        return False
+    return True
 
 
-def wait_for_keycloak(timeout=300):
+def wait_for_keycloak(timeout=300, initial_delay=.1, max_delay=5):
+    """
+    Wait until Keycloak serves the master realm.
+
+    Polls with exponential backoff, from `initial_delay` up to `max_delay` seconds.
+
+    Args:
+        timeout (float): seconds to wait in total
+        initial_delay (float): first delay between polls
+        max_delay (float): max delay between polls
+    """
     cfg = from_environment({
         'KEYCLOAK_URL': None,
     })
 
-    url = f'{cfg["KEYCLOAK_URL"]}/auth/'
-    for _ in range(timeout):
-        try:
-            r = requests.get(url)
-            r.raise_for_status()
-            break
-        except requests.exceptions.RequestException:
-            time.sleep(1)
-    else:
-        raise Exception('Keycloak did not start')
+    url = f'{cfg["KEYCLOAK_URL"]}/auth/realms/master'
+    deadline = time.monotonic() + timeout
+    for delay in _backoff(initial_delay, max_delay):
+        if _probe(url):
+            return
+        if time.monotonic() + delay > deadline:
+            raise Exception('Keycloak did not start')
+        time.sleep(delay)
+
+
+async def wait_for_keycloak_async(timeout=300, initial_delay=.1, max_delay=5):
+    """Async version of `wait_for_keycloak()`."""
+    cfg = from_environment({
+        'KEYCLOAK_URL': None,
+    })
+
+    url = f'{cfg["KEYCLOAK_URL"]}/auth/realms/master'
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+    for delay in _backoff(initial_delay, max_delay):
+        if await loop.run_in_executor(None, _probe, url):
+            return
+        if time.monotonic() + delay > deadline:
+            raise Exception('Keycloak did not start')
+        await asyncio.sleep(delay)
 
 
 def get_token():
@@ -105,19 +217,7 @@ def create_service_role(client_id, realm=None, token=None):
     if not any(c['clientId'] == client_id for c in clients):
         print(f'creating client "{client_id}"')
         url = f'{cfg["KEYCLOAK_URL"]}/auth/admin/realms/master/clients'
-        args = {
-            'authorizationServicesEnabled': False,
-            'clientId': client_id,
-            'consentRequired': False,
-            'defaultClientScopes': ['web-origins', 'roles'],
-            'directAccessGrantsEnabled': True,
-            'enabled': True,
-            'fullScopeAllowed': True,
-            'implicitFlowEnabled': False,
-            'optionalClientScopes': ['offline_access', 'microprofile-jwt'],
-            'serviceAccountsEnabled': True,
-            'standardFlowEnabled': False,
-        }
+        args = _service_client_args(client_id)
         r = requests.post(url, json=args,
                           headers={'Authorization': f'bearer {token}'})
         try:
@@ -156,7 +256,7 @@ def create_service_role(client_id, realm=None, token=None):
 
     client_roles = []
     for r in roles:
-        if r['name'] in ('create-client', 'manage-clients', 'manage-users', 'query-clients', 'view-clients', 'view-users', 'view-realm'):
+        if r['name'] in SERVICE_ROLES:
             client_roles.append(r)
 
     if client_roles:
@@ -212,7 +312,6 @@ def create_public_app(realm=None, token=None):
     })
 
     appname = 'public'
-    appurl = ''
 
     url = f'{cfg["KEYCLOAK_URL"]}/auth/admin/realms/{realm}/clients?clientId={appname}'
     r = requests.get(url, headers={'Authorization': f'bearer {token}'})
@@ -223,46 +322,7 @@ def create_public_app(realm=None, token=None):
         print('public app already exists')
     else:
         url = f'{cfg["KEYCLOAK_URL"]}/auth/admin/realms/{realm}/clients'
-        args = {
-            'access': {'configure': True, 'manage': True, 'view': True},
-            'adminUrl': appurl,
-            'attributes': {
-                'display.on.consent.screen': 'false',
-                'exclude.session.state.from.auth.response': 'false',
-                'saml.assertion.signature': 'false',
-                'saml.authnstatement': 'false',
-                'saml.client.signature': 'false',
-                'saml.encrypt': 'false',
-                'saml.force.post.binding': 'false',
-                'saml.multivalued.roles': 'false',
-                'saml.onetimeuse.condition': 'false',
-                'saml.server.signature': 'false',
-                'saml.server.signature.keyinfo.ext': 'false',
-                'saml_force_name_id_format': 'false',
-                'tls.client.certificate.bound.access.tokens': 'false',
-            },
-            'authenticationFlowBindingOverrides': {},
-            'bearerOnly': False,
-            'clientAuthenticatorType': 'client-secret',
-            'clientId': appname,
-            'consentRequired': False,
-            'defaultClientScopes': [],
-            'directAccessGrantsEnabled': True,
-            'enabled': True,
-            'frontchannelLogout': False,
-            'fullScopeAllowed': True,
-            'implicitFlowEnabled': False,
-            'nodeReRegistrationTimeout': -1,
-            'notBefore': 0,
-            'optionalClientScopes': ['profile'],
-            'protocol': 'openid-connect',
-            'publicClient': True,
-            'redirectUris': [f'{appurl}/*'],
-            'serviceAccountsEnabled': False,
-            'standardFlowEnabled': False,
-            'surrogateAuthRequired': False,
-            'webOrigins': [],
-        }
+        args = _public_app_args()
         r = requests.post(url, json=args, headers={'Authorization': f'bearer {token}'})
         r.raise_for_status()
         print('public app created')
@@ -450,5 +510,111 @@ def bootstrap():
     return client_secret
 
 
+async def _ensure_realm(rest_client, realm):
+    realms = await rest_client.request('GET', '')
+    if any(r['realm'] == realm for r in realms):
+        print(f'realm "{realm}" already exists')
+        return
+    print(f'creating realm "{realm}"')
+    await rest_client.request('POST', '', {'realm': realm, 'enabled': True})
+    print(f'realm "{realm}" created')
+
+
+async def _ensure_public_app(rest_client, realm):
+    ret = await rest_client.request('GET', f'/{realm}/clients?clientId=public')
+    if ret:
+        print('public app already exists')
+        return
+    await rest_client.request('POST', f'/{realm}/clients', _public_app_args())
+    print('public app created')
+
+
+async def _ensure_service_role(rest_client, realm, client_id):
+    async def get_client(name):
+        ret = await rest_client.request('GET', f'/master/clients?clientId={name}')
+        return ret[0] if ret else None
+
+    realm_client, client = await asyncio.gather(get_client(f'{realm}-realm'), get_client(client_id))
+    if not realm_client:
+        raise Exception(f'realm {realm} not created yet')
+
+    if client:
+        print(f'client "{client_id}" already exists')
+    else:
+        print(f'creating client "{client_id}"')
+        await rest_client.request('POST', '/master/clients', _service_client_args(client_id))
+        client = await get_client(client_id)
+        if not client:
+            raise Exception(f'failed to create client {client_id}')
+        print(f'created client "{client_id}"')
+    kc_id = client['id']
+
+    async def add_roles():
+        svc_user = await rest_client.request('GET', f'/master/clients/{kc_id}/service-account-user')
+        url = f'/master/users/{svc_user["id"]}/role-mappings/clients/{realm_client["id"]}'
+        roles = await rest_client.request('GET', f'{url}/available')
+        client_roles = [r for r in roles if r['name'] in SERVICE_ROLES]
+        if client_roles:
+            print('service account roles to add:', client_roles)
+            await rest_client.request('POST', url, client_roles)
+
+    async def get_secret():
+        ret = await rest_client.request('GET', f'/master/clients/{kc_id}/client-secret')
+        if 'value' not in ret:
+            ret = await rest_client.request('POST', f'/master/clients/{kc_id}/client-secret')
+        return ret['value']
+
+    _, secret = await asyncio.gather(add_roles(), get_secret())
+    return secret
+
+
+async def bootstrap_async(rest_client=None):
+    """
+    Bootstrap Keycloak, creating only what is missing.
+
+    The realm is made first.  The public app and the service account
+    client, with its roles and secret, are then set up concurrently.
+
+    Args:
+        rest_client: (optional) rest client for `/auth/admin/realms`
+            (default: one made with an admin token)
+
+    Returns:
+        str: service account client secret
+    """
+    cfg = from_environment({
+        'KEYCLOAK_URL': None,
+        'KEYCLOAK_REALM': None,
+        'KEYCLOAK_CLIENT_ID': 'rest-access',
+    })
+
+    if rest_client is None:
+        await wait_for_keycloak_async()
+
+        loop = asyncio.get_running_loop()
+        for delay in _backoff(.5, 5):
+            try:
+                token = await loop.run_in_executor(None, get_token)
+            except requests.exceptions.HTTPError:
+                if delay >= 5:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                break
+        rest_client = RestClient(f'{cfg["KEYCLOAK_URL"]}/auth/admin/realms', token=token, retries=2)
+
+    print('Keycloak token obtained, setting up...')
+
+    await _ensure_realm(rest_client, cfg['KEYCLOAK_REALM'])
+    _, client_secret = await asyncio.gather(
+        _ensure_public_app(rest_client, cfg['KEYCLOAK_REALM']),
+        _ensure_service_role(rest_client, cfg['KEYCLOAK_REALM'], cfg['KEYCLOAK_CLIENT_ID']),
+    )
+
+    print(f'\nclient_id={cfg["KEYCLOAK_CLIENT_ID"]}')
+    print(f'client_secret={client_secret}')
+    return client_secret
+
+
 if __name__ == '__main__':
-    bootstrap()
+    asyncio.run(bootstrap_async())
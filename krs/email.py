@@ -1,12 +1,33 @@
 """Utilities for sending email."""
 
+import asyncio
+import base64
+from collections import namedtuple
+import concurrent.futures
+from contextlib import closing
+from datetime import date
+import json
+import logging
+import queue
+import secrets
 import smtplib
+import sqlite3
+import string
+import threading
+import time
 from email.message import EmailMessage
 from email.headerregistry import Address
-from email.utils import localtime
+from email.parser import BytesHeaderParser
+from email.policy import SMTP, default as default_policy
+from email.utils import format_datetime, formataddr, getaddresses, localtime
 
 from wipac_dev_tools import from_environment
 
+from .ratelimit import TokenBucket
+
+
+logger = logging.getLogger('krs.email')
+
 
 TEMPLATE = """{}
 
@@ -53,25 +74,19 @@ HTML_TEMPLATE = """
 """
 
 
-def send_email(recipient, subject, content, sender=None):
+def _build_message(recipient, subject, content, sender):
     """
-    Send an email message.
+    Build an email message with plain text and HTML alternatives.
 
     Args:
         recipient (dict): Dict with name and email, or just a string email address
         subject (str): Email subject
         content (str): Email content
-        sender (dict): (optional) Dict with name and email, or just a string email address
-    """
-    config = from_environment({
-        'EMAIL_SENDER': 'no-reply@icecube.wisc.edu',
-        'EMAIL_SMTP_SERVER': 'localhost',
-        'EMAIL_SMTP_TIMEOUT': 5,  # email should be mostly instant
-    })
-
-    if not sender:
-        sender = config['EMAIL_SENDER']
+        sender (dict): Dict with name and email, or just a string email address
 
+    Returns:
+        EmailMessage: the message
+    """
     msg = EmailMessage()
     msg['Subject'] = subject
     msg['Date'] = localtime()
@@ -91,6 +106,574 @@ def send_email(recipient, subject, content, sender=None):
     msg.set_content(TEMPLATE.format(content))
     msg.add_alternative(HTML_TEMPLATE.format(content.replace('\n', '<br>')),
                         subtype='html')
+    return msg
+
+
+def build_email(recipient, subject, content, sender=None):
+    """
+    Build an email message, for sending later with a `Mailer`.
+
+    Args:
+        recipient (dict): Dict with name and email, or just a string email address
+        subject (str): Email subject
+        content (str): Email content
+        sender (dict): (optional) Dict with name and email, or just a string email address
+
+    Returns:
+        EmailMessage: the message
+    """
+    if not sender:
+        config = from_environment({
+            'EMAIL_SENDER': 'no-reply@icecube.wisc.edu',
+        })
+        sender = config['EMAIL_SENDER']
+    return _build_message(recipient, subject, content, sender)
+
+
+def send_email(recipient, subject, content, sender=None):
+    """
+    Send an email message.
+
+    Args:
+        recipient (dict): Dict with name and email, or just a string email address
+        subject (str): Email subject
+        content (str): Email content
+        sender (dict): (optional) Dict with name and email, or just a string email address
+    """
+    config = from_environment({
+        'EMAIL_SENDER': 'no-reply@icecube.wisc.edu',
+        'EMAIL_SMTP_SERVER': 'localhost',
+        'EMAIL_SMTP_TIMEOUT': 5,  # email should be mostly instant
+    })
+
+    if not sender:
+        sender = config['EMAIL_SENDER']
+
+    msg = _build_message(recipient, subject, content, sender)
 
     with smtplib.SMTP(config['EMAIL_SMTP_SERVER'], timeout=config['EMAIL_SMTP_TIMEOUT']) as s:
         s.send_message(msg)
+
+
+#: A rendered message, ready to hand to `smtplib.SMTP.sendmail`
+RawEmail = namedtuple('RawEmail', ['sender', 'recipients', 'data'])
+
+
+class EmailTemplate:
+    """
+    Pre-rendered email for bulk jobs where only a few fields vary.
+
+    `content` is a `str.format` template.  The page templates, the
+    literal parts of the content, and all static MIME headers are
+    rendered once, so `render()` only has to format the fields and
+    encode the two bodies.
+
+    Args:
+        subject (str): Email subject
+        content (str): Email content, with `str.format` fields
+        sender (dict): (optional) Dict with name and email, or just a string email address
+    """
+    _formatter = string.Formatter()
+
+    def __init__(self, subject, content, sender=None):
+        if not sender:
+            config = from_environment({
+                'EMAIL_SENDER': 'no-reply@icecube.wisc.edu',
+            })
+            sender = config['EMAIL_SENDER']
+
+        self._parts = list(self._formatter.parse(content))
+        self._html_literals = [literal.replace('\n', '<br>') for literal, *_ in self._parts]
+
+        sentinel = '\0'
+        self._text_prefix, self._text_suffix = TEMPLATE.format(sentinel).split(sentinel)
+        self._html_prefix, self._html_suffix = HTML_TEMPLATE.format(sentinel).split(sentinel)
+
+        msg = EmailMessage(policy=SMTP)
+        msg['Subject'] = subject
+        if isinstance(sender, dict):
+            username, domain = sender['email'].split('@')
+            msg['From'] = Address(sender['name'], username, domain)
+            self.sender = sender['email']
+        else:
+            msg['From'] = sender
+            self.sender = sender
+        headers = b''.join(SMTP.fold_binary(k, v) for k, v in msg.items())
+
+        boundary = '===============' + secrets.token_hex(16) + '=='
+        self._headers = headers
+        self._mime_header = (
+            'MIME-Version: 1.0\r\n'
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+            '\r\n'
+            f'--{boundary}\r\n'
+            'Content-Type: text/plain; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            '\r\n'
+        ).encode()
+        self._mime_middle = (
+            f'--{boundary}\r\n'
+            'Content-Type: text/html; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            '\r\n'
+        ).encode()
+        self._mime_footer = f'--{boundary}--\r\n'.encode()
+
+    def _format_fields(self, fields):
+        ret = []
+        for _, field_name, format_spec, conversion in self._parts:
+            if field_name is None:
+                ret.append(None)
+                continue
+            obj, _ = self._formatter.get_field(field_name, (), fields)
+            obj = self._formatter.convert_field(obj, conversion)
+            ret.append(self._formatter.format_field(obj, format_spec))
+        return ret
+
+    def render_content(self, fields=None):
+        """
+        Render the text and html bodies.
+
+        Args:
+            fields (dict): values for the content template fields
+
+        Returns:
+            tuple: (text, html)
+        """
+        values = self._format_fields(fields if fields else {})
+        text = [self._text_prefix]
+        html = [self._html_prefix]
+        for (literal, *_), html_literal, value in zip(self._parts, self._html_literals, values):
+            text.append(literal)
+            html.append(html_literal)
+            if value is not None:
+                text.append(value)
+                html.append(value.replace('\n', '<br>'))
+        text.append(self._text_suffix)
+        html.append(self._html_suffix)
+        return ''.join(text), ''.join(html)
+
+    def render(self, recipient, fields=None, date=None):
+        """
+        Render a message for one recipient.
+
+        Args:
+            recipient (dict): Dict with name and email, or just a string email address
+            fields (dict): values for the content template fields
+            date (str): (optional) pre-formatted Date header, to share across a batch
+
+        Returns:
+            RawEmail: the message, ready to send
+        """
+        if isinstance(recipient, dict):
+            addr = recipient['email']
+            to = formataddr((recipient['name'], addr), charset='utf-8')
+        else:
+            addr = to = recipient
+        if not date:
+            date = format_datetime(localtime())
+
+        text, html = self.render_content(fields)
+        data = b''.join((
+            self._headers,
+            f'To: {to}\r\nDate: {date}\r\n'.encode(),
+            self._mime_header,
+            base64.encodebytes(text.encode()).replace(b'\n', b'\r\n'),
+            self._mime_middle,
+            base64.encodebytes(html.encode()).replace(b'\n', b'\r\n'),
+            self._mime_footer,
+        ))
+        return RawEmail(self.sender, [addr], data)
+
+
+def _is_connection_error(e):
+    """Is this an error after which the SMTP connection cannot be reused?"""
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code == 421  # service shutting down the connection
+    # SMTPException is an OSError, so only plain socket errors are left
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+
+class Mailer:
+    """
+    Send email over persistent SMTP connections.
+
+    Connections are opened on first use, kept open between messages,
+    and reopened once if a send fails on a dropped connection.  Bulk
+    sends spread messages across up to `connections` sessions.
+
+    The `async_*` methods run the blocking SMTP calls in a thread pool.
+
+    Args:
+        server (str): SMTP server (default: $EMAIL_SMTP_SERVER)
+        timeout (float): SMTP timeout (default: $EMAIL_SMTP_TIMEOUT)
+        connections (int): max number of concurrent SMTP connections
+    """
+    def __init__(self, server=None, timeout=None, connections=4):
+        config = from_environment({
+            'EMAIL_SMTP_SERVER': 'localhost',
+            'EMAIL_SMTP_TIMEOUT': 5,
+        })
+        assert connections > 0
+        self.server = server if server else config['EMAIL_SMTP_SERVER']
+        self.timeout = timeout if timeout else config['EMAIL_SMTP_TIMEOUT']
+        self.connections = connections
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(connections)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
+
+    def _connect(self):
+        logger.debug(f'opening SMTP connection to {self.server}')
+        return smtplib.SMTP(self.server, timeout=self.timeout)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _checkin(self, conn):
+        if conn is not None:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def _send_on(self, conn, msg):
+        """
+        Send a message, (re)connecting once if the connection fails.
+
+        Returns:
+            tuple: (connection to keep using or None, exception or None)
+        """
+        error = None
+        for _ in range(2):
+            try:
+                if conn is None:
+                    conn = self._connect()
+                if isinstance(msg, RawEmail):
+                    conn.sendmail(*msg)
+                else:
+                    conn.send_message(msg)
+                return conn, None
+            except Exception as e:
+                if not _is_connection_error(e):
+                    return conn, e
+                logger.debug('SMTP connection failed', exc_info=True)
+                if conn is not None:
+                    self._close(conn)
+                conn = None
+                error = e
+        return None, error
+
+    def send(self, msg):
+        """
+        Send a single message.
+
+        Args:
+            msg (EmailMessage|RawEmail): the message
+        """
+        conn = self._checkout()
+        try:
+            conn, error = self._send_on(conn, msg)
+        finally:
+            self._checkin(conn)
+        if error:
+            raise error
+
+    def _send_worker(self, work, results):
+        conn = self._checkout()
+        try:
+            while True:
+                try:
+                    i, msg = work.get_nowait()
+                except queue.Empty:
+                    break
+                conn, results[i] = self._send_on(conn, msg)
+        finally:
+            self._checkin(conn)
+
+    def _bulk_work(self, messages):
+        work = queue.Queue()
+        for i, msg in enumerate(messages):
+            work.put((i, msg))
+        return work, [None]*len(messages), min(self.connections, len(messages))
+
+    def send_bulk(self, messages):
+        """
+        Send many messages, reusing a few SMTP sessions.
+
+        Args:
+            messages (list): EmailMessage or RawEmail objects
+
+        Returns:
+            list: for each message, None on success or the exception raised
+        """
+        work, results, workers = self._bulk_work(messages)
+        futures = [self._executor.submit(self._send_worker, work, results) for _ in range(workers)]
+        for f in futures:
+            f.result()
+        return results
+
+    async def async_send(self, msg):
+        """Async version of `send`."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.send, msg)
+
+    async def async_send_bulk(self, messages):
+        """Async version of `send_bulk`."""
+        loop = asyncio.get_running_loop()
+        work, results, workers = self._bulk_work(messages)
+        await asyncio.gather(*(loop.run_in_executor(self._executor, self._send_worker, work, results)
+                               for _ in range(workers)))
+        return results
+
+
+def _is_permanent_error(e):
+    """Will retrying this send never succeed?"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code >= 500
+    return False
+
+
+def _to_raw(msg):
+    """Convert an EmailMessage to a RawEmail."""
+    if isinstance(msg, RawEmail):
+        return msg
+    sender = getaddresses([str(msg['From'])])[0][1]
+    recipients = [addr for _, addr in getaddresses([str(v) for v in msg.get_all('To', [])])]
+    return RawEmail(sender, recipients, msg.as_bytes(policy=SMTP))
+
+
+MIN_BACKOFF = 1
+
+
+class Outbox:
+    """
+    On-disk email spool, backed by SQLite.
+
+    Jobs `enqueue()` messages and return immediately; a separate sender
+    calls `drain()` (or `run()`) to deliver them through a `Mailer`,
+    rate limited, with exponential backoff on failure.
+
+    Messages are de-duplicated by (recipient, subject, day), so rerunning
+    a notification job on the same day does not send twice.  Delivered
+    and failed rows are kept for `keep_days` to support this.
+
+    Args:
+        path (str): SQLite database path (default: $EMAIL_OUTBOX)
+        mailer (Mailer): mailer used to deliver messages
+        rate (float): max messages per second
+        burst (int): max messages sent at once
+        max_attempts (int): attempts before a message is marked failed
+        backoff (float): seconds before the first retry, doubled each attempt (min: 1)
+        max_backoff (float): max seconds between retries
+        keep_days (int): days to keep sent and failed messages
+    """
+    def __init__(self, path=None, mailer=None, rate=10, burst=20, max_attempts=8,
+                 backoff=60, max_backoff=3600*6, keep_days=7):
+        if not path:
+            config = from_environment({
+                'EMAIL_OUTBOX': 'email_outbox.sqlite',
+            })
+            path = config['EMAIL_OUTBOX']
+        self.path = path
+        self.mailer = mailer
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.keep_days = keep_days
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                recipient TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                day TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                recipients TEXT NOT NULL,
+                data BLOB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                created REAL NOT NULL,
+                error TEXT,
+                UNIQUE (recipient, subject, day)
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def enqueue(self, msg):
+        """
+        Add a message to the outbox.
+
+        Args:
+            msg (EmailMessage|RawEmail): the message
+
+        Returns:
+            bool: False if the message is a duplicate and was dropped
+        """
+        return self.enqueue_many([msg]) == 1
+
+    def enqueue_many(self, messages):
+        """
+        Add many messages to the outbox in one transaction.
+
+        Args:
+            messages (list): EmailMessage or RawEmail objects
+
+        Returns:
+            int: number of messages queued, after de-duplication
+        """
+        parser = BytesHeaderParser(policy=default_policy)
+        now = time.time()
+        day = date.today().isoformat()
+        rows = []
+        for msg in messages:
+            raw = _to_raw(msg)
+            subject = str(parser.parsebytes(raw.data).get('Subject', ''))
+            rows.append((','.join(sorted(raw.recipients)), subject, day, raw.sender,
+                         json.dumps(raw.recipients), raw.data, now, now))
+        with closing(self._connect()) as conn, conn:
+            before = conn.total_changes
+            conn.executemany('''INSERT OR IGNORE INTO outbox
+                (recipient, subject, day, sender, recipients, data, next_attempt, created)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            ret = conn.total_changes - before
+        if ret < len(rows):
+            logger.info(f'dropped {len(rows)-ret} duplicate messages')
+        return ret
+
+    def pending(self):
+        """Number of messages waiting to be sent."""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def purge(self):
+        """Delete sent and failed messages older than `keep_days`."""
+        cutoff = time.time() - self.keep_days*86400
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM outbox WHERE status != 'pending' AND created < ?", (cutoff,))
+
+    def _retry_delay(self, attempts):
+        # at least a second, so a retry is never due again in the same drain
+        return max(MIN_BACKOFF, min(self.max_backoff, self.backoff * 2**(attempts-1)))
+
+    def drain(self):
+        """
+        Send all messages that are due, once.
+
+        Returns:
+            tuple: (number sent, number that failed this round)
+        """
+        if self.mailer is None:
+            self.mailer = Mailer()
+        sent = failed = 0
+        start = time.time()  # retries wait for the next drain
+        while True:
+            n = self.bucket.take(self.bucket.burst)
+            with closing(self._connect()) as conn:
+                rows = conn.execute('''SELECT id, sender, recipients, data, attempts FROM outbox
+                    WHERE status = 'pending' AND next_attempt <= ?
+                    ORDER BY next_attempt LIMIT ?''', (start, n)).fetchall()
+            if not rows:
+                break
+
+            msgs = [RawEmail(sender, json.loads(recipients), data) for _, sender, recipients, data, _ in rows]
+            results = self.mailer.send_bulk(msgs)
+
+            updates = []
+            now = time.time()
+            for (row_id, _, recipients, _, attempts), error in zip(rows, results):
+                if error is None:
+                    updates.append(('sent', attempts+1, now, None, row_id))
+                    sent += 1
+                    continue
+                failed += 1
+                attempts += 1
+                if attempts >= self.max_attempts or _is_permanent_error(error):
+                    logger.warning(f'giving up sending email to {recipients}: {error!r}')
+                    updates.append(('failed', attempts, now, repr(error), row_id))
+                else:
+                    logger.info(f'error sending email to {recipients}, will retry: {error!r}')
+                    updates.append(('pending', attempts, now + self._retry_delay(attempts), repr(error), row_id))
+            with closing(self._connect()) as conn, conn:
+                conn.executemany('UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, error = ? WHERE id = ?', updates)
+        return sent, failed
+
+    async def run(self, interval=10):
+        """
+        Drain the outbox forever.
+
+        Args:
+            interval (float): seconds to wait between drains
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                sent, failed = await loop.run_in_executor(None, self.drain)
+                if sent or failed:
+                    logger.info(f'outbox: {sent} sent, {failed} failed')
+                await loop.run_in_executor(None, self.purge)
+            except Exception:
+                logger.warning('error draining outbox', exc_info=True)
+            await asyncio.sleep(interval)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Deliver email from the outbox')
+    parser.add_argument('--outbox', default=None, help='outbox path (default: $EMAIL_OUTBOX)')
+    parser.add_argument('--rate', default=10, type=float, help='max messages per second')
+    parser.add_argument('--connections', default=4, type=int, help='max concurrent SMTP connections')
+    parser.add_argument('--interval', default=10, type=float, help='seconds between drains')
+    parser.add_argument('--once', action='store_true', help='drain once, then exit')
+    parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'), help='logging level')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
+
+    with Mailer(connections=args['connections']) as mailer:
+        outbox = Outbox(args['outbox'], mailer=mailer, rate=args['rate'])
+        if args['once']:
+            sent, failed = outbox.drain()
+            outbox.purge()
+            print(f'{sent} sent, {failed} failed, {outbox.pending()} pending')
+        else:
+            asyncio.run(outbox.run(interval=args['interval']))
+
+
+if __name__ == '__main__':
+    main()
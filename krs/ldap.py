@@ -1,6 +1,7 @@
+from collections import deque
 import logging
 
-from ldap3 import Server, Connection, ALL, ALL_ATTRIBUTES, MODIFY_ADD, MODIFY_REPLACE, MODIFY_DELETE
+from ldap3 import Server, Connection, ALL, ALL_ATTRIBUTES, ASYNC, MODIFY_ADD, MODIFY_REPLACE, MODIFY_DELETE
 from rest_tools.client import RestClient
 from wipac_dev_tools import from_environment
 
@@ -222,8 +223,11 @@ class LDAP:
         # define the connection
         c = Connection(s, auto_bind=True)
 
+        # only fetch the attributes we need, plus the uid for the key
+        search_attrs = list(set(attrs) | {'uid'}) if attrs else ALL_ATTRIBUTES
+
         # search for the user
-        c.search(self.config['LDAP_USER_BASE'], '(uid=*)', attributes=ALL_ATTRIBUTES, paged_size=100)
+        c.search(self.config['LDAP_USER_BASE'], '(uid=*)', attributes=search_attrs, paged_size=100)
         if c.result['result']:
             logger.debug(f'search result {c.result}')
             raise Exception(f'Search users failed: {c.result["description"]}')
@@ -233,7 +237,7 @@ class LDAP:
             for entry in c.entries:
                 entry = entry.entry_attributes_as_dict
                 if attrs:
-                    val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry if k in attrs}
+                    val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry if k in attrs and entry[k]}
                 else:
                     val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry}
                 ret[entry['uid'][0]] = val
@@ -241,7 +245,7 @@ class LDAP:
         ret = {}
         process()
         while cookie:
-            c.search(self.config['LDAP_USER_BASE'], '(uid=*)', attributes=ALL_ATTRIBUTES, paged_size=100, paged_cookie=cookie)
+            c.search(self.config['LDAP_USER_BASE'], '(uid=*)', attributes=search_attrs, paged_size=100, paged_cookie=cookie)
             if c.result['result']:
                 logger.debug(f'search result {c.result}')
                 raise Exception(f'Search users failed: {c.result["description"]}')
@@ -250,12 +254,13 @@ class LDAP:
 
         return ret
 
-    def get_user(self, username):
+    def get_user(self, username, attrs=None):
         """
         Get user information from LDAP.
 
         Args:
             username (str): username of user
+            attrs (list): attributes to fetch (default: ALL)
 
         Returns:
             dict: user info
@@ -270,7 +275,8 @@ class LDAP:
         c = Connection(s, auto_bind=True)
 
         # search for the user
-        ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})', attributes=ALL_ATTRIBUTES)
+        search_attrs = list(set(attrs) | {'uid'}) if attrs else ALL_ATTRIBUTES
+        ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})', attributes=search_attrs)
         if not ret:
             raise KeyError(f'user {username} not found')
         return c.entries[0]
@@ -368,6 +374,67 @@ class LDAP:
         # close the connection
         c.unbind()
 
+    def modify_users(self, users, window=100):
+        """
+        Modify many users in LDAP over one connection.
+
+        Unlike `modify_user`, users are not searched for first: the DN is
+        built from LDAP_USER_BASE, attributes are replaced (or deleted if
+        None), and up to `window` requests are in flight at once.
+
+        Args:
+            users (dict): username: attributes to modify
+            window (int): max number of outstanding requests
+
+        Returns:
+            dict: username: None on success, or an error message
+        """
+        ret = {}
+        if not users:
+            return ret
+
+        # define the server
+        s = Server(self.config['LDAP_URL'], get_info=ALL)
+
+        # define the connection
+        c = Connection(s, user=self.config['LDAP_ADMIN_USER'], password=self.config['LDAP_ADMIN_PASSWORD'], client_strategy=ASYNC, auto_bind=True)
+
+        pending = deque()
+
+        def collect():
+            username, msg_id = pending.popleft()
+            try:
+                _, result = c.get_response(msg_id)
+            except Exception as e:
+                logger.debug('ldap exception', exc_info=True)
+                ret[username] = str(e)
+                return
+            if result['result']:
+                ret[username] = f'{result["description"]}: {result["message"]}'
+            else:
+                ret[username] = None
+
+        try:
+            for username in users:
+                attributes = users[username]
+                vals = {}
+                for a in attributes:
+                    if attributes[a] is None:
+                        vals[a] = [(MODIFY_REPLACE, [])]
+                    else:
+                        vals[a] = [(MODIFY_REPLACE, attributes[a] if isinstance(attributes[a], list) else [attributes[a]])]
+                logger.debug(f'ldap change for user {username}: {vals}')
+                pending.append((username, c.modify(f'uid={username},{self.config["LDAP_USER_BASE"]}', vals)))
+                if len(pending) >= window:
+                    collect()
+            while pending:
+                collect()
+        finally:
+            # close the connection
+            c.unbind()
+
+        return ret
+
     def list_groups(self, groupbase=None, attrs=None):
         """
         List group information in LDAP.
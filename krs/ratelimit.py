@@ -0,0 +1,38 @@
+"""Rate limiting utilities."""
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Args:
+        rate (float): tokens added per second
+        burst (int): max tokens held at once
+    """
+    def __init__(self, rate, burst):
+        assert rate > 0 and burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self, n=1):
+        """
+        Take up to `n` tokens, sleeping until at least one is available.
+
+        Returns:
+            int: number of tokens taken
+        """
+        self._refill()
+        if self._tokens < 1:
+            time.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        n = min(n, int(self._tokens))
+        self._tokens -= n
+        return n
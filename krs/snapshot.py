@@ -0,0 +1,380 @@
+"""
+Export and import a realm snapshot.
+
+A snapshot holds groups (with attributes, which covers institutions),
+apps and their roles, users, group memberships, and app role mappings.
+It is written as gzipped newline-delimited JSON, one record per line,
+in the order it is imported::
+
+    {"type": "realm", "version": 1}
+    {"type": "group", "path": "/posix", "attributes": {}}
+    {"type": "app", "name": "myapp", "url": "https://myapp", "roles": ["read"], "access": "public", ...}
+    {"type": "user", "username": "jdoe", "firstName": "J", ..., "groups": ["/posix"]}
+    {"type": "role_mapping", "group": "/posix", "app": "myapp", "roles": ["read"]}
+
+Passwords and other credentials are not exported.
+
+Import streams the file.  Groups, apps, and role mappings go through
+`krs.state`, so only missing objects are written.  Users are created
+with their group memberships by Keycloak's partial import, in batches
+and with several batches in flight, skipping users that already exist.
+Memberships missing from those existing users are then added one by one.
+
+With a checkpoint file, an interrupted import resumes after the last
+finished phase or user batch.
+
+Example::
+
+    python -m krs.snapshot export realm.ndjson.gz
+    python -m krs.snapshot import realm.ndjson.gz --checkpoint realm.ckpt
+"""
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import os
+
+from .apps import list_apps, list_scopes
+from .state import _list_groups, apply_state, gather_limited
+from .token import get_rest_client
+
+logger = logging.getLogger('krs.snapshot')
+
+VERSION = 1
+
+BUILTIN_SCOPES = ('profile', 'email', 'institution')
+
+USER_FIELDS = ('username', 'firstName', 'lastName', 'email', 'enabled', 'emailVerified', 'attributes', 'groups')
+
+
+async def get_paged(url, page_size, rest_client):
+    """
+    Get all results of a paged listing.
+
+    Args:
+        url (str): listing url, with or without a query string
+        page_size (int): results per request
+        rest_client: keycloak rest client
+
+    Returns:
+        list: all results
+    """
+    ret = []
+    sep = '&' if '?' in url else '?'
+    while True:
+        data = await rest_client.request('GET', f'{url}{sep}first={len(ret)}&max={page_size}')
+        ret.extend(data)
+        if len(data) < page_size:
+            return ret
+
+
+async def export_realm(filename, page_size=100, concurrency=8, rest_client=None):
+    """
+    Export a realm snapshot.
+
+    Users are fetched `concurrency` pages at a time and written as they
+    arrive.  Only group memberships are held in memory.
+
+    Args:
+        filename (str): output file
+        page_size (int): users per request
+        concurrency (int): max concurrent requests
+
+    Returns:
+        dict: record type: count
+    """
+    counts = {}
+
+    groups, apps, scopes = await asyncio.gather(
+        _list_groups(rest_client),
+        list_apps(rest_client=rest_client),
+        list_scopes(rest_client=rest_client),
+    )
+    app_names = {a['id']: name for name, a in apps.items()}
+
+    async def get_roles(appname):
+        roles = await rest_client.request('GET', f'/clients/{apps[appname]["id"]}/roles')
+        return [r['name'] for r in roles]
+
+    async def get_members(path):
+        members = await get_paged(f'/groups/{groups[path]["id"]}/members?briefRepresentation=true',
+                                  page_size, rest_client)
+        return [u['username'] for u in members]
+
+    async def get_mappings(path):
+        return await rest_client.request('GET', f'/groups/{groups[path]["id"]}/role-mappings')
+
+    with gzip.open(filename, 'wt', encoding='utf-8') as f:
+        def write(record):
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            counts[record['type']] = counts.get(record['type'], 0) + 1
+
+        write({'type': 'realm', 'version': VERSION})
+        for path in sorted(groups):
+            write({'type': 'group', 'path': path, 'attributes': groups[path].get('attributes') or {}})
+
+        names = sorted(apps)
+        for appname, roles in zip(names, await gather_limited(get_roles, names, concurrency)):
+            app = apps[appname]
+            client_scopes = app.get('defaultClientScopes', []) + app.get('optionalClientScopes', [])
+            write({'type': 'app', 'name': appname, 'url': app.get('rootUrl', ''), 'roles': roles,
+                   'access': scopes.get(appname, {}).get('attributes', {}).get('access', 'public'),
+                   'service_account': app.get('serviceAccountsEnabled', False),
+                   'builtin_scopes': sorted(s for s in set(client_scopes) if s in BUILTIN_SCOPES)})
+
+        paths = sorted(groups)
+        user_groups = {}
+        for path, members in zip(paths, await gather_limited(get_members, paths, concurrency)):
+            for username in members:
+                user_groups.setdefault(username, []).append(path)
+
+        first = 0
+        done = False
+        while not done:
+            urls = [f'/users?briefRepresentation=false&first={first+i*page_size}&max={page_size}'
+                    for i in range(concurrency)]
+            first += concurrency*page_size
+            for data in await gather_limited(lambda url: rest_client.request('GET', url), urls, concurrency):
+                for user in data:
+                    record = {k: user[k] for k in USER_FIELDS if k in user}
+                    record['groups'] = user_groups.get(user['username'], [])
+                    write(dict(record, type='user'))
+                if len(data) < page_size:
+                    done = True
+
+        for path, ret in zip(paths, await gather_limited(get_mappings, paths, concurrency)):
+            for client in (ret.get('clientMappings') or {}).values():
+                appname = app_names.get(client['id'])
+                if appname and client.get('mappings'):
+                    write({'type': 'role_mapping', 'group': path, 'app': appname,
+                           'roles': sorted(r['name'] for r in client['mappings'])})
+
+    logger.info(f'exported {counts} to {filename}')
+    return counts
+
+
+def read_snapshot(filename):
+    """
+    Read the records of a realm snapshot.
+
+    Args:
+        filename (str): snapshot file
+
+    Returns:
+        iterator: records
+    """
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        header = json.loads(next(f))
+        if header.get('type') != 'realm' or header.get('version') != VERSION:
+            raise Exception(f'{filename} is not a version {VERSION} realm snapshot')
+        for line in f:
+            yield json.loads(line)
+
+
+class Checkpoint:
+    """
+    Import progress, saved to a JSON file after every step.
+
+    Args:
+        path (str): checkpoint file (optional, default: no checkpoints)
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.phases = set()
+        self.users = 0
+        self.existing = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.phases = set(data['phases'])
+            self.users = data['users']
+            self.existing = data['existing']
+            logger.info(f'resuming import after {sorted(self.phases)} and {self.users} users')
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'phases': sorted(self.phases), 'users': self.users, 'existing': self.existing}, f)
+        os.replace(tmp, self.path)
+
+    def done(self, phase):
+        self.phases.add(phase)
+        self.save()
+
+
+async def _import_users(records, checkpoint, batch_size, concurrency, rest_client):
+    """
+    Create users with partial imports, several batches at a time.
+
+    The checkpoint only advances past a batch once it and all earlier
+    batches have finished.  Users that already existed are kept in the
+    checkpoint, to have their memberships checked afterwards.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    finished = {}
+    start = checkpoint.users
+    added = 0
+    failed = False
+
+    async def run(offset, batch):
+        nonlocal added, failed
+        try:
+            ret = await rest_client.request('POST', '/partialImport', {'ifResourceExists': 'SKIP', 'users': batch})
+        except Exception:
+            failed = True
+            raise
+        finally:
+            semaphore.release()
+        ret = ret or {}
+        added += ret.get('added', 0)
+        user_groups = {u['username']: u.get('groups', []) for u in batch}
+        for r in ret.get('results', []):
+            if r.get('action') == 'SKIPPED' and user_groups.get(r['resourceName']):
+                checkpoint.existing[r['resourceName']] = [r.get('id'), user_groups[r['resourceName']]]
+        finished[offset] = offset + len(batch)
+        while checkpoint.users in finished:
+            checkpoint.users = finished.pop(checkpoint.users)
+        checkpoint.save()
+
+    def users():
+        for i, record in enumerate(records):
+            if i >= start:
+                yield {k: record[k] for k in USER_FIELDS if k in record}
+
+    offset = start
+    it = users()
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            break
+        await semaphore.acquire()
+        if failed:
+            # stop at the first error, the checkpoint cannot advance past it
+            semaphore.release()
+            break
+        tasks.append(asyncio.create_task(run(offset, batch)))
+        offset += len(batch)
+    await asyncio.gather(*tasks)
+    logger.info(f'imported {offset-start} users, {added} added')
+
+
+async def _add_memberships(existing, concurrency, rest_client):
+    """
+    Add group memberships missing from users that already existed.
+
+    Each group with such users has its members listed once.  Parent
+    groups are handled before their children, to stay clear of
+    https://issues.redhat.com/browse/KEYCLOAK-11298.
+
+    Args:
+        existing (dict): username: [user id, group paths]
+    """
+    groups = await _list_groups(rest_client)
+    group_users = {}
+    for username, (_, paths) in existing.items():
+        for path in paths:
+            group_users.setdefault(path, []).append(username)
+
+    async def get_missing(path):
+        if path not in groups:
+            logger.warning(f'group "{path}" does not exist')
+            return []
+        members = await get_paged(f'/groups/{groups[path]["id"]}/members?briefRepresentation=true', 100, rest_client)
+        current = {u['username'] for u in members}
+        return [(u, path) for u in group_users[path] if u not in current]
+
+    paths = sorted(group_users)
+    missing = [m for ret in await gather_limited(get_missing, paths, concurrency) for m in ret]
+
+    async def get_user_id(username):
+        ret = await rest_client.request('GET', f'/users?exact=true&username={username}')
+        existing[username][0] = ret[0]['id']
+    await gather_limited(get_user_id, sorted({u for u, _ in missing if not existing[u][0]}), concurrency)
+
+    async def add(item):
+        username, path = item
+        await rest_client.request('PUT', f'/users/{existing[username][0]}/groups/{groups[path]["id"]}')
+        logger.info(f'user "{username}" added to group "{path}"')
+
+    levels = {}
+    for username, path in missing:
+        levels.setdefault(path.count('/'), []).append((username, path))
+    for depth in sorted(levels):
+        await gather_limited(add, levels[depth], concurrency)
+    logger.info(f'added {len(missing)} memberships to existing users')
+
+
+async def import_realm(filename, checkpoint=None, batch_size=100, concurrency=8, rest_client=None):
+    """
+    Import a realm snapshot.
+
+    Args:
+        filename (str): snapshot file
+        checkpoint (str): checkpoint file to resume from and save progress to (optional)
+        batch_size (int): users per partial import request
+        concurrency (int): max concurrent requests
+    """
+    progress = Checkpoint(checkpoint)
+
+    for record_type, records in itertools.groupby(read_snapshot(filename), key=lambda r: r['type']):
+        if record_type in progress.phases:
+            logger.info(f'skipping {record_type} records, already imported')
+            continue
+        if record_type == 'group':
+            state = {'group_attrs': {r['path']: r['attributes'] for r in records}}
+            await apply_state(state, concurrency=concurrency, update_attrs=True, rest_client=rest_client)
+        elif record_type == 'app':
+            state = {'apps': {}}
+            for r in records:
+                args = {'appurl': r['url'], 'roles': r['roles']}
+                args.update({k: r[k] for k in ('access', 'service_account', 'builtin_scopes') if k in r})
+                state['apps'][r['name']] = args
+            await apply_state(state, concurrency=concurrency, rest_client=rest_client)
+        elif record_type == 'user':
+            await _import_users(records, progress, batch_size, concurrency, rest_client)
+            await _add_memberships(progress.existing, concurrency, rest_client)
+        elif record_type == 'role_mapping':
+            role_mappings = {}
+            for r in records:
+                for role in r['roles']:
+                    role_mappings.setdefault(r['app'], {}).setdefault(role, []).append(r['group'])
+            await apply_state({'role_mappings': role_mappings}, concurrency=concurrency, rest_client=rest_client)
+        else:
+            raise Exception(f'unknown record type {record_type}')
+        progress.done(record_type)
+
+
+def main():
+    import argparse
+    from pprint import pprint
+
+    parser = argparse.ArgumentParser(description='Keycloak realm snapshot export and import')
+    subparsers = parser.add_subparsers()
+    parser_export = subparsers.add_parser('export', help='export a realm snapshot')
+    parser_export.add_argument('filename', help='output file (gzipped NDJSON)')
+    parser_export.add_argument('--page-size', dest='page_size', default=100, type=int, help='users per request')
+    parser_export.add_argument('--concurrency', default=8, type=int, help='max concurrent requests')
+    parser_export.set_defaults(func=export_realm)
+    parser_import = subparsers.add_parser('import', help='import a realm snapshot')
+    parser_import.add_argument('filename', help='snapshot file (gzipped NDJSON)')
+    parser_import.add_argument('--checkpoint', default=None, help='checkpoint file for resuming an import')
+    parser_import.add_argument('--batch-size', dest='batch_size', default=100, type=int, help='users per import request')
+    parser_import.add_argument('--concurrency', default=8, type=int, help='max concurrent requests')
+    parser_import.set_defaults(func=import_realm)
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    rest_client = get_rest_client()
+    func = args.pop('func')
+    ret = asyncio.run(func(rest_client=rest_client, **args))
+    if ret is not None:
+        pprint(ret)
+
+
+if __name__ == '__main__':
+    main()
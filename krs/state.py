@@ -0,0 +1,383 @@
+"""
+Declarative realm state for Keycloak.
+
+Describe the groups, institutions, apps, and app role mappings a realm
+should have, and bring the realm up to date in one step::
+
+    state = {
+        'groups': {'institutions': {'IceCube': {}}, 'posix': {}},
+        'institutions': {'IceCube': {'UW-Madison': {'name': ..., 'cite': ..., ...}}},
+        'apps': {'myapp': {'appurl': 'https://myapp', 'roles': ['read', 'write']}},
+        'role_mappings': {'myapp': {'read': ['/posix']}},
+        'group_attrs': {'/posix': {'gidNumber': '1000'}},
+    }
+    await apply_state(state, rest_client=rest_client)
+
+The current state is read once, compared against the desired state, and
+only the differences are written.  Writes run with bounded parallelism,
+creating parent groups before their children, and groups and apps before
+role mappings.  Nothing is ever deleted.
+
+By default only missing objects are created: attributes of existing
+groups are left alone, so edits made in Keycloak are not reverted.  With
+`update_attrs`, attributes of existing groups that differ from the
+desired state are also written (other existing attributes are kept).
+On an up-to-date realm this is one read pass and no writes.
+
+Example::
+
+    python -m krs.state state.json --dryrun
+"""
+import asyncio
+import copy
+import json
+import logging
+
+from .apps import create_apps
+from .institutions import validate_attrs
+from .token import get_rest_client
+
+logger = logging.getLogger('krs.state')
+
+
+def desired_groups(state):
+    """
+    Expand the groups and institutions of a desired state into group paths.
+
+    Institutions get the same subgroups as `create_inst()`.  Attributes
+    from `group_attrs` are added to (and can create) any group.  Any missing
+    parent groups are added without attributes.
+
+    Args:
+        state (dict): desired state
+
+    Returns:
+        dict: group path: attrs (or None)
+    """
+    ret = {}
+
+    def add_tree(root, values):
+        for name in values:
+            path = root + '/' + name
+            ret[path] = None
+            if isinstance(values, dict) and values[name]:
+                add_tree(path, values[name])
+    add_tree('', state.get('groups', {}))
+
+    for experiment, insts in state.get('institutions', {}).items():
+        for name, attrs in insts.items():
+            attrs = validate_attrs({k: copy.deepcopy(v) for k, v in attrs.items() if not k.startswith('_')})
+            authorlists = attrs.pop('authorlists', None)
+            path = f'/institutions/{experiment}/{name}'
+            ret[path] = attrs
+            ret[f'{path}/_admin'] = attrs
+            if authorlists:
+                for a in authorlists:
+                    ret[f'{path}/authorlist-{a}'] = {'cite': authorlists[a]}
+            elif attrs['authorlist']:
+                ret.setdefault(f'{path}/authorlist', None)
+
+    for path, attrs in state.get('group_attrs', {}).items():
+        ret[path] = dict(ret.get(path) or {}, **attrs)
+
+    for path in list(ret):
+        parent = path.rsplit('/', 1)[0]
+        while parent and parent not in ret:
+            ret[parent] = None
+            parent = parent.rsplit('/', 1)[0]
+    return ret
+
+
+def _attr_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _same_attr(desired, current):
+    if current is None:
+        # keycloak drops empty attributes
+        return desired == []
+    if isinstance(desired, list):
+        return _attr_list(current) == desired
+    if isinstance(current, list):
+        current = current[0] if len(current) == 1 else current
+    if isinstance(desired, bool):
+        return str(current).lower() == str(desired).lower()
+    return current == desired
+
+
+async def gather_limited(fn, items, concurrency):
+    """
+    Run `fn` on each item, at most `concurrency` at a time.
+
+    Args:
+        fn (callable): async function of one item
+        items (iterable): items
+        concurrency (int): max concurrent calls
+
+    Returns:
+        list: results, in the order of `items`
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await fn(item)
+    return await asyncio.gather(*(run(i) for i in items))
+
+
+async def _list_groups(rest_client):
+    """Get all groups with attributes, in one request, keyed by path."""
+    ret = {}
+
+    def add_groups(groups):
+        for g in groups:
+            ret[g['path']] = g
+            add_groups(g.get('subGroups', []))
+    add_groups(await rest_client.request('GET', '/groups?briefRepresentation=false&max=10000'))
+    return ret
+
+
+async def fetch_state(apps=None, mapped_groups=None, concurrency=8, rest_client=None):
+    """
+    Read the current state of a realm.
+
+    All groups with their attributes come from a single request.  Roles
+    are fetched for the given apps, and role mappings for the given groups.
+
+    Args:
+        apps (iterable): app names to fetch roles for (default: none)
+        mapped_groups (iterable): group paths to fetch role mappings for (default: none)
+        concurrency (int): max concurrent requests
+
+    Returns:
+        dict: {groups: {path: group}, apps: {name: {id, roles: {name: role}}}, mappings: {path: {app: set(roles)}}}
+    """
+    groups, clients = await asyncio.gather(
+        _list_groups(rest_client),
+        rest_client.request('GET', '/clients'),
+    )
+    clients = {c['clientId']: c for c in clients}
+
+    ret = {'groups': groups, 'apps': {}, 'mappings': {}}
+    names = [a for a in (apps or []) if a in clients]
+
+    async def get_roles(appname):
+        roles = await rest_client.request('GET', f'/clients/{clients[appname]["id"]}/roles')
+        ret['apps'][appname] = {'id': clients[appname]['id'], 'roles': {r['name']: r for r in roles}}
+
+    paths = [p for p in (mapped_groups or []) if p in groups]
+
+    async def get_mappings(path):
+        data = await rest_client.request('GET', f'/groups/{groups[path]["id"]}/role-mappings')
+        ret['mappings'][path] = {
+            appname: {r['name'] for r in client.get('mappings', [])}
+            for appname, client in (data.get('clientMappings') or {}).items()
+        }
+
+    await asyncio.gather(gather_limited(get_roles, names, concurrency), gather_limited(get_mappings, paths, concurrency))
+    return ret
+
+
+def plan_state(state, current, update_attrs=False):
+    """
+    Compute the changes needed to reach a desired state.
+
+    Args:
+        state (dict): desired state
+        current (dict): current state, from `fetch_state()`
+        update_attrs (bool): also update attributes of existing groups
+
+    Returns:
+        dict: {create_groups: {path: attrs}, update_groups: {path: attrs},
+               create_apps: {name: args}, create_roles: {app: [roles]},
+               add_mappings: [(app, role, group)]}
+    """
+    plan = {'create_groups': {}, 'update_groups': {}, 'create_apps': {}, 'create_roles': {}, 'add_mappings': []}
+
+    groups = desired_groups(state)
+    for path, attrs in sorted(groups.items()):
+        group = current['groups'].get(path)
+        if group is None:
+            plan['create_groups'][path] = attrs
+        elif attrs and update_attrs:
+            existing = group.get('attributes') or {}
+            changed = {k: v for k, v in attrs.items() if not _same_attr(v, existing.get(k))}
+            if changed:
+                plan['update_groups'][path] = changed
+
+    for appname, args in sorted(state.get('apps', {}).items()):
+        roles = args.get('roles', ['read', 'write'])
+        if appname not in current['apps']:
+            plan['create_apps'][appname] = args
+        else:
+            missing = [r for r in roles if r not in current['apps'][appname]['roles']]
+            if missing:
+                plan['create_roles'][appname] = missing
+
+    for appname, role_groups in sorted(state.get('role_mappings', {}).items()):
+        if appname in current['apps']:
+            roles = set(current['apps'][appname]['roles'])
+        elif appname in state.get('apps', {}):
+            roles = set()
+        else:
+            raise Exception(f'app "{appname}" does not exist')
+        if appname in state.get('apps', {}):
+            roles.update(state['apps'][appname].get('roles', ['read', 'write']))
+        for role, paths in sorted(role_groups.items()):
+            if role not in roles:
+                raise Exception(f'role "{role}" does not exist in app "{appname}"')
+            for path in sorted(paths):
+                if path not in current['groups'] and path not in groups:
+                    raise Exception(f'group "{path}" does not exist')
+                if role not in current['mappings'].get(path, {}).get(appname, ()):
+                    plan['add_mappings'].append((appname, role, path))
+    return plan
+
+
+def format_plan(plan):
+    """
+    Describe a plan, one change per line.
+
+    Returns:
+        str: plan description
+    """
+    lines = []
+    for path, attrs in plan['create_groups'].items():
+        lines.append(f'+ group {path}' + (f' {attrs}' if attrs else ''))
+    for path, attrs in plan['update_groups'].items():
+        lines.append(f'~ group {path} {attrs}')
+    for appname in plan['create_apps']:
+        lines.append(f'+ app {appname}')
+    for appname, roles in plan['create_roles'].items():
+        for role in roles:
+            lines.append(f'+ role {appname}/{role}')
+    for appname, role, path in plan['add_mappings']:
+        lines.append(f'+ mapping {appname}/{role} -> {path}')
+    return '\n'.join(lines) if lines else 'no changes'
+
+
+async def apply_plan(plan, current, concurrency=8, rest_client=None):
+    """
+    Execute a plan.
+
+    Groups are created one tree level at a time, so parents always exist
+    before their children.  The group list is re-read after each level
+    to learn the new group ids.
+
+    Args:
+        plan (dict): plan, from `plan_state()`
+        current (dict): current state the plan was made from
+        concurrency (int): max concurrent writes
+    """
+    group_ids = {path: g['id'] for path, g in current['groups'].items()}
+
+    async def refresh_group_ids():
+        groups = await _list_groups(rest_client)
+        group_ids.update({path: g['id'] for path, g in groups.items()})
+
+    levels = {}
+    for path in plan['create_groups']:
+        levels.setdefault(path.count('/'), []).append(path)
+
+    async def create_group(path):
+        parent, name = path.rsplit('/', 1)
+        group = {'name': name}
+        attrs = plan['create_groups'][path]
+        if attrs:
+            group['attributes'] = {k: _attr_list(attrs[k]) for k in attrs}
+        url = f'/groups/{group_ids[parent]}/children' if parent else '/groups'
+        await rest_client.request('POST', url, group)
+        logger.info(f'group "{path}" created')
+
+    async def update_group(path):
+        group = current['groups'][path]
+        attributes = dict(group.get('attributes') or {})
+        attributes.update({k: _attr_list(v) for k, v in plan['update_groups'][path].items()})
+        await rest_client.request('PUT', f'/groups/{group["id"]}', {'name': group['name'], 'attributes': attributes})
+        logger.info(f'group "{path}" updated')
+
+    async def create_groups():
+        for depth in sorted(levels):
+            await gather_limited(create_group, levels[depth], concurrency)
+            await refresh_group_ids()
+
+    async def create_new_apps():
+        if plan['create_apps']:
+            apps = [dict(args, appname=appname) for appname, args in plan['create_apps'].items()]
+            await create_apps(apps, concurrency=concurrency, rest_client=rest_client)
+
+    async def create_roles():
+        async def create(item):
+            appname, role = item
+            url = f'/clients/{current["apps"][appname]["id"]}/roles'
+            await rest_client.request('POST', url, {'name': role})
+            logger.info(f'app "{appname}" role "{role}" created')
+        items = [(a, r) for a, roles in plan['create_roles'].items() for r in roles]
+        await gather_limited(create, items, concurrency)
+
+    await asyncio.gather(
+        create_groups(),
+        gather_limited(update_group, list(plan['update_groups']), concurrency),
+        create_new_apps(),
+        create_roles(),
+    )
+
+    if plan['add_mappings']:
+        apps = await fetch_state(apps={a for a, _, _ in plan['add_mappings']}, rest_client=rest_client)
+
+        async def add_mapping(item):
+            appname, role, path = item
+            app = apps['apps'][appname]
+            url = f'/groups/{group_ids[path]}/role-mappings/clients/{app["id"]}'
+            await rest_client.request('POST', url, [app['roles'][role]])
+            logger.info(f'app "{appname}" role mapping {role}-{path} created')
+        await gather_limited(add_mapping, plan['add_mappings'], concurrency)
+
+
+async def apply_state(state, dryrun=False, concurrency=8, update_attrs=False, rest_client=None):
+    """
+    Bring a realm up to date with a desired state.
+
+    Args:
+        state (dict): desired state
+        dryrun (bool): only print the plan
+        concurrency (int): max concurrent requests
+        update_attrs (bool): also update attributes of existing groups
+
+    Returns:
+        dict: the plan
+    """
+    mapped_groups = {p for role_groups in state.get('role_mappings', {}).values()
+                     for paths in role_groups.values() for p in paths}
+    apps = set(state.get('apps', {})) | set(state.get('role_mappings', {}))
+    current = await fetch_state(apps=apps, mapped_groups=mapped_groups,
+                                concurrency=concurrency, rest_client=rest_client)
+    plan = plan_state(state, current, update_attrs=update_attrs)
+    print(format_plan(plan))
+    if not dryrun:
+        await apply_plan(plan, current, concurrency=concurrency, rest_client=rest_client)
+    return plan
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Apply a declarative realm state to Keycloak')
+    parser.add_argument('state', help='JSON file with the desired state')
+    parser.add_argument('--dryrun', default=False, action='store_true', help='only print the plan')
+    parser.add_argument('--concurrency', default=8, type=int, help='max concurrent requests')
+    parser.add_argument('--update-attrs', dest='update_attrs', default=False, action='store_true',
+                        help='also update attributes of existing groups')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    with open(args.pop('state')) as f:
+        state = json.load(f)
+
+    rest_client = get_rest_client()
+    asyncio.run(apply_state(state, rest_client=rest_client, **args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,15 @@
 """
-Get an admin token for KeyCloak.
+Get an admin token for KeyCloak, and verify tokens issued by it.
 """
+import copy
+import json
 import logging
 from functools import partial
+import threading
+import time
 
+from cachetools import TLRUCache
+import jwt
 import requests
 from wipac_dev_tools import from_environment
 from rest_tools.client import RestClient
@@ -49,6 +55,106 @@ def get_rest_client(retries=None, timeout=10):
     )
 
 
+class TokenVerifier:
+    """
+    Verify OIDC tokens locally.
+
+    The discovery document and the parsed public keys are cached for
+    `key_ttl` seconds.  A token signed with an unknown key id triggers a
+    refresh, at most once every `min_refresh_interval` seconds.  Verified
+    tokens are cached until they expire, so repeat checks of the same
+    token skip the signature verification.
+
+    Args:
+        openid_url (str): realm url, like `https://keycloak/auth/realms/myrealm`
+        algorithms (list): allowed signing algorithms (default: RS256, RS512)
+        audience (str): expected audience (default: not checked)
+        key_ttl (float): seconds to cache discovery and keys (default: 3600)
+        min_refresh_interval (float): min seconds between refreshes for unknown keys (default: 10)
+        cache_size (int): max verified tokens to cache (default: 10000)
+    """
+    def __init__(self, openid_url, algorithms=None, audience=None, key_ttl=3600,
+                 min_refresh_interval=10, cache_size=10000):
+        self.openid_url = openid_url.rstrip('/')
+        self.algorithms = algorithms if algorithms else ['RS256', 'RS512']
+        self.audience = audience
+        self.key_ttl = key_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._provider_info = None
+        self._keys = {}
+        self._keys_time = 0
+        self._lock = threading.Lock()
+        self._tokens = TLRUCache(maxsize=cache_size, ttu=lambda _, claims, now: claims.get('exp', now), timer=time.time)
+
+    def _refresh(self):
+        r = requests.get(f'{self.openid_url}/.well-known/openid-configuration')
+        r.raise_for_status()
+        provider_info = r.json()
+
+        r = requests.get(provider_info['jwks_uri'])
+        r.raise_for_status()
+        keys = {}
+        for jwk in r.json()['keys']:
+            if jwk.get('use', 'sig') != 'sig' or jwk.get('kty') != 'RSA':
+                continue
+            keys[jwk['kid']] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+        self._provider_info = provider_info
+        self._keys = keys
+        self._keys_time = time.monotonic()
+        logging.debug(f'loaded {len(keys)} keys from {provider_info["jwks_uri"]}')
+
+    def provider_info(self):
+        """
+        Get the OIDC discovery document.
+
+        Returns:
+            dict: provider info
+        """
+        with self._lock:
+            if self._provider_info is None or time.monotonic() - self._keys_time > self.key_ttl:
+                self._refresh()
+            return self._provider_info
+
+    def _get_key(self, kid):
+        with self._lock:
+            age = time.monotonic() - self._keys_time
+            if self._provider_info is None or age > self.key_ttl or (
+                    kid not in self._keys and age > self.min_refresh_interval):
+                self._refresh()
+            if kid not in self._keys:
+                raise jwt.InvalidTokenError(f'key {kid} not found')
+            return self._keys[kid]
+
+    def verify(self, token):
+        """
+        Verify a token.
+
+        Args:
+            token (str): encoded token
+
+        Returns:
+            dict: token claims
+
+        Raises:
+            jwt.InvalidTokenError
+        """
+        with self._lock:
+            claims = self._tokens.get(token)
+        if claims is not None:
+            return copy.deepcopy(claims)
+
+        header = jwt.get_unverified_header(token)
+        key = self._get_key(header.get('kid'))
+        options = {'require': ['exp']}
+        if self.audience is None:
+            options['verify_aud'] = False
+        claims = jwt.decode(token, key, algorithms=self.algorithms, audience=self.audience, options=options)
+        with self._lock:
+            self._tokens[token] = claims
+        return copy.deepcopy(claims)
+
+
 def main():
     import argparse
     from pprint import pprint
@@ -9,7 +9,7 @@ from .token import get_rest_client
 logger = logging.getLogger('krs.users')
 
 
-def _fix_attributes(user):
+def fix_attributes(user):
     """
     "Fix" user attributes that are only a single value.
 
@@ -25,6 +25,10 @@ def _fix_attributes(user):
                 user['attributes'][k] = user['attributes'][k][0]
 
 
+# kept for existing importers
+_fix_attributes = fix_attributes
+
+
 class UserDoesNotExist(Exception):
     pass
 
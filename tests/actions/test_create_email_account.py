@@ -10,7 +10,7 @@ import actions.util
 from actions import create_email_account
 
 from ..util import keycloak_bootstrap, rabbitmq_bootstrap
-from .util import patch_ssh_sudo, TestException
+from .util import patch_ssh_sudo, agent_script_request, TestException
 
 
 @pytest.mark.asyncio
@@ -25,7 +25,7 @@ async def test_create(keycloak_bootstrap, patch_ssh_sudo):
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
     user_dict = {'testuser': {'canonical': 'first.last', 'uid': 1000, 'gid': 1000}}
-    assert json.loads(patch_ssh_sudo.call_args.args[1].split('\n')[6].split('=',1)[-1]) == user_dict
+    assert agent_script_request(patch_ssh_sudo.call_args.args[1])['args']['users'] == user_dict
 
 @pytest.mark.asyncio
 async def test_create_error_ssh(keycloak_bootstrap, patch_ssh_sudo):
@@ -49,7 +49,7 @@ async def test_create_not_in_group(keycloak_bootstrap, patch_ssh_sudo):
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
     user_dict = {}
-    assert json.loads(patch_ssh_sudo.call_args.args[1].split('\n')[6].split('=',1)[-1]) == user_dict
+    assert agent_script_request(patch_ssh_sudo.call_args.args[1])['args']['users'] == user_dict
 
 @pytest.mark.asyncio
 async def test_create_unicode(keycloak_bootstrap, patch_ssh_sudo):
@@ -63,7 +63,7 @@ async def test_create_unicode(keycloak_bootstrap, patch_ssh_sudo):
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
     user_dict = {'foo': {'canonical': 'first.mulast', 'uid': 1000, 'gid': 1000}}
-    assert json.loads(patch_ssh_sudo.call_args.args[1].split('\n')[6].split('=',1)[-1]) == user_dict
+    assert agent_script_request(patch_ssh_sudo.call_args.args[1])['args']['users'] == user_dict
 
 
 @pytest_asyncio.fixture
@@ -87,4 +87,4 @@ async def test_listener_create(keycloak_bootstrap, tmp_path, listener, patch_ssh
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
     user_dict = {'testuser': {'canonical': 'first.last', 'uid': 1000, 'gid': 1000}}
-    assert json.loads(patch_ssh_sudo.call_args.args[1].split('\n')[6].split('=',1)[-1]) == user_dict
+    assert agent_script_request(patch_ssh_sudo.call_args.args[1])['args']['users'] == user_dict
@@ -1,13 +1,15 @@
 import asyncio
+import pathlib
 import pytest
 import pytest_asyncio
 
 #from krs.token import get_token
 from krs import users, groups, bootstrap, rabbitmq
+import actions.util
 from actions import create_user_directory_ssh
 
 from ..util import keycloak_bootstrap, rabbitmq_bootstrap
-from .util import patch_ssh_sudo, TestException
+from .util import patch_ssh_sudo, agent_script_request, TestException
 
 @pytest.mark.asyncio
 async def test_create(keycloak_bootstrap, tmp_path, patch_ssh_sudo):
@@ -24,7 +26,7 @@ async def test_create(keycloak_bootstrap, tmp_path, patch_ssh_sudo):
     patch_ssh_sudo.assert_called_once()
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
-    exec(patch_ssh_sudo.call_args.args[1])
+    exec(patch_ssh_sudo.call_args.args[1], {})
 
     ret_path = tmp_path / 'testuser'
     assert ret_path.is_dir()
@@ -43,7 +45,7 @@ async def test_missing_uidNumber(keycloak_bootstrap, tmp_path, patch_ssh_sudo):
     patch_ssh_sudo.assert_called_once()
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
-    exec(patch_ssh_sudo.call_args.args[1])
+    exec(patch_ssh_sudo.call_args.args[1], {})
 
     ret_path = tmp_path / 'testuser'
     assert not ret_path.is_dir()
@@ -62,7 +64,7 @@ async def test_missing_gidNumber(keycloak_bootstrap, tmp_path, patch_ssh_sudo):
     patch_ssh_sudo.assert_called_once()
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
-    exec(patch_ssh_sudo.call_args.args[1])
+    exec(patch_ssh_sudo.call_args.args[1], {})
 
     ret_path = tmp_path / 'testuser'
     assert not ret_path.is_dir()
@@ -81,7 +83,7 @@ async def test_missing_group(keycloak_bootstrap, tmp_path, patch_ssh_sudo):
     patch_ssh_sudo.assert_called_once()
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
-    exec(patch_ssh_sudo.call_args.args[1])
+    exec(patch_ssh_sudo.call_args.args[1], {})
 
     ret_path = tmp_path / 'testuser'
     assert not ret_path.is_dir()
@@ -105,7 +107,7 @@ async def test_already_exists(keycloak_bootstrap, tmp_path, patch_ssh_sudo):
     patch_ssh_sudo.assert_called_once()
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
-    exec(patch_ssh_sudo.call_args.args[1])
+    exec(patch_ssh_sudo.call_args.args[1], {})
 
     assert ret_path.exists()
     assert not ret_path.is_dir()
@@ -136,7 +138,88 @@ async def test_listener_create(keycloak_bootstrap, tmp_path, listener, patch_ssh
     patch_ssh_sudo.assert_called_once()
     assert patch_ssh_sudo.call_args.args[0] == 'test.test.test'
 
-    exec(patch_ssh_sudo.call_args.args[1])
+    exec(patch_ssh_sudo.call_args.args[1], {})
 
     ret_path = tmp_path / 'testuser'
     assert ret_path.is_dir()
+
+@pytest.mark.asyncio
+async def test_create_state(tmp_path, mocker, patch_ssh_sudo):
+    members = ['testuser']
+    user_info = {
+        'testuser': {'attributes': {'uidNumber': '12345', 'gidNumber': '12345'}},
+        'testuser2': {'attributes': {'uidNumber': '12346', 'gidNumber': '12346'}},
+    }
+    mocker.patch('actions.create_user_directory_ssh.get_group_membership', return_value=members)
+    mocker.patch('actions.create_user_directory_ssh.list_users', return_value=user_info)
+    state = actions.util.ProvisionedState()
+
+    # first run does a full check
+    await create_user_directory_ssh.process('test.test.test', '/posix', tmp_path, state=state)
+    req = agent_script_request(patch_ssh_sudo.call_args.args[1])
+    assert set(req['args']['user_dirs']) == {'testuser'}
+    assert req['args']['full']
+    exec(patch_ssh_sudo.call_args.args[1], {})
+
+    # nothing new, so nothing to send
+    await create_user_directory_ssh.process('test.test.test', '/posix', tmp_path, state=state)
+    assert patch_ssh_sudo.call_count == 1
+
+    # only the new user is sent
+    members.append('testuser2')
+    await create_user_directory_ssh.process('test.test.test', '/posix', tmp_path, state=state)
+    assert patch_ssh_sudo.call_count == 2
+    req = agent_script_request(patch_ssh_sudo.call_args.args[1])
+    assert set(req['args']['user_dirs']) == {'testuser2'}
+    assert not req['args']['full']
+    exec(patch_ssh_sudo.call_args.args[1], {})
+
+    assert (tmp_path / 'testuser2').is_dir()
+
+@pytest.mark.asyncio
+async def test_process_targets(mocker):
+    user_info = {
+        'testuser': {'attributes': {'uidNumber': '12345', 'gidNumber': '12345'}},
+        'roleuser': {'attributes': {'uidNumber': '12346', 'gidNumber': '12346', 'roleAccount': 'True'}},
+    }
+    gm = mocker.patch('actions.create_user_directory_ssh.get_group_membership', return_value=list(user_info))
+    lu = mocker.patch('actions.create_user_directory_ssh.list_users', return_value=user_info)
+
+    running = {'a': 0, 'b': 0}
+    max_running = {'a': 0, 'b': 0}
+    requests = {}
+    async def run_remote_script(server, script, sudo=False):
+        running[server] += 1
+        max_running[server] = max(max_running[server], running[server])
+        await asyncio.sleep(.01)
+        running[server] -= 1
+        req = agent_script_request(script)['args']
+        if req['root_dir'] == '/fail':
+            raise TestException()
+        requests[f'{server}:{req["root_dir"]}'] = set(req['user_dirs'])
+    mocker.patch('actions.util.run_remote_script', side_effect=run_remote_script)
+
+    targets = [
+        ('a', '/mnt/homework/homework'),
+        ('a', '/mnt/homework/public_html'),
+        ('a', '/fail'),
+        ('b', '/mnt/homework/homework'),
+    ]
+    report = await create_user_directory_ssh.process_targets(targets, '/posix', host_concurrency=1)
+
+    gm.assert_called_once()
+    lu.assert_called_once()
+    assert max_running == {'a': 1, 'b': 1}
+    assert requests == {
+        'a:/mnt/homework/homework': {'testuser', 'roleuser'},
+        'a:/mnt/homework/public_html': {'testuser'},
+        'b:/mnt/homework/homework': {'testuser', 'roleuser'},
+    }
+    assert report['a:/mnt/homework/homework'] == {'checked': 2, 'created': None, 'error': None}
+    assert report['a:/fail']['error']
+    assert not report['b:/mnt/homework/homework']['error']
+
+def test_parse_target():
+    assert create_user_directory_ssh.parse_target('a:/foo/bar') == ('a', pathlib.Path('/foo/bar'))
+    with pytest.raises(ValueError):
+        create_user_directory_ssh.parse_target('a')
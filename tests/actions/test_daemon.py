@@ -0,0 +1,206 @@
+import asyncio
+
+import pytest
+
+from actions.daemon import topic_match, RealmSnapshot, HostedAction, Daemon, load_actions, MAX_REFETCH
+
+
+class FakeRestClient:
+    def __init__(self):
+        self.calls = []
+
+    async def request(self, method, path, args=None):
+        self.calls.append((method, path))
+        await asyncio.sleep(.01)
+        return {'path': path, 'data': [1, 2]}
+
+
+def test_topic_match():
+    key = 'KK.EVENT.ADMIN.testrealm.SUCCESS.GROUP_MEMBERSHIP.CREATE'
+    assert topic_match('KK.EVENT.ADMIN.#', key)
+    assert topic_match('KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#', key)
+    assert topic_match('KK.EVENT.ADMIN.*.SUCCESS.*.CREATE', key)
+    assert topic_match('#', key)
+    assert topic_match('KK.EVENT.ADMIN.testrealm.SUCCESS.GROUP_MEMBERSHIP.CREATE.#', key)
+    assert not topic_match('KK.EVENT.ADMIN.#.SUCCESS.USER.#', key)
+    assert not topic_match('KK.EVENT.ADMIN.*.CREATE', key)
+    assert not topic_match('KK.EVENT.CLIENT.#', key)
+
+
+@pytest.mark.asyncio
+async def test_snapshot_cache():
+    rc = FakeRestClient()
+    snapshot = RealmSnapshot(rc)
+
+    ret = await asyncio.gather(*(snapshot.request('GET', '/users') for _ in range(5)))
+    assert len(rc.calls) == 1
+    assert all(r == ret[0] for r in ret)
+
+    # responses are copies
+    ret[0]['data'].append(3)
+    assert (await snapshot.request('GET', '/users'))['data'] == [1, 2]
+    assert len(rc.calls) == 1
+
+    await snapshot.request('GET', '/groups')
+    assert len(rc.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_snapshot_invalidate():
+    rc = FakeRestClient()
+    snapshot = RealmSnapshot(rc)
+
+    await snapshot.request('GET', '/users')
+    await snapshot.request('PUT', '/users/1', {'firstName': 'foo'})
+    await snapshot.request('GET', '/users')
+    assert rc.calls == [('GET', '/users'), ('PUT', '/users/1'), ('GET', '/users')]
+
+    snapshot.invalidate()
+    await snapshot.request('GET', '/users')
+    assert len(rc.calls) == 4
+
+
+@pytest.mark.asyncio
+async def test_snapshot_get_args():
+    rc = FakeRestClient()
+    snapshot = RealmSnapshot(rc)
+
+    await snapshot.request('GET', '/users')
+    await snapshot.request('GET', '/users', {'a': 1})
+    await snapshot.request('GET', '/users', {'a': 1})
+    await snapshot.request('GET', '/users', {'a': 2})
+    await snapshot.request('GET', '/users')
+    assert len(rc.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_snapshot_invalidate_in_flight():
+    rc = FakeRestClient()
+    snapshot = RealmSnapshot(rc)
+
+    task = asyncio.create_task(snapshot.request('GET', '/users'))
+    await asyncio.sleep(.001)
+    await snapshot.request('PUT', '/users/1', {'firstName': 'foo'})
+    await task
+    # the GET that overlapped the write is redone, and the new result cached
+    assert rc.calls[:2] == [('GET', '/users'), ('PUT', '/users/1')]
+    assert rc.calls[2:] and set(rc.calls[2:]) == {('GET', '/users')}
+    num_calls = len(rc.calls)
+    await snapshot.request('GET', '/users')
+    assert len(rc.calls) == num_calls
+
+
+@pytest.mark.asyncio
+async def test_snapshot_invalidate_bounded():
+    class BusyRestClient(FakeRestClient):
+        async def request(self, method, path, args=None):
+            snapshot.invalidate()
+            return await super().request(method, path, args)
+
+    rc = BusyRestClient()
+    snapshot = RealmSnapshot(rc)
+    ret = await snapshot.request('GET', '/users')
+    assert ret['data'] == [1, 2]
+    assert len(rc.calls) == MAX_REFETCH + 1
+
+
+@pytest.mark.asyncio
+async def test_snapshot_error():
+    class ErrorRestClient(FakeRestClient):
+        async def request(self, method, path, args=None):
+            await super().request(method, path, args)
+            raise Exception()
+
+    rc = ErrorRestClient()
+    snapshot = RealmSnapshot(rc)
+    for _ in range(2):
+        with pytest.raises(Exception):
+            await snapshot.request('GET', '/users')
+    assert len(rc.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_hosted_action_concurrency():
+    running = []
+    max_running = []
+
+    async def action(message):
+        running.append(message)
+        max_running.append(len(running))
+        await asyncio.sleep(.01)
+        running.remove(message)
+
+    a = HostedAction('test', action, 'KK.EVENT.ADMIN.#', concurrency=2)
+    await asyncio.gather(*(a.submit(i) for i in range(6)))
+    assert len(max_running) == 6
+    assert max(max_running) == 2
+
+
+@pytest.mark.asyncio
+async def test_hosted_action_dedup():
+    messages = []
+
+    async def action(message):
+        messages.append(message)
+
+    a = HostedAction('test', action, 'KK.EVENT.ADMIN.#', dedup=.05)
+    for i in range(5):
+        await a.submit(i)
+    assert messages == []
+    await asyncio.sleep(.1)
+    assert messages == [4]
+
+
+@pytest.mark.asyncio
+async def test_hosted_action_error():
+    async def action(message):
+        raise Exception()
+
+    a = HostedAction('test', action, 'KK.EVENT.ADMIN.#')
+    await a.submit({})
+
+
+@pytest.mark.asyncio
+async def test_dispatch():
+    calls = {'a': [], 'b': []}
+
+    async def action_a(message):
+        calls['a'].append(message)
+
+    async def action_b(message):
+        calls['b'].append(message)
+
+    rc = FakeRestClient()
+    snapshot = RealmSnapshot(rc)
+    await snapshot.request('GET', '/users')
+
+    daemon = Daemon([
+        HostedAction('a', action_a, 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#'),
+        HostedAction('b', action_b, 'KK.EVENT.ADMIN.#.SUCCESS.USER.#'),
+    ], snapshot=snapshot)
+
+    await daemon.dispatch({'representation': 1}, 'KK.EVENT.ADMIN.realm.SUCCESS.USER.UPDATE')
+    assert calls == {'a': [], 'b': [{'representation': 1}]}
+
+    # event invalidates the snapshot
+    await snapshot.request('GET', '/users')
+    assert len(rc.calls) == 2
+
+
+def test_load_actions(monkeypatch, mocker):
+    monkeypatch.setenv('LDAP_URL', 'ldap://localhost')
+    monkeypatch.setenv('RABBITMQ_ROUTING_KEY', 'KK.EVENT.ADMIN.#')
+    # no listeners are created for hosted actions
+    mocker.patch('krs.rabbitmq.RabbitMQListener.__init__', side_effect=AssertionError)
+    config = [
+        {'action': 'create_posix_account', 'args': {'group_path': '/posix'}},
+        {'action': 'create_user_directory_ssh', 'concurrency': 2, 'dedup': 5,
+         'args': {'server': 'test.test.test', 'group_path': '/posix', 'root_dir': '/tmp'}},
+        {'action': 'update_ldap_shadow_expire'},
+    ]
+    ret = load_actions(config, keycloak_client=FakeRestClient())
+    assert [a.name for a in ret] == ['create_posix_account', 'create_user_directory_ssh', 'update_ldap_shadow_expire']
+    assert ret[0].routing_key == 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#'
+    assert ret[1].concurrency == 2
+    assert ret[1].dedup == 5
+    assert ret[2].routing_key == 'KK.EVENT.ADMIN.#.SUCCESS.USER.#'
@@ -0,0 +1,180 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+from actions.remote_agent import Agent, quota_commands
+from actions.util import agent_script, RemoteAgent, RemoteAgentError
+
+
+def user_dirs(root, *usernames):
+    return {u: {'path': str(root / u), 'uid': os.getuid(), 'gid': os.getgid(), 'username': u} for u in usernames}
+
+
+def test_ensure_dirs(tmp_path):
+    agent = Agent()
+    ret = agent.ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo', 'bar'))
+    assert ret == {'created': ['bar', 'foo']}
+    assert (tmp_path / 'foo').is_dir()
+
+    ret = agent.ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo', 'bar', 'baz'))
+    assert ret == {'created': ['baz']}
+
+
+def test_ensure_dirs_dryrun(tmp_path):
+    ret = Agent().ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo'), dryrun=True)
+    assert ret == {'created': ['foo']}
+    assert not (tmp_path / 'foo').exists()
+
+
+def test_ensure_dirs_cache(tmp_path, mocker):
+    (tmp_path / 'foo').mkdir()
+    agent = Agent()
+    listdir = mocker.spy(os, 'listdir')
+
+    for _ in range(3):
+        assert agent.ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo')) == {'created': []}
+    assert listdir.call_count == 1
+
+    # a change in the root dir refreshes the listing
+    agent.ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo', 'bar'))
+    agent.ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo', 'bar'))
+    assert listdir.call_count == 2
+
+
+def test_ensure_dirs_delta(tmp_path, mocker):
+    (tmp_path / 'foo').mkdir()
+    listdir = mocker.spy(os, 'listdir')
+    ret = Agent().ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo', 'bar'), full=False)
+    assert ret == {'created': ['bar']}
+    assert listdir.call_count == 0
+
+
+def test_quota_commands():
+    users = [{'uid': i, 'gid': i, 'username': f'u{i}'} for i in range(5)]
+    ret = quota_commands('/sbin/zfs set userquota@{uid}=15G homework/homework', users, batch_size=2)
+    assert ret == [
+        (['/sbin/zfs', 'set', 'userquota@0=15G', 'userquota@1=15G', 'homework/homework'], None),
+        (['/sbin/zfs', 'set', 'userquota@2=15G', 'userquota@3=15G', 'homework/homework'], None),
+        (['/sbin/zfs', 'set', 'userquota@4=15G', 'homework/homework'], None),
+    ]
+
+    ret = quota_commands('setfattr -v 1 /mnt/{username}; setfattr -v 2 /mnt/{username}', users[:2])
+    assert ret == [(['/bin/sh', '-e'], 'setfattr -v 1 /mnt/u0; setfattr -v 2 /mnt/u0\n'
+                                       'setfattr -v 1 /mnt/u1; setfattr -v 2 /mnt/u1\n')]
+
+    assert quota_commands('anything', []) == []
+
+
+def test_ensure_dirs_quota(tmp_path, mocker):
+    run = mocker.patch('subprocess.run')
+    agent = Agent()
+    agent.is_root = True
+    ret = agent.ensure_dirs(str(tmp_path), user_dirs(tmp_path, 'foo', 'bar', 'baz'),
+                            quota='/sbin/zfs set userquota@{uid}=1G tank/home')
+    assert ret == {'created': ['bar', 'baz', 'foo']}
+    assert run.call_count == 1
+    args = run.call_args[0][0]
+    assert args[:2] == ['/sbin/zfs', 'set'] and len(args) == 6
+
+    run.reset_mock()
+    agent.ensure_dirs(str(tmp_path / 'foo'), user_dirs(tmp_path / 'foo', 'a', 'b'), dryrun=True,
+                      quota='/sbin/zfs set userquota@{uid}=1G tank/home')
+    run.assert_not_called()
+
+
+@pytest.fixture
+def postfix(tmp_path, mocker):
+    postfix_dir = tmp_path / 'postfix'
+    postfix_dir.mkdir()
+    (postfix_dir / 'local_recipients').write_text('existing     OK\n')
+    mail_dir = tmp_path / 'mail'
+    mail_dir.mkdir()
+    check_call = mocker.patch('subprocess.check_call')
+    return Agent(postfix_dir=str(postfix_dir), mail_dir=str(mail_dir)), postfix_dir, check_call
+
+
+def test_ensure_mailboxes(postfix):
+    agent, postfix_dir, check_call = postfix
+    users = {
+        'existing': {'canonical': 'e.xisting', 'uid': os.getuid(), 'gid': os.getgid()},
+        'foo': {'canonical': 'f.oo', 'uid': os.getuid(), 'gid': os.getgid()},
+    }
+    assert agent.ensure_mailboxes(users) == {'added': ['foo']}
+    assert (postfix_dir / 'local_recipients').read_text() == 'existing     OK\nfoo     OK\n'
+    assert (postfix_dir / 'canonical_recipient').read_text() == 'f.oo     foo\n'
+    assert check_call.call_count == 4
+
+    assert agent.ensure_mailboxes(users) == {'added': []}
+    assert check_call.call_count == 4
+
+
+def test_ensure_mailboxes_incremental(postfix, mocker):
+    agent, postfix_dir, check_call = postfix
+    run = mocker.patch('subprocess.run')
+    users = {u: {'canonical': 'c.'+u, 'uid': os.getuid(), 'gid': os.getgid()} for u in ('existing', 'foo', 'bar')}
+    assert agent.ensure_mailboxes(users, incremental=True) == {'added': ['bar', 'foo']}
+    assert (postfix_dir / 'local_recipients').read_text() == 'existing     OK\nbar     OK\nfoo     OK\n'
+    check_call.assert_not_called()
+
+    assert run.call_count == 3
+    calls = {c[0][0][-1]: c[1]['input'] for c in run.call_args_list}
+    assert all(c[0][0][:2] == ['/usr/sbin/postmap', '-i'] for c in run.call_args_list)
+    assert calls[str(postfix_dir / 'canonical_sender')] == 'bar     c.bar\nfoo     c.foo\n'
+    assert calls[str(postfix_dir / 'local_recipients')] == 'bar     OK\nfoo     OK\n'
+
+
+def test_serve(tmp_path):
+    requests = [
+        {'op': 'ensure_dirs', 'args': {'root_dir': str(tmp_path), 'user_dirs': user_dirs(tmp_path, 'foo')}},
+        {'op': 'bad'},
+        {'op': 'ensure_dirs', 'args': {'root_dir': str(tmp_path / 'missing'), 'user_dirs': {}}},
+    ]
+    infile = io.StringIO(''.join(json.dumps(r)+'\n' for r in requests) + 'garbage\n')
+    outfile = io.StringIO()
+    Agent().serve(infile, outfile)
+
+    ret = [json.loads(line) for line in outfile.getvalue().split('\n') if line]
+    assert ret[0] == {'ok': True, 'result': {'created': ['foo']}}
+    assert [r['ok'] for r in ret] == [True, False, False, False]
+
+
+def test_agent_script(tmp_path):
+    script = agent_script('ensure_dirs', {'root_dir': str(tmp_path), 'user_dirs': user_dirs(tmp_path, 'foo')})
+    exec(script, {})
+    assert (tmp_path / 'foo').is_dir()
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    """An `ssh` that runs the remote command locally"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'ssh').write_text('#!/bin/sh\nwhile [ "$1" = "-o" ]; do shift 2; done\nshift\nexec sh -c "exec $*"\n')
+    (bin_dir / 'ssh').chmod(0o755)
+    (bin_dir / 'python').symlink_to(sys.executable)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+
+
+@pytest.mark.asyncio
+async def test_remote_agent(tmp_path, fake_ssh):
+    root = tmp_path / 'root'
+    root.mkdir()
+    agent = RemoteAgent('test.test.test')
+    try:
+        ret = await agent.request('ensure_dirs', root_dir=str(root), user_dirs=user_dirs(root, 'foo'))
+        assert ret == {'created': ['foo']}
+        assert (root / 'foo').is_dir()
+
+        with pytest.raises(RemoteAgentError):
+            await agent.request('ensure_dirs', root_dir=str(tmp_path / 'missing'), user_dirs={})
+
+        # restart after the agent dies
+        agent._proc.kill()
+        await agent._proc.wait()
+        ret = await agent.request('ensure_dirs', root_dir=str(root), user_dirs=user_dirs(root, 'foo', 'bar'))
+        assert ret == {'created': ['bar']}
+    finally:
+        await agent.close()
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+import time
+
+import pytest
+
+from actions import shadow
+from actions import update_ldap_shadow_expire
+
+
+TODAY = int(time.time()/3600/24)
+
+USERS = {
+    'ok': {'uid': 'ok', 'shadowExpire': TODAY+100, 'shadowMax': 180, 'shadowLastChange': TODAY-80},
+    'expiring': {'uid': 'expiring', 'shadowExpire': TODAY+10, 'shadowMax': 180, 'shadowLastChange': TODAY-170},
+    'expired': {'uid': 'expired', 'shadowExpire': TODAY, 'shadowMax': 180, 'shadowLastChange': TODAY-180},
+    'disabled': {'uid': 'disabled', 'shadowExpire': TODAY-365, 'shadowMax': 180, 'shadowLastChange': TODAY-545},
+    'changed': {'uid': 'changed', 'shadowExpire': TODAY+10, 'shadowMax': 180, 'shadowLastChange': TODAY},
+    'noexpire': {'uid': 'noexpire', 'shadowExpire': -1, 'shadowMax': 180, 'shadowLastChange': TODAY},
+    'nomax': {'uid': 'nomax', 'shadowExpire': TODAY+10, 'shadowLastChange': TODAY},
+    'none': {'uid': 'none'},
+}
+
+
+@pytest.fixture(params=['python', 'numpy'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(shadow, 'np', None)
+    return request.param
+
+
+def test_classify_expiry(backend):
+    table = shadow.build_table(USERS)
+    expiring, expired, disabled = shadow.classify_expiry(table, today=TODAY)
+
+    assert list(expiring) == ['changed', 'expiring']
+    assert list(expired) == ['expired']
+    assert list(disabled) == ['disabled']
+    assert expiring['expiring'] == (datetime.utcnow() + timedelta(days=10)).date()
+
+
+def test_classify_expiry_usernames(backend):
+    table = shadow.build_table(USERS, ['expired', 'ok'])
+    assert table.uids == ['expired', 'ok']
+    expiring, expired, disabled = shadow.classify_expiry(table, today=TODAY)
+    assert not expiring
+    assert list(expired) == ['expired']
+    assert not disabled
+
+
+def test_expiry_updates(backend):
+    table = shadow.build_table(USERS)
+    assert shadow.expiry_updates(table) == {'changed': TODAY+180}
+
+
+def test_empty(backend):
+    table = shadow.build_table({})
+    assert shadow.classify_expiry(table) == ({}, {}, {})
+    assert shadow.expiry_updates(table) == {}
+
+
+class FakeEntry:
+    def __init__(self, attrs):
+        self.entry_attributes_as_dict = {k: [v] for k, v in attrs.items()}
+        self.entry_attributes_as_dict['mail'] = []
+
+
+def test_get_shadow_users(mocker):
+    ldap_client = mocker.MagicMock()
+    ldap_client.get_user.return_value = FakeEntry(USERS['changed'])
+
+    ret = shadow.get_shadow_users(ldap_client, 'changed')
+    assert ret == {'changed': USERS['changed']}
+    ldap_client.get_user.assert_called_once_with('changed', attrs=shadow.SHADOW_ATTRS)
+    ldap_client.list_users.assert_not_called()
+
+    shadow.get_shadow_users(ldap_client)
+    ldap_client.list_users.assert_called_once_with(shadow.SHADOW_ATTRS)
+
+
+@pytest.mark.asyncio
+async def test_update_ldap_shadow_expire(mocker):
+    ldap_client = mocker.MagicMock()
+    ldap_client.list_users.return_value = USERS
+    ldap_client.modify_users.return_value = {'changed': None}
+
+    await update_ldap_shadow_expire.process(ldap_client=ldap_client)
+    ldap_client.modify_users.assert_called_once_with({'changed': {'shadowExpire': TODAY+180}})
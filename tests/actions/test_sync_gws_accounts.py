@@ -1,7 +1,15 @@
+import asyncio
+import time
 from unittest.mock import MagicMock
 
+import pytest
+
+from actions import sync_gws_accounts
 from actions.sync_gws_accounts import create_missing_eligible_accounts
 from actions.sync_gws_accounts import get_gws_accounts
+from actions.sync_gws_accounts import insert_accounts
+from actions.sync_gws_accounts import GwsIndex
+from actions.sync_gws_accounts import plan_changes, apply_plan
 
 
 class MockHttpRequest:
@@ -66,3 +74,275 @@ def test_create_missing_eligible_accounts():
     ret = create_missing_eligible_accounts(MockGwsResource(), GWS_ACCOUNTS, LDAP_ACCOUNTS,
                                            KC_ACCOUNTS, dryrun=False)
     assert ret == ['add-to-gws']
+
+
+class MockBatch:
+    def __init__(self, batches, callback):
+        self.requests = []
+        self.callback = callback
+        batches.append(self.requests)
+
+    def add(self, request, request_id):
+        self.requests.append(request_id)
+
+    def execute(self):
+        for request_id in self.requests:
+            self.callback(request_id, {}, Exception() if request_id.endswith('bad') else None)
+
+
+def test_insert_accounts_batched():
+    batches = []
+    bodies = [{'primaryEmail': f'{u}@i.w.e'} for u in ('a', 'b', 'bad', 'c', 'd')]
+    failed = insert_accounts(MockGwsResource(), bodies, batch_size=2,
+                             new_batch=lambda callback: MockBatch(batches, callback))
+    assert batches == [['a', 'b'], ['bad', 'c'], ['d']]
+    assert failed == ['bad']
+
+
+def test_create_missing_eligible_accounts_batched():
+    batches = []
+    ret = create_missing_eligible_accounts(MockGwsResource(), GWS_ACCOUNTS, LDAP_ACCOUNTS, KC_ACCOUNTS, dryrun=False,
+                                           new_batch=lambda callback: MockBatch(batches, callback))
+    assert ret == ['add-to-gws']
+    assert batches == [['add-to-gws']]
+
+    batches.clear()
+    create_missing_eligible_accounts(MockGwsResource(), GWS_ACCOUNTS, LDAP_ACCOUNTS, KC_ACCOUNTS, dryrun=True,
+                                     new_batch=lambda callback: MockBatch(batches, callback))
+    assert batches == []
+
+
+@pytest.mark.asyncio
+async def test_process(mocker):
+    async def list_users(rest_client=None):
+        return KC_ACCOUNTS
+    mocker.patch('actions.sync_gws_accounts.list_users', list_users)
+    mocker.patch('actions.sync_gws_accounts.get_gws_accounts', return_value=GWS_ACCOUNTS)
+    create = mocker.patch('actions.sync_gws_accounts.create_missing_eligible_accounts')
+    ldap_client = MagicMock()
+    ldap_client.list_users = MagicMock(return_value=LDAP_ACCOUNTS)
+
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, batch_size=10)
+    ldap_client.list_users.assert_called_once_with(attrs=['shadowExpire'])
+    args = create.call_args
+    assert args[0][1:] == (GWS_ACCOUNTS, LDAP_ACCOUNTS, KC_ACCOUNTS, False)
+    assert args[1]['batch_size'] == 10
+
+
+def test_gws_index(tmp_path):
+    path = str(tmp_path / 'index.json')
+    index = GwsIndex(path, max_age=60)
+    assert index.stale()
+
+    gws_users_client = MagicMock()
+    gws_users_client.list().execute.return_value = {'users': [
+        {'primaryEmail': 'foo@i.w.e', 'etag': '1', 'suspended': False}]}
+    gws_users_client.list_next.return_value = None
+    assert index.refresh(gws_users_client) == {'foo': {'primaryEmail': 'foo@i.w.e', 'etag': '1'}}
+    assert gws_users_client.list.call_args[1]['fields'] == 'nextPageToken,users(primaryEmail,etag)'
+    assert not index.stale()
+
+    index.update('bar', {'primaryEmail': 'bar@i.w.e'})
+    index2 = GwsIndex(path, max_age=60)
+    assert not index2.stale()
+    assert set(index2.users) == {'foo', 'bar'}
+
+    index2.update('foo', None)
+    assert set(GwsIndex(path).users) == {'bar'}
+
+
+@pytest.fixture
+def single_user(mocker):
+    async def user_info(username, rest_client=None):
+        if username not in KC_ACCOUNTS:
+            raise sync_gws_accounts.UserDoesNotExist()
+        return KC_ACCOUNTS[username]
+    mocker.patch('actions.sync_gws_accounts.user_info', user_info)
+    get_account = mocker.patch('actions.sync_gws_accounts.get_gws_account',
+                               side_effect=lambda client, username: GWS_ACCOUNTS.get(username))
+    insert = mocker.patch('actions.sync_gws_accounts.insert_accounts', return_value=[])
+
+    ldap_client = MagicMock()
+
+    def get_user(username, attrs=None):
+        if username not in LDAP_ACCOUNTS:
+            raise KeyError()
+        entry = MagicMock()
+        entry.entry_attributes_as_dict = {k: [v] for k, v in LDAP_ACCOUNTS[username].items()}
+        return entry
+    ldap_client.get_user = get_user
+    return ldap_client, get_account, insert
+
+
+@pytest.mark.asyncio
+async def test_process_user(single_user):
+    ldap_client, get_account, insert = single_user
+    index = GwsIndex()
+    index.updated = float('inf')
+
+    await sync_gws_accounts.process_user('add-to-gws', MockGwsResource(), ldap_client, None, index=index)
+    assert insert.call_count == 1
+    assert insert.call_args[0][1][0]['primaryEmail'] == 'add-to-gws@icecube.wisc.edu'
+    assert 'add-to-gws' in index.users
+
+    # now in the index, so no lookups at all
+    await sync_gws_accounts.process_user('add-to-gws', MockGwsResource(), ldap_client, None, index=index)
+    assert get_account.call_count == 1
+    assert insert.call_count == 1
+
+    await sync_gws_accounts.process_user('already-in-gws', MockGwsResource(), ldap_client, None, index=index)
+    assert 'already-in-gws' in index.users
+    for username in ('ineligible-nologin', 'expired-shadow', 'missing-name', 'not-in-keycloak'):
+        await sync_gws_accounts.process_user(username, MockGwsResource(), ldap_client, None, index=index)
+    assert insert.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_process_user_serial_gws_calls(single_user):
+    ldap_client, get_account, insert = single_user
+    active = []
+
+    def get_gws_account(client, username):
+        active.append(username)
+        assert len(active) == 1, 'concurrent Google API calls'
+        time.sleep(.01)
+        active.remove(username)
+        return GWS_ACCOUNTS.get(username)
+    get_account.side_effect = get_gws_account
+
+    await asyncio.gather(*(sync_gws_accounts.process_user(username, MockGwsResource(), ldap_client, None, index=GwsIndex())
+                           for username in KC_ACCOUNTS))
+    assert get_account.call_count == len(KC_ACCOUNTS)
+
+
+@pytest.mark.asyncio
+async def test_process_index(mocker):
+    async def list_users(rest_client=None):
+        return KC_ACCOUNTS
+    mocker.patch('actions.sync_gws_accounts.list_users', list_users)
+    get_accounts = mocker.patch('actions.sync_gws_accounts.get_gws_accounts', return_value=GWS_ACCOUNTS)
+    ldap_client = MagicMock()
+    ldap_client.list_users = MagicMock(return_value=LDAP_ACCOUNTS)
+
+    index = GwsIndex()
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, index=index)
+    assert get_accounts.call_count == 1
+    assert set(index.users) == {'gws-only-account', 'already-in-gws', 'add-to-gws'}
+
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, index=index)
+    assert get_accounts.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_process_index_saves_once(mocker, tmp_path):
+    kc_accounts = {f'user{i}': KC_ACCOUNTS['add-to-gws'] for i in range(20)}
+    ldap_accounts = {u: {'shadowExpire': 99999} for u in kc_accounts}
+
+    async def list_users(rest_client=None):
+        return kc_accounts
+    mocker.patch('actions.sync_gws_accounts.list_users', list_users)
+    mocker.patch('actions.sync_gws_accounts.get_gws_accounts', return_value={})
+    mocker.patch('actions.sync_gws_accounts.insert_accounts', return_value=[])
+    ldap_client = MagicMock()
+    ldap_client.list_users = MagicMock(return_value=ldap_accounts)
+
+    index = GwsIndex(str(tmp_path / 'index.json'))
+    save = mocker.spy(index, 'save')
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, index=index)
+    assert set(index.users) == set(kc_accounts)
+    # one save for the full listing, one for all the created accounts
+    assert save.call_count == 2
+    assert set(GwsIndex(str(tmp_path / 'index.json')).users) == set(kc_accounts)
+
+
+def test_plan_changes():
+    kc_accounts = dict(KC_ACCOUNTS)
+    kc_accounts['renamed'] = {'attributes': {'loginShell': '/bin/bash'}, 'enabled': True, 'firstName': 'New', 'lastName': 'Ln'}
+    kc_accounts['disabled'] = {'attributes': {'loginShell': '/bin/bash'}, 'enabled': False, 'firstName': 'Fn', 'lastName': 'Ln'}
+    kc_accounts['not-in-ldap'] = {'attributes': {'loginShell': '/bin/bash'}, 'enabled': False, 'firstName': 'Fn', 'lastName': 'Ln'}
+    kc_accounts['already-suspended'] = {'attributes': {'loginShell': '/sbin/nologin'}, 'enabled': True, 'firstName': 'Fn', 'lastName': 'Ln'}
+    ldap_accounts = dict(LDAP_ACCOUNTS, renamed={'shadowExpire': 99999}, disabled={'shadowExpire': 99999},
+                         **{'already-suspended': {'shadowExpire': 99999}})
+    name = {'givenName': 'Fn', 'familyName': 'Ln'}
+    gws_accounts = {
+        'gws-only-account': {'primaryEmail': 'gws-only-account@i.w.e', 'suspended': False, 'name': name},
+        'already-in-gws': {'primaryEmail': 'already-in-gws@i.w.e', 'suspended': False, 'name': name},
+        'renamed': {'primaryEmail': 'renamed@i.w.e', 'suspended': False, 'name': name},
+        'disabled': {'primaryEmail': 'disabled@i.w.e', 'suspended': False, 'name': name},
+        'not-in-ldap': {'primaryEmail': 'not-in-ldap@i.w.e', 'suspended': False, 'name': name},
+        'already-suspended': {'primaryEmail': 'already-suspended@i.w.e', 'suspended': True, 'name': name},
+        'expired-shadow': {'primaryEmail': 'expired-shadow@i.w.e', 'suspended': False, 'name': name},
+    }
+
+    plan = plan_changes(kc_accounts, ldap_accounts, gws_accounts)
+    assert [b['primaryEmail'] for b in plan['create']] == ['add-to-gws@icecube.wisc.edu']
+    assert plan['update'] == [('renamed', {'name': {'givenName': 'New', 'familyName': 'Ln'}})]
+    assert plan['suspend'] == ['disabled', 'expired-shadow']
+
+
+def test_plan_changes_no_shadow_expire():
+    kc_accounts = {
+        'no-shadow-expire': KC_ACCOUNTS['no-shadow-expire'],
+        'disabled': dict(KC_ACCOUNTS['no-shadow-expire'], enabled=False),
+    }
+    ldap_accounts = {'no-shadow-expire': {}, 'disabled': {}}
+    gws_accounts = {
+        'no-shadow-expire': {'primaryEmail': 'no-shadow-expire@i.w.e', 'suspended': False},
+        'disabled': {'primaryEmail': 'disabled@i.w.e', 'suspended': False},
+    }
+
+    plan = plan_changes(kc_accounts, ldap_accounts, gws_accounts)
+    assert plan['suspend'] == ['disabled']
+
+
+def test_apply_plan():
+    batches = []
+    plan = {
+        'create': [{'primaryEmail': 'a@icecube.wisc.edu'}],
+        'update': [('b', {'name': {'givenName': 'B', 'familyName': 'B'}})],
+        'suspend': ['c', 'bad'],
+    }
+    gws_users_client = MagicMock()
+    ret = apply_plan(gws_users_client, plan, batch_size=3, rate=1000,
+                     new_batch=lambda callback: MockBatch(batches, callback))
+    assert batches == [['create:a', 'update:b', 'suspend:c'], ['suspend:bad']]
+    assert ret == {'create': ['a'], 'update': ['b'], 'suspend': ['c']}
+    gws_users_client.patch.assert_any_call(userKey='c@icecube.wisc.edu', body={'suspended': True})
+
+
+@pytest.mark.asyncio
+async def test_process_reconcile(mocker):
+    async def list_users(rest_client=None):
+        return KC_ACCOUNTS
+    mocker.patch('actions.sync_gws_accounts.list_users', list_users)
+    get_accounts = mocker.patch('actions.sync_gws_accounts.get_gws_accounts', return_value=GWS_ACCOUNTS)
+    apply = mocker.patch('actions.sync_gws_accounts.apply_plan')
+    ldap_client = MagicMock()
+    ldap_client.list_users = MagicMock(return_value=LDAP_ACCOUNTS)
+
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, reconcile=True, dryrun=True)
+    assert get_accounts.call_args[1]['fields'] == sync_gws_accounts.GWS_RECONCILE_FIELDS
+    apply.assert_not_called()
+
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, reconcile=True)
+    plan = apply.call_args[0][1]
+    assert [b['primaryEmail'] for b in plan['create']] == ['add-to-gws@icecube.wisc.edu']
+
+
+@pytest.mark.asyncio
+async def test_process_reconcile_max_suspend(mocker):
+    async def list_users(rest_client=None):
+        return {'expired-shadow': KC_ACCOUNTS['expired-shadow']}
+    mocker.patch('actions.sync_gws_accounts.list_users', list_users)
+    mocker.patch('actions.sync_gws_accounts.get_gws_accounts', return_value={
+        'expired-shadow': {'primaryEmail': 'expired-shadow@i.w.e', 'suspended': False}})
+    apply = mocker.patch('actions.sync_gws_accounts.apply_plan')
+    ldap_client = MagicMock()
+    ldap_client.list_users = MagicMock(return_value=LDAP_ACCOUNTS)
+
+    with pytest.raises(Exception):
+        await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, reconcile=True, max_suspend=0)
+    apply.assert_not_called()
+
+    await sync_gws_accounts.process(MockGwsResource(), ldap_client, None, reconcile=True, max_suspend=1)
+    assert apply.call_args[0][1]['suspend'] == ['expired-shadow']
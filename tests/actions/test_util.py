@@ -1,5 +1,7 @@
 import pytest
-from actions.util import ssh, scp_and_run, scp_and_run_sudo
+import subprocess
+
+from actions.util import ssh, scp_and_run, scp_and_run_sudo, run_remote_script, ProvisionedState
 
 from .util import TestException
 
@@ -47,3 +49,58 @@ def test_scp_and_run_sudo_error(mocker):
 
     with pytest.raises(TestException):
         scp_and_run_sudo('test.test.test', 'data data data')
+
+@pytest.fixture
+def patch_subprocess_exec(mocker):
+    proc = mocker.MagicMock()
+    proc.communicate = mocker.AsyncMock(return_value=(None, None))
+    proc.returncode = 0
+    return mocker.patch('asyncio.create_subprocess_exec', return_value=proc)
+
+@pytest.mark.asyncio
+async def test_run_remote_script(patch_subprocess_exec):
+    await run_remote_script('test.test.test', 'data data data')
+
+    patch_subprocess_exec.assert_called_once()
+    cmd = patch_subprocess_exec.call_args.args
+    assert cmd[0] == 'ssh'
+    assert 'ControlMaster=auto' in cmd
+    assert cmd[-3:] == ('test.test.test', 'python', '-')
+    proc = patch_subprocess_exec.return_value
+    proc.communicate.assert_called_once_with(b'data data data')
+
+@pytest.mark.asyncio
+async def test_run_remote_script_sudo(patch_subprocess_exec):
+    await run_remote_script('test.test.test', 'data data data', sudo=True)
+
+    cmd = patch_subprocess_exec.call_args.args
+    assert cmd[-4:] == ('test.test.test', 'sudo', 'python', '-')
+
+@pytest.mark.asyncio
+async def test_run_remote_script_error(patch_subprocess_exec):
+    patch_subprocess_exec.return_value.returncode = 1
+
+    with pytest.raises(subprocess.CalledProcessError):
+        await run_remote_script('test.test.test', 'data data data')
+
+def test_provisioned_state(tmp_path):
+    path = str(tmp_path / 'state.json')
+    state = ProvisionedState(path)
+    assert state.known('host:/root') is None
+
+    # partial updates wait for a full verification
+    state.update('host:/root', ['foo'])
+    assert state.known('host:/root') is None
+
+    state.update('host:/root', ['foo', 'bar'], verified=True)
+    state.update('host:/root', ['baz'])
+    assert state.known('host:/root') == {'foo', 'bar', 'baz'}
+
+    state = ProvisionedState(path)
+    assert state.known('host:/root') == {'foo', 'bar', 'baz'}
+    assert state.known('host:/other') is None
+
+def test_provisioned_state_verify(tmp_path):
+    state = ProvisionedState(verify_interval=0)
+    state.update('host:/root', ['foo'], verified=True)
+    assert state.known('host:/root') is None
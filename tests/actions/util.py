@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 import actions.util
@@ -11,4 +13,9 @@ def patch_ssh(mocker):
 
 @pytest.fixture
 def patch_ssh_sudo(mocker):
-    return mocker.patch('actions.util.scp_and_run_sudo')
+    return mocker.patch('actions.util.run_remote_script')
+
+def agent_script_request(script):
+    """Get the request from a one-shot remote agent script"""
+    line = [l for l in script.split('\n') if l.startswith('REQUEST = ')][0]
+    return json.loads(json.loads(line.split('(', 1)[-1].rsplit(')', 1)[0]))
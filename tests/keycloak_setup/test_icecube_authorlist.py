@@ -0,0 +1,103 @@
+from keycloak_setup.icecube_authorlist import normalize, parse_authorlist, AuthorMatcher
+
+
+AUTHORLIST_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<collaborationauthorlist xmlns:foaf="http://xmlns.com/foaf/0.1/"
+                         xmlns:cal="http://inspirehep.net/info/HepNames/tools/authors_xml/">
+  <cal:organizations>
+    <foaf:Organization id="a1"><foaf:name>Univ A</foaf:name></foaf:Organization>
+    <foaf:Organization id="a2"><foaf:name>Univ B</foaf:name></foaf:Organization>
+  </cal:organizations>
+  <cal:authors>
+    <foaf:Person>
+      <foaf:givenName>Jane</foaf:givenName>
+      <foaf:familyName>Doe</foaf:familyName>
+      <cal:authorNamePaper>J. Doe</cal:authorNamePaper>
+      <cal:authorAffiliations>
+        <cal:authorAffiliation organizationid="a1"/>
+        <cal:authorAffiliation organizationid="a2" connection="AlsoAt"/>
+      </cal:authorAffiliations>
+      <cal:authorids>
+        <cal:authorid source="INTERNAL">jdoe@icecube.wisc.edu</cal:authorid>
+        <cal:authorid source="ORCID">0000-0000</cal:authorid>
+      </cal:authorids>
+    </foaf:Person>
+    <foaf:Person>
+      <foaf:givenName>Jürgen</foaf:givenName>
+      <foaf:familyName>Müller</foaf:familyName>
+      <cal:authorNamePaper>J. Müller</cal:authorNamePaper>
+      <cal:authorAffiliations>
+        <cal:authorAffiliation organizationid="a2"/>
+      </cal:authorAffiliations>
+    </foaf:Person>
+  </cal:authors>
+</collaborationauthorlist>
+'''
+
+
+def test_normalize():
+    assert normalize('J. Müller-Smith') == 'jmullersmith'
+    assert normalize(None) == ''
+
+
+def test_parse_authorlist():
+    insts, authors = parse_authorlist(AUTHORLIST_XML)
+    assert insts == {'a1': 'Univ A', 'a2': 'Univ B'}
+    assert authors == [
+        {'first': 'Jane', 'last': 'Doe', 'author': 'J. Doe', 'insts': ['a1'], 'thanks': ['a2'],
+         'email': ['jdoe@icecube.wisc.edu']},
+        {'first': 'Jürgen', 'last': 'Müller', 'author': 'J. Müller', 'insts': ['a2'], 'thanks': [],
+         'email': []},
+    ]
+
+
+def author(first='Jane', last='Doe', name='J. Doe', email=None):
+    return {'first': first, 'last': last, 'author': name, 'insts': [], 'thanks': [], 'email': email or []}
+
+
+KEYCLOAK_USERS = {
+    'jdoe': {'username': 'jdoe', 'firstName': 'Jane', 'lastName': 'Doe', 'attributes': {}},
+    'jdoe2': {'username': 'jdoe2', 'firstName': 'John', 'lastName': 'Doe', 'attributes': {}},
+    'named': {'username': 'named', 'firstName': 'X', 'lastName': 'Y', 'attributes': {'author_name': 'A. Author'}},
+    'jmuller': {'username': 'jmuller', 'firstName': 'Jurgen', 'lastName': 'Muller', 'attributes': {}},
+    'other': {'username': 'other', 'firstName': 'Other', 'lastName': 'Person'},
+}
+
+
+def test_match_author_name():
+    matcher = AuthorMatcher(KEYCLOAK_USERS)
+    assert matcher.match(author(first='Q', last='Q', name='A. Author'))['username'] == 'named'
+
+
+def test_match_email():
+    matcher = AuthorMatcher(KEYCLOAK_USERS)
+    assert matcher.match(author(first='Q', last='Q', email=['jdoe2@icecube.wisc.edu']))['username'] == 'jdoe2'
+    # other domains and unknown usernames do not match
+    assert matcher.match(author(first='Q', last='Q', email=['jdoe2@example.com'])) is None
+    assert matcher.match(author(first='Q', last='Q', email=['nobody@icecube.wisc.edu', None])) is None
+
+
+def test_match_full_name():
+    matcher = AuthorMatcher(KEYCLOAK_USERS)
+    # last name alone is ambiguous, first name decides
+    assert matcher.match(author(first='John', last='Doe'))['username'] == 'jdoe2'
+    assert matcher.match(author(first='Jürgen', last='Müller'))['username'] == 'jmuller'
+
+
+def test_match_last_name():
+    matcher = AuthorMatcher(KEYCLOAK_USERS)
+    assert matcher.match(author(first='Ottie', last='Person'))['username'] == 'other'
+
+
+def test_match_ambiguous():
+    matcher = AuthorMatcher(KEYCLOAK_USERS)
+    # two users named Doe, and no first name, author name, or email match
+    assert matcher.match(author(first='Jim', last='Doe')) is None
+    assert matcher.match(author(first='Jim', last='Nobody')) is None
+
+
+def test_match_ambiguous_author_name():
+    users = dict(KEYCLOAK_USERS, named2=dict(KEYCLOAK_USERS['named'], username='named2'))
+    matcher = AuthorMatcher(users)
+    # falls through to the (unique) full name
+    assert matcher.match(author(first='Jane', last='Doe', name='A. Author'))['username'] == 'jdoe'
@@ -0,0 +1,144 @@
+import pytest
+
+from keycloak_setup.icecube_ldap import get_keycloak_snapshot, apply_membership_changes
+from keycloak_setup.icecube_ldap import import_ldap_groups, index_users_by_o
+
+from benchmarks.fake_keycloak import FakeKeycloak
+
+
+def test_index_users_by_o():
+    ldap_users = {
+        'single': {'o': 'o=A'},
+        'multi': {'o': ['o=A', 'o=B']},
+        'missing': {},
+        'empty': {'o': []},
+    }
+    assert index_users_by_o(ldap_users) == {
+        'o=A': ['multi', 'single'],
+        'o=B': ['multi'],
+    }
+
+
+class RecordingKeycloak(FakeKeycloak):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log = []
+
+    async def request(self, method, path, args=None):
+        if method != 'GET':
+            self.log.append((method, path))
+        return await super().request(method, path, args)
+
+
+class FakeLDAP:
+    def __init__(self, users, groups):
+        self.users = users
+        self.groups = groups
+
+    def list_users(self, attrs=None):
+        return self.users
+
+    def list_groups(self, groupbase=None, attrs=None):
+        return self.groups
+
+
+def make_keycloak():
+    kc = RecordingKeycloak()
+    kc.add_group('/posix')
+    kc.add_group('/posix/sub')
+    for i in range(5):
+        kc.add_user({'username': f'user{i}', 'attributes': {'uidNumber': [str(1000+i)], 'mail': ['a', 'b']}})
+    return kc
+
+
+@pytest.mark.asyncio
+async def test_get_keycloak_snapshot():
+    kc = make_keycloak()
+    kc.members[kc.group_id('/posix')].update(kc.user_id(u) for u in ('user1', 'user2'))
+
+    ret = await get_keycloak_snapshot(kc, ['/posix', '/posix/sub', '/missing'], page_size=2, details=True)
+    assert set(ret['groups']) == {'/posix', '/posix/sub'}
+    assert ret['users'] == {f'user{i}': kc.user_id(f'user{i}') for i in range(5)}
+    assert ret['members'] == {'/posix': {'user1', 'user2'}, '/posix/sub': set()}
+    assert ret['user_details']['user0']['attributes'] == {'uidNumber': '1000', 'mail': ['a', 'b']}
+    assert kc.writes == 0
+
+
+@pytest.mark.asyncio
+async def test_apply_membership_changes():
+    kc = make_keycloak()
+    posix, sub = kc.group_id('/posix'), kc.group_id('/posix/sub')
+    kc.members[posix].add(kc.user_id('user0'))
+    kc.members[sub].add(kc.user_id('user1'))
+    snapshot = await get_keycloak_snapshot(kc, ['/posix', '/posix/sub'])
+
+    adds = [('/posix/sub', 'user2'), ('/posix', 'user2'), ('/posix', 'user1')]
+    removes = [('/posix', 'user0')]
+    await apply_membership_changes(snapshot, adds, removes, concurrency=1, keycloak_conn=kc)
+
+    assert kc.members[posix] == {kc.user_id('user1'), kc.user_id('user2')}
+    assert kc.members[sub] == {kc.user_id('user1'), kc.user_id('user2')}
+    assert snapshot['members'] == {'/posix': {'user1', 'user2'}, '/posix/sub': {'user1', 'user2'}}
+
+    # removes first, then parents before children (KEYCLOAK-11298)
+    user1, user2 = kc.user_id('user1'), kc.user_id('user2')
+    assert kc.log == [
+        ('DELETE', f'/users/{kc.user_id("user0")}/groups/{posix}'),
+        ('PUT', f'/users/{user2}/groups/{posix}'),
+        ('DELETE', f'/users/{user1}/groups/{sub}'),
+        ('PUT', f'/users/{user1}/groups/{posix}'),
+        ('PUT', f'/users/{user1}/groups/{sub}'),
+        ('PUT', f'/users/{user2}/groups/{sub}'),
+    ]
+
+
+LDAP_USERS = {
+    'user0': {'uid': 'user0', 'loginShell': '/bin/bash'},
+    'user1': {'uid': 'user1', 'loginShell': '/bin/bash'},
+    'user2': {'uid': 'user2', 'loginShell': '/sbin/nologin'},
+    'user3': {'uid': 'user3'},
+    'not-in-keycloak': {'uid': 'not-in-keycloak', 'loginShell': '/bin/bash'},
+}
+
+LDAP_GROUPS = {
+    'group1': {'cn': 'group1', 'gidNumber': '20001', 'memberUid': ['user1', 'user3', 'not-in-keycloak']},
+    'sub': {'cn': 'sub', 'gidNumber': '20002', 'memberUid': ['user0']},
+    'empty': {'cn': 'empty', 'gidNumber': '20003'},
+    'user0': {'cn': 'user0', 'gidNumber': '20004', 'memberUid': 'user0'},
+}
+
+
+@pytest.mark.asyncio
+async def test_import_ldap_groups(mocker):
+    mocker.patch('keycloak_setup.icecube_ldap.LDAP', lambda: FakeLDAP(LDAP_USERS, LDAP_GROUPS))
+    kc = make_keycloak()
+    posix = kc.group_id('/posix')
+    kc.members[posix].update(kc.user_id(u) for u in ('user1', 'user2'))
+
+    await import_ldap_groups(kc, ldap_setup=False)
+
+    assert kc.members[posix] == {kc.user_id('user0'), kc.user_id('user1')}
+    group1 = kc.group_id('/posix/group1')
+    assert kc.groups[group1]['attributes'] == {'gidNumber': ['20001']}
+    assert kc.members[group1] == {kc.user_id('user1'), kc.user_id('user3')}
+    # existing, empty, and 1:1 user groups are skipped
+    assert kc.members[kc.group_id('/posix/sub')] == set()
+    assert kc.group_id('/posix/empty') is None
+    assert kc.group_id('/posix/user0') is None
+
+    # second run has nothing to do
+    kc.writes = 0
+    await import_ldap_groups(kc, ldap_setup=False)
+    assert kc.writes == 0
+
+
+@pytest.mark.asyncio
+async def test_import_ldap_groups_dryrun(mocker):
+    mocker.patch('keycloak_setup.icecube_ldap.LDAP', lambda: FakeLDAP(LDAP_USERS, LDAP_GROUPS))
+    kc = FakeKeycloak()
+    for username in LDAP_USERS:
+        kc.add_user({'username': username})
+
+    await import_ldap_groups(kc, ldap_setup=False, dryrun=True)
+    assert kc.writes == 0
+    assert kc.groups == {}
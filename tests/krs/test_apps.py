@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 import pytest
@@ -94,3 +95,347 @@ async def test_get_public_token(keycloak_bootstrap):
     ret = apps.get_public_token(username='testuser', password='foo', scopes=['testapp'], openid_url=url)
     assert ret['scope'] == 'testapp'
     assert ret['roles'] == {'testapp': ['read']}
+
+
+class FakeRoleClient:
+    """Fake rest client with a few groups mapped to app roles."""
+    def __init__(self, reverse_lookup=True):
+        self.reverse_lookup = reverse_lookup
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.groups = {f'/inst/g{i}': f'id{i}' for i in range(10)}
+        self.groups['/other'] = 'other'
+        self.mappings = {'id1': ['read'], 'id3': ['read', 'write'], 'other': ['read']}
+
+    async def request(self, method, path, args=None):
+        self.calls.append(path)
+        if path.startswith('/clients?clientId='):
+            return [{'id': 'cid'}]
+        if path == '/clients/cid/client-secret':
+            return {}
+        if path == '/clients/cid/roles':
+            return [{'name': 'read'}, {'name': 'write'}]
+        if path.startswith('/groups?'):
+            return [
+                {'id': 'inst', 'name': 'inst', 'path': '/inst', 'subGroups': [
+                    {'id': gid, 'name': p.split('/')[-1], 'path': p, 'subGroups': []}
+                    for p, gid in self.groups.items() if p.startswith('/inst/')]},
+                {'id': 'other', 'name': 'other', 'path': '/other', 'subGroups': []},
+            ]
+        if path.startswith('/clients/cid/roles/'):
+            if not self.reverse_lookup:
+                raise Exception('404')
+            role = path.split('/')[4].split('?')[0]
+            first = int(path.split('first=')[1].split('&')[0])
+            max_ = int(path.split('max=')[1].split('&')[0])
+            ret = [{'path': p} for p, gid in sorted(self.groups.items()) if role in self.mappings.get(gid, [])]
+            return ret[first:first+max_]
+        if path.startswith('/groups/'):
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(.01)
+            self.running -= 1
+            gid = path.split('/')[2]
+            return [{'name': r} for r in self.mappings.get(gid, [])]
+        raise Exception(f'unexpected {path}')
+
+
+@pytest.mark.asyncio
+async def test_get_app_role_mappings_scan():
+    rc = FakeRoleClient()
+    ret = await apps.get_app_role_mappings('testapp', concurrency=3, rest_client=rc)
+    assert ret == {'read': ['/inst/g1', '/inst/g3', '/other'], 'write': ['/inst/g3']}
+    assert rc.max_running == 3
+
+    ret = await apps.get_app_role_mappings('testapp', group_path='/inst', rest_client=rc)
+    assert ret == {'read': ['/inst/g1', '/inst/g3'], 'write': ['/inst/g3']}
+
+
+@pytest.mark.asyncio
+async def test_get_app_role_mappings_reverse_lookup(monkeypatch):
+    rc = FakeRoleClient()
+    ret = await apps.get_app_role_mappings('testapp', role='read', rest_client=rc)
+    assert ret == {'read': ['/inst/g1', '/inst/g3', '/other']}
+    assert not any(c.startswith('/groups') for c in rc.calls)
+
+    ret = await apps.get_app_role_mappings('testapp', role='read', group_path='/inst', rest_client=rc)
+    assert ret == {'read': ['/inst/g1', '/inst/g3']}
+
+    # paging
+    rc.calls = []
+    ret = await apps._get_role_groups('cid', 'read', max_results=2, rest_client=rc)
+    assert ret == ['/inst/g1', '/inst/g3', '/other']
+    assert len(rc.calls) == 2
+
+    # fallback for old Keycloak versions
+    rc = FakeRoleClient(reverse_lookup=False)
+    ret = await apps.get_app_role_mappings('testapp', role='write', rest_client=rc)
+    assert ret == {'write': ['/inst/g3']}
+
+
+class FakeRealm:
+    """Fake rest client for AppIndex."""
+    def __init__(self):
+        self.calls = []
+        self.clients = {
+            'c1': {'clientId': 'app1', 'roles': ['read', 'write']},
+            'c2': {'clientId': 'app2', 'roles': ['admin']},
+        }
+        self.groups = {'g1': '/a', 'g2': '/a/b', 'g3': '/c'}
+        self.mappings = {'g1': {'c1': ['read']}, 'g2': {'c1': ['read', 'write'], 'c2': ['admin']}}
+        self.scopes = {'s1': 'app1'}
+
+    def _client(self, cid):
+        return {'id': cid, 'clientId': self.clients[cid]['clientId'], 'attributes': {'app': 'true'},
+                'defaultClientScopes': [], 'optionalClientScopes': [], 'rootUrl': '', 'serviceAccountsEnabled': False}
+
+    def _scope(self, sid):
+        return {'id': sid, 'name': self.scopes[sid], 'protocol': 'openid-connect', 'attributes': {'app': 'app'}}
+
+    async def request(self, method, path, args=None):
+        self.calls.append(path)
+        if path == '/clients':
+            return [self._client(cid) for cid in self.clients]
+        if path == '/client-scopes':
+            return [self._scope(sid) for sid in self.scopes]
+        if path.startswith('/client-scopes/'):
+            sid = path.split('/')[2]
+            return self._scope(sid) if sid in self.scopes else None
+        if path.startswith('/clients/'):
+            cid = path.split('/')[2]
+            if cid not in self.clients:
+                return None if path.count('/') == 2 else []
+            if path.endswith('/roles'):
+                return [{'name': r} for r in self.clients[cid]['roles']]
+            return self._client(cid)
+        if path.startswith('/groups?'):
+            def tree(prefix):
+                return [{'id': gid, 'name': p.split('/')[-1], 'path': p, 'subGroups': tree(p + '/')}
+                        for gid, p in self.groups.items()
+                        if p.startswith(prefix) and '/' not in p[len(prefix):]]
+            return tree('/')
+        if path.startswith('/groups/'):
+            gid = path.split('/')[2]
+            return {'clientMappings': {
+                self.clients[cid]['clientId']: {'id': cid, 'client': self.clients[cid]['clientId'],
+                                                'mappings': [{'name': r} for r in roles]}
+                for cid, roles in self.mappings.get(gid, {}).items()}}
+        raise Exception(f'unexpected {path}')
+
+
+@pytest.mark.asyncio
+async def test_app_index():
+    rc = FakeRealm()
+    index = apps.AppIndex(rest_client=rc)
+    await index.load()
+    assert set(index.apps) == {'app1', 'app2'}
+    assert index.app('app1')['roles'] == ['read', 'write']
+    assert index.groups_with_role('app1', 'read') == ['/a', '/a/b']
+    assert index.groups_with_role('app2', 'admin') == ['/a/b']
+    assert index.groups_with_role('app2', 'missing') == []
+    assert index.group_roles('/a/b') == {'app1': ['read', 'write'], 'app2': ['admin']}
+    assert index.group_roles('/c') == {}
+
+    # role mapping event only refreshes that group
+    rc.calls = []
+    rc.mappings['g3'] = {'c2': ['admin']}
+    await index.handle_event({'resourceType': 'CLIENT_ROLE_MAPPING', 'operationType': 'CREATE',
+                              'resourcePath': 'groups/g3/role-mappings/clients/c2', 'representation': []})
+    assert rc.calls == ['/groups/g3/role-mappings']
+    assert index.groups_with_role('app2', 'admin') == ['/a/b', '/c']
+
+    # new group, using the routing key for the resource type
+    rc.groups['g4'] = '/c/d'
+    rc.mappings['g4'] = {'c1': ['write']}
+    await index.handle_event({'resourcePath': 'groups/g3/children', 'representation': {}},
+                             'KK.EVENT.ADMIN.realm.SUCCESS.GROUP.CREATE')
+    assert index.group_roles('/c/d') == {'app1': ['write']}
+
+    # deleted group
+    del rc.groups['g2']
+    await index.handle_event({'resourceType': 'GROUP', 'resourcePath': 'groups/g2', 'representation': {}})
+    assert index.groups_with_role('app1', 'write') == ['/c/d']
+    assert index.group_roles('/a/b') == {}
+
+    # deleted role and app, refreshing only the touched clients
+    rc.calls = []
+    rc.clients['c1']['roles'] = ['read']
+    await index.handle_event({'resourceType': 'CLIENT_ROLE', 'operationType': 'DELETE',
+                              'resourcePath': 'clients/c1/roles/write', 'representation': {}})
+    assert sorted(rc.calls) == ['/clients/c1', '/clients/c1/roles']
+    del rc.clients['c2']
+    await index.handle_event({'resourceType': 'CLIENT', 'resourcePath': 'clients/c2', 'representation': {}})
+    assert set(index.apps) == {'app1'}
+    assert index.groups_with_role('app1', 'write') == []
+    assert index.groups_with_role('app2', 'admin') == []
+    assert index.group_roles('/c') == {}
+
+
+@pytest.mark.asyncio
+async def test_app_index_delete_app():
+    rc = FakeRealm()
+    index = apps.AppIndex(rest_client=rc)
+    await index.load()
+
+    # app deletion is handled without any requests
+    rc.calls = []
+    del rc.clients['c2']
+    for _ in range(2):
+        await index.handle_event({'resourceType': 'CLIENT', 'operationType': 'DELETE',
+                                  'resourcePath': 'clients/c2', 'representation': {}})
+    assert rc.calls == []
+    assert set(index.apps) == {'app1'}
+    assert index.groups_with_role('app2', 'admin') == []
+    assert index.group_roles('/a/b') == {'app1': ['read', 'write']}
+
+
+@pytest.mark.asyncio
+async def test_app_index_client_events():
+    rc = FakeRealm()
+    index = apps.AppIndex(rest_client=rc)
+    await index.load()
+
+    # new app
+    rc.calls = []
+    rc.clients['c3'] = {'clientId': 'app3', 'roles': ['read']}
+    await index.handle_event({'resourceType': 'CLIENT', 'operationType': 'CREATE',
+                              'resourcePath': 'clients/c3', 'representation': {}})
+    assert sorted(rc.calls) == ['/clients/c3', '/clients/c3/roles']
+    assert index.app('app3')['roles'] == ['read']
+
+    # new role
+    rc.calls = []
+    rc.clients['c3']['roles'].append('write')
+    await index.handle_event({'resourcePath': 'clients/c3/roles', 'representation': {}},
+                             'KK.EVENT.ADMIN.realm.SUCCESS.CLIENT_ROLE.CREATE')
+    assert len(rc.calls) == 2
+    assert index.app('app3')['roles'] == ['read', 'write']
+
+    # scopes
+    rc.calls = []
+    rc.scopes['s3'] = 'app3'
+    await index.handle_event({'resourceType': 'CLIENT_SCOPE', 'operationType': 'CREATE',
+                              'resourcePath': 'client-scopes/s3', 'representation': {}})
+    assert rc.calls == ['/client-scopes/s3']
+    assert set(index.scopes) == {'app1', 'app3'}
+    await index.handle_event({'resourceType': 'CLIENT_SCOPE', 'operationType': 'DELETE',
+                              'resourcePath': 'client-scopes/s3', 'representation': {}})
+    assert set(index.scopes) == {'app1'}
+
+    # unparseable paths reload all apps
+    rc.calls = []
+    await index.handle_event({'resourceType': 'CLIENT_ROLE', 'operationType': 'DELETE',
+                              'resourcePath': 'roles-by-id/r1', 'representation': {}})
+    assert '/clients' in rc.calls
+
+
+def test_app_index_listener():
+    index = apps.AppIndex(rest_client=FakeRealm())
+    listener = index.listener(address='amqp://test')
+    assert listener.action == index.handle_event
+    assert listener.with_routing_key
+    assert listener.routing_key == 'KK.EVENT.ADMIN.#'
+
+
+class FakeClients:
+    """Fake rest client for app creation and deletion."""
+    def __init__(self):
+        self.clients = {'pub': {'id': 'pub', 'clientId': 'public', 'attributes': {}, 'optionalClientScopes': []}}
+        self.roles = {}
+        self.scopes = {}
+        self.running = 0
+        self.max_running = 0
+        self.count = 0
+
+    async def request(self, method, path, args=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(.001)
+            return self._request(method, path, args)
+        finally:
+            self.running -= 1
+
+    def _new_id(self):
+        self.count += 1
+        return f'id{self.count}'
+
+    def _request(self, method, path, args):
+        parts = path.split('/')
+        if path.startswith('/clients?clientId='):
+            name = path.split('=', 1)[1]
+            return [c for c in self.clients.values() if c['clientId'] == name]
+        if path == '/clients':
+            if method == 'POST':
+                cid = self._new_id()
+                self.clients[cid] = dict(args, id=cid, optionalClientScopes=[])
+                self.roles[cid] = []
+                return
+            return list(self.clients.values())
+        if path == '/client-scopes':
+            if method == 'POST':
+                sid = self._new_id()
+                self.scopes[sid] = dict(args, id=sid)
+                return
+            return list(self.scopes.values())
+        if parts[1] == 'client-scopes':
+            if method == 'DELETE':
+                del self.scopes[parts[2]]
+            return
+        cid = parts[2]
+        if len(parts) == 3 and method == 'DELETE':
+            del self.clients[cid]
+        elif parts[3] == 'roles':
+            if method == 'POST':
+                self.roles[cid].append(args['name'])
+            return [{'name': r} for r in self.roles[cid]]
+        elif parts[3] == 'client-secret':
+            return {'value': 'secret'}
+        elif parts[3] == 'optional-client-scopes':
+            name = self.scopes[parts[4]]['name']
+            scopes = self.clients[cid]['optionalClientScopes']
+            if method == 'PUT' and name not in scopes:
+                scopes.append(name)
+            elif method == 'DELETE':
+                scopes.remove(name)
+
+
+@pytest.mark.asyncio
+async def test_create_delete_app_fake():
+    rc = FakeClients()
+    await apps.create_app('app1', 'http://url', roles=['a', 'b', 'c'], rest_client=rc)
+    await apps.create_app('app2', 'http://url', access='apps', rest_client=rc)
+    await apps.create_app('app2', 'http://url', access='apps', rest_client=rc)
+    assert rc.max_running > 1
+
+    ret = await apps.list_apps(rest_client=rc)
+    assert set(ret) == {'app1', 'app2'}
+    assert set(ret['app1']['optionalClientScopes']) == {'app1', 'app2'}
+    assert set(ret['app2']['optionalClientScopes']) == {'app2'}
+    assert rc.clients['pub']['optionalClientScopes'] == ['app1']
+    assert set((await apps.app_info('app1', rest_client=rc))['roles']) == {'a', 'b', 'c'}
+
+    await apps.delete_app('app1', rest_client=rc)
+    ret = await apps.list_apps(rest_client=rc)
+    assert list(ret) == ['app2']
+    assert ret['app2']['optionalClientScopes'] == ['app2']
+    assert rc.clients['pub']['optionalClientScopes'] == []
+    assert [s['name'] for s in rc.scopes.values()] == ['app2']
+
+    await apps.delete_app('app1', rest_client=rc)
+
+
+@pytest.mark.asyncio
+async def test_create_apps_fake():
+    rc = FakeClients()
+    await apps.create_apps([{'appname': f'app{i}', 'appurl': 'http://url'} for i in range(6)]
+                           + [{'appname': 'private', 'appurl': 'http://url', 'access': 'none'}],
+                           concurrency=3, rest_client=rc)
+    ret = await apps.list_apps(rest_client=rc)
+    assert len(ret) == 7
+    public_scopes = {f'app{i}' for i in range(6)}
+    for name, app in ret.items():
+        expected = public_scopes | {'private'} if name == 'private' else public_scopes
+        assert set(app['optionalClientScopes']) == expected
+    assert set(rc.clients['pub']['optionalClientScopes']) == public_scopes
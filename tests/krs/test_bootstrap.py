@@ -1,3 +1,7 @@
+import asyncio
+
+import pytest
+
 from krs import bootstrap
 
 def test_wait_for_keycloak(monkeypatch):
@@ -53,3 +57,82 @@ def test_bootstrap(monkeypatch):
     tok = bootstrap.get_token()
     bootstrap.delete_service_role('testclient', token=tok)
     bootstrap.delete_realm('testrealm', token=tok)
+
+
+class FakeAdmin:
+    """Fake rest client for /auth/admin/realms."""
+    def __init__(self):
+        self.calls = []
+        self.realms = ['master']
+        self.clients = {'master': [{'id': 'm1', 'clientId': 'master-realm'}]}
+        self.secrets = {}
+        self.assigned = set()
+
+    async def request(self, method, path, args=None):
+        self.calls.append((method, path))
+        await asyncio.sleep(.001)
+        if path == '':
+            if method == 'POST':
+                self.realms.append(args['realm'])
+                self.clients[args['realm']] = []
+                self.clients['master'].append({'id': f'{args["realm"]}-id', 'clientId': f'{args["realm"]}-realm'})
+            return [{'realm': r} for r in self.realms]
+        parts = path.split('/')
+        realm = parts[1]
+        if parts[2].startswith('clients?clientId='):
+            name = parts[2].split('=')[1]
+            return [c for c in self.clients[realm] if c['clientId'] == name]
+        if parts[2] == 'clients' and len(parts) == 3:
+            self.clients[realm].append(dict(args, id=f'{args["clientId"]}-id'))
+            return
+        if parts[-1] == 'service-account-user':
+            return {'id': 'svc'}
+        if parts[-1] == 'available':
+            return [{'name': r} for r in ('view-users', 'other') if r not in self.assigned]
+        if parts[-1] == 'client-secret':
+            if method == 'POST':
+                self.secrets[parts[3]] = 'secret'
+            return {'value': self.secrets[parts[3]]} if parts[3] in self.secrets else {}
+        if parts[3] == 'svc':
+            self.assigned.update(r['name'] for r in args)
+            return
+        raise Exception(f'unexpected {method} {path}')
+
+
+@pytest.mark.asyncio
+async def test_bootstrap_async_fake(monkeypatch):
+    monkeypatch.setenv('KEYCLOAK_URL', 'http://localhost')
+    monkeypatch.setenv('KEYCLOAK_REALM', 'testrealm')
+    monkeypatch.setenv('KEYCLOAK_CLIENT_ID', 'testclient')
+    rc = FakeAdmin()
+    assert await bootstrap.bootstrap_async(rest_client=rc) == 'secret'
+    assert 'testrealm' in rc.realms
+    assert [c['clientId'] for c in rc.clients['testrealm']] == ['public']
+    assert ('POST', '/master/users/svc/role-mappings/clients/testrealm-id') in rc.calls
+
+    # second run only reads
+    rc.calls = []
+    assert await bootstrap.bootstrap_async(rest_client=rc) == 'secret'
+    assert [c for c in rc.calls if c[0] != 'GET'] == []
+    assert len(rc.clients['master']) == 3
+
+
+def test_wait_for_keycloak_backoff(monkeypatch, mocker):
+    monkeypatch.setenv('KEYCLOAK_URL', 'http://localhost')
+    probe = mocker.patch('krs.bootstrap._probe', side_effect=[False, False, False, True])
+    sleep = mocker.patch('time.sleep')
+    bootstrap.wait_for_keycloak(initial_delay=.1, max_delay=.3)
+    assert probe.call_count == 4
+    assert [c[0][0] for c in sleep.call_args_list] == [.1, .2, .3]
+
+    probe = mocker.patch('krs.bootstrap._probe', return_value=False)
+    with pytest.raises(Exception, match='did not start'):
+        bootstrap.wait_for_keycloak(timeout=.01, initial_delay=.1)
+
+
+@pytest.mark.asyncio
+async def test_wait_for_keycloak_async_backoff(monkeypatch, mocker):
+    monkeypatch.setenv('KEYCLOAK_URL', 'http://localhost')
+    probe = mocker.patch('krs.bootstrap._probe', side_effect=[False, False, True])
+    await bootstrap.wait_for_keycloak_async(initial_delay=.001)
+    assert probe.call_count == 3
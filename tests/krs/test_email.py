@@ -1,5 +1,9 @@
+import email
+import email.policy
 import smtplib
+import time
 from contextlib import AbstractContextManager
+from datetime import datetime
 from unittest.mock import MagicMock
 
 import pytest
@@ -24,4 +28,174 @@ def test_send_email(patch_smtp):
     a = patch_smtp.return_value.send_message.call_args[0][0]
     assert 'To: foo@bar' in str(a)
     assert 'Subject: test' in str(a)
-    assert 'test message' in str(a)
\ No newline at end of file
+    assert 'test message' in str(a)
+
+class MockSMTP:
+    """SMTP stand-in that records which connection sent each message"""
+    connections = []
+
+    def __init__(self, *args, **kwargs):
+        self.sent = []
+        self.fail_next = None
+        MockSMTP.connections.append(self)
+
+    def send_message(self, msg):
+        if self.fail_next:
+            e, self.fail_next = self.fail_next, None
+            raise e
+        self.sent.append(msg)
+
+    def sendmail(self, sender, recipients, data):
+        self.send_message(data)
+
+    def quit(self):
+        pass
+
+@pytest.fixture
+def mock_smtp(mocker):
+    MockSMTP.connections = []
+    return mocker.patch('smtplib.SMTP', new=MockSMTP)
+
+def test_build_email():
+    msg = krs.email.build_email({'name': 'Foo', 'email': 'foo@bar'}, 'test', 'test message')
+    assert 'To: Foo <foo@bar>' in str(msg)
+    assert 'Subject: test' in str(msg)
+    assert 'test message' in str(msg)
+
+def test_mailer_send(mock_smtp):
+    with krs.email.Mailer() as mailer:
+        for i in range(3):
+            mailer.send(krs.email.build_email('foo@bar', f'test{i}', 'test message'))
+
+    assert len(MockSMTP.connections) == 1
+    assert len(MockSMTP.connections[0].sent) == 3
+
+def test_mailer_reconnect(mock_smtp):
+    mailer = krs.email.Mailer()
+    mailer.send(krs.email.build_email('foo@bar', 'test', 'test message'))
+    MockSMTP.connections[0].fail_next = smtplib.SMTPServerDisconnected()
+    mailer.send(krs.email.build_email('foo@bar', 'test', 'test message'))
+
+    assert len(MockSMTP.connections) == 2
+    assert len(MockSMTP.connections[1].sent) == 1
+
+def test_mailer_error(mock_smtp):
+    mailer = krs.email.Mailer()
+    mailer.send(krs.email.build_email('foo@bar', 'test', 'test message'))
+    MockSMTP.connections[0].fail_next = smtplib.SMTPRecipientsRefused({})
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        mailer.send(krs.email.build_email('foo@bar', 'test', 'test message'))
+
+    # connection is kept
+    mailer.send(krs.email.build_email('foo@bar', 'test', 'test message'))
+    assert len(MockSMTP.connections) == 1
+
+def test_mailer_send_bulk(mock_smtp):
+    msgs = [krs.email.build_email('foo@bar', f'test{i}', 'test message') for i in range(100)]
+    mailer = krs.email.Mailer(connections=3)
+    ret = mailer.send_bulk(msgs)
+
+    assert ret == [None]*100
+    assert 1 <= len(MockSMTP.connections) <= 3
+    assert sum(len(c.sent) for c in MockSMTP.connections) == 100
+
+@pytest.mark.asyncio
+async def test_mailer_async_send_bulk(mock_smtp):
+    msgs = [krs.email.build_email('foo@bar', f'test{i}', 'test message') for i in range(10)]
+    mailer = krs.email.Mailer(connections=2)
+    ret = await mailer.async_send_bulk(msgs)
+
+    assert ret == [None]*10
+    assert sum(len(c.sent) for c in MockSMTP.connections) == 10
+
+    await mailer.async_send(msgs[0])
+    assert sum(len(c.sent) for c in MockSMTP.connections) == 11
+
+def test_email_template_render():
+    content = 'Hello {name},\n\nYour account {uid} expires on {date:%Y-%m-%d}.\n'
+    fields = {'name': 'Jos\u00e9', 'uid': 'jdoe', 'date': datetime(2024, 1, 2)}
+    template = krs.email.EmailTemplate('test \u00fcnicode', content, sender='no-reply@bar')
+    raw = template.render({'name': 'Jos\u00e9 Doe', 'email': 'jdoe@bar'}, fields)
+    assert raw.sender == 'no-reply@bar'
+    assert raw.recipients == ['jdoe@bar']
+
+    msg = email.message_from_bytes(raw.data, policy=email.policy.default)
+    expected = krs.email.build_email({'name': 'Jos\u00e9 Doe', 'email': 'jdoe@bar'}, 'test \u00fcnicode',
+                                     content.format(**fields), sender='no-reply@bar')
+    for header in ('Subject', 'From', 'To'):
+        assert msg[header] == expected[header]
+    assert msg['Date']
+
+    parts = [p.get_content().replace('\r\n', '\n') for p in msg.iter_parts()]
+    expected_parts = [p.get_content().replace('\r\n', '\n') for p in expected.iter_parts()]
+    assert parts == expected_parts
+
+def test_mailer_send_raw(mock_smtp):
+    template = krs.email.EmailTemplate('test', 'test message for {uid}')
+    mailer = krs.email.Mailer()
+    ret = mailer.send_bulk([template.render('foo@bar', {'uid': i}) for i in range(5)])
+
+    assert ret == [None]*5
+    sent = MockSMTP.connections[0].sent
+    assert len(sent) == 5
+    assert b'To: foo@bar' in sent[0]
+
+def test_outbox_dedup(tmp_path):
+    outbox = krs.email.Outbox(str(tmp_path / 'outbox.sqlite'))
+    assert outbox.enqueue(krs.email.build_email('foo@bar', 'test', 'test message'))
+    assert not outbox.enqueue(krs.email.build_email('foo@bar', 'test', 'other message'))
+
+    template = krs.email.EmailTemplate('test', 'test message')
+    assert outbox.enqueue_many([template.render('foo@bar'), template.render('baz@bar')]) == 1
+    assert outbox.pending() == 2
+
+def test_outbox_drain(tmp_path, mock_smtp):
+    outbox = krs.email.Outbox(str(tmp_path / 'outbox.sqlite'), mailer=krs.email.Mailer())
+    outbox.enqueue_many([krs.email.build_email(f'foo{i}@bar', 'test', 'test message') for i in range(10)])
+
+    assert outbox.drain() == (10, 0)
+    assert outbox.pending() == 0
+    sent = [m for c in MockSMTP.connections for m in c.sent]
+    assert len(sent) == 10
+    assert b'To: foo0@bar' in sent[0]
+
+    # already sent today
+    assert not outbox.enqueue(krs.email.build_email('foo0@bar', 'test', 'test message'))
+    assert outbox.drain() == (0, 0)
+
+def test_outbox_retry(tmp_path, mock_smtp, mocker):
+    outbox = krs.email.Outbox(str(tmp_path / 'outbox.sqlite'), mailer=krs.email.Mailer(), backoff=0)
+    outbox.enqueue(krs.email.build_email('foo@bar', 'test', 'test message'))
+    outbox.enqueue(krs.email.build_email('baz@bar', 'test', 'test message'))
+
+    outbox.mailer.send(krs.email.build_email('foo@bar', 'warmup', 'test message'))
+    MockSMTP.connections[0].fail_next = smtplib.SMTPRecipientsRefused({'foo@bar': (450, b'try later')})
+    assert outbox.drain() == (1, 1)
+    assert outbox.pending() == 1
+
+    # not retried within the same second
+    assert outbox.drain() == (0, 0)
+
+    # retried after backoff
+    mocker.patch('time.time', return_value=time.time() + 2)
+    assert outbox.drain() == (1, 0)
+    assert outbox.pending() == 0
+
+def test_outbox_permanent_error(tmp_path, mock_smtp):
+    outbox = krs.email.Outbox(str(tmp_path / 'outbox.sqlite'), mailer=krs.email.Mailer(), backoff=0)
+    outbox.enqueue(krs.email.build_email('foo@bar', 'test', 'test message'))
+
+    outbox.mailer.send(krs.email.build_email('foo@bar', 'warmup', 'test message'))
+    MockSMTP.connections[0].fail_next = smtplib.SMTPRecipientsRefused({'foo@bar': (550, b'no such user')})
+    assert outbox.drain() == (0, 1)
+    assert outbox.pending() == 0
+    assert outbox.drain() == (0, 0)
+
+def test_outbox_retry_no_backoff(tmp_path, mock_smtp):
+    outbox = krs.email.Outbox(str(tmp_path / 'outbox.sqlite'), mailer=krs.email.Mailer(), backoff=0, max_attempts=1000)
+    outbox.enqueue(krs.email.build_email('foo@bar', 'test', 'test message'))
+
+    outbox.mailer.send(krs.email.build_email('foo@bar', 'warmup', 'test message'))
+    MockSMTP.connections[0].fail_next = smtplib.SMTPRecipientsRefused({'foo@bar': (450, b'try later')})
+    assert outbox.drain() == (0, 1)
+    assert outbox.pending() == 1
@@ -1,5 +1,7 @@
 import pytest
 
+from ldap3 import MOCK_ASYNC
+
 from krs import ldap
 
 from ..util import ldap_bootstrap
@@ -70,6 +72,47 @@ def test_modify_user_attrs(ldap_bootstrap):
     ret = ldap_bootstrap.get_user('foo')
     assert ret['givenName'] == 'foofoo'
 
+def test_modify_users(ldap_bootstrap):
+    ldap_bootstrap.create_user(username='foo', firstName='foo', lastName='bar', email='foo@bar')
+    ldap_bootstrap.create_user(username='foo2', firstName='foo2', lastName='bar', email='foo2@bar')
+    ret = ldap_bootstrap.modify_users({
+        'foo': {'givenName': 'foofoo'},
+        'foo2': {'givenName': 'foofoo2', 'mail': None},
+        'missing': {'givenName': 'missing'},
+    })
+    assert ret['foo'] is None
+    assert ret['foo2'] is None
+    assert ret['missing']
+    assert ldap_bootstrap.get_user('foo')['givenName'] == 'foofoo'
+    assert 'mail' not in ldap_bootstrap.get_user('foo2')
+
+def test_modify_users_pipelined(mocker, monkeypatch):
+    monkeypatch.setenv('LDAP_URL', 'ldap://localhost')
+    monkeypatch.setenv('LDAP_USER_BASE', 'ou=people,dc=test')
+    base_connection = ldap.Connection
+
+    conns = []
+    def connection(server, user=None, password=None, client_strategy=None, auto_bind=False):
+        assert client_strategy == ldap.ASYNC
+        c = base_connection(server, user=user, password=password, client_strategy=MOCK_ASYNC)
+        c.strategy.add_entry(user, {'userPassword': password, 'sn': 'admin'})
+        for i in range(5):
+            c.strategy.add_entry(f'uid=foo{i},ou=people,dc=test', {'uid': f'foo{i}', 'shadowExpire': 1})
+        c.bind()
+        conns.append(c)
+        return c
+    mocker.patch('krs.ldap.Connection', side_effect=connection)
+
+    users = {f'foo{i}': {'shadowExpire': 10+i} for i in range(6)}
+    ret = ldap.LDAP().modify_users(users, window=2)
+
+    assert len(conns) == 1
+    assert list(ret) == list(users)
+    assert all(ret[f'foo{i}'] is None for i in range(5))
+    assert 'noSuchObject' in ret['foo5']
+
+    assert conns[0].server.dit['uid=foo3,ou=people,dc=test']['shadowExpire'] == [b'13']
+
 def test_modify_user_fail(ldap_bootstrap):
     ldap_bootstrap.create_user(username='foo', firstName='foo', lastName='bar', email='foo@bar')
 
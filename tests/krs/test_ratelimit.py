@@ -0,0 +1,7 @@
+import krs.ratelimit
+
+
+def test_token_bucket():
+    bucket = krs.ratelimit.TokenBucket(rate=1000, burst=5)
+    assert bucket.take(10) == 5
+    assert bucket.take(1) == 1
@@ -0,0 +1,139 @@
+import gzip
+import json
+
+import pytest
+
+from krs import snapshot, state
+
+from benchmarks.fake_keycloak import FakeKeycloak
+
+
+def make_realm(num_users=25):
+    kc = FakeKeycloak()
+    kc.add_group('/institutions')
+    kc.add_group('/institutions/IceCube')
+    kc.add_group('/institutions/IceCube/Test', {'name': ['Test'], 'cite': ['Test Univ']})
+    kc.add_group('/posix')
+    cid = kc.add_client('app1', roles=['read', 'write'], url='http://app1')
+    kc.mappings[kc.group_id('/posix')] = {cid: {'read'}}
+    for i in range(num_users):
+        groups = ['/posix'] + (['/institutions/IceCube/Test'] if i % 2 else [])
+        kc.add_user({'username': f'user{i}', 'firstName': 'F', 'lastName': 'L', 'email': f'user{i}@test',
+                     'enabled': True, 'attributes': {'uidNumber': [str(1000+i)]}, 'groups': groups})
+    return kc
+
+
+def dump(kc):
+    groups = {g['path']: g['attributes'] for g in kc.groups.values()}
+    users = {u['username']: {k: v for k, v in u.items() if k != 'id'} for u in kc.users.values()}
+    members = {kc.groups[gid]['path']: sorted(kc.users[uid]['username'] for uid in uids)
+               for gid, uids in kc.members.items()}
+    mappings = {kc.groups[gid]['path']: {kc.clients[cid]['clientId']: sorted(r) for cid, r in m.items()}
+                for gid, m in kc.mappings.items() if m}
+    return groups, users, members, mappings
+
+
+@pytest.mark.asyncio
+async def test_export_import(tmp_path):
+    src = make_realm()
+    filename = str(tmp_path / 'realm.ndjson.gz')
+    counts = await snapshot.export_realm(filename, page_size=10, concurrency=2, rest_client=src)
+    assert counts == {'realm': 1, 'group': 4, 'app': 1, 'user': 25, 'role_mapping': 1}
+
+    with gzip.open(filename, 'rt') as f:
+        records = [json.loads(line) for line in f]
+    user0 = [r for r in records if r.get('username') == 'user0'][0]
+    assert user0['groups'] == ['/posix']
+
+    dest = FakeKeycloak()
+    dest.add_client('app1', roles=['read'], url='http://app1')
+    await snapshot.import_realm(filename, batch_size=10, concurrency=2, rest_client=dest)
+    assert dump(dest) == dump(src)
+
+    # re-import only sends the user batches, which skip existing users
+    dest.writes = 0
+    await snapshot.import_realm(filename, batch_size=10, rest_client=dest)
+    assert dest.writes == 3
+    assert dump(dest) == dump(src)
+
+
+@pytest.mark.asyncio
+async def test_export_import_apps(tmp_path, mocker):
+    src = FakeKeycloak()
+    src.add_client('app1', roles=['read'], url='http://app1')
+    src.add_client('svc', roles=['admin'], url='http://svc', access='none', service_account=True,
+                   builtin_scopes=['email', 'profile'])
+    filename = str(tmp_path / 'realm.ndjson.gz')
+    await snapshot.export_realm(filename, rest_client=src)
+
+    with gzip.open(filename, 'rt') as f:
+        records = {r['name']: r for r in map(json.loads, f) if r['type'] == 'app'}
+    assert records['app1'] == {'type': 'app', 'name': 'app1', 'url': 'http://app1', 'roles': ['read'],
+                               'access': 'public', 'service_account': False, 'builtin_scopes': []}
+    assert records['svc'] == {'type': 'app', 'name': 'svc', 'url': 'http://svc', 'roles': ['admin'],
+                              'access': 'none', 'service_account': True, 'builtin_scopes': ['email', 'profile']}
+
+    dest = FakeKeycloak()
+
+    async def create_apps(apps, concurrency, rest_client):
+        for a in apps:
+            dest.add_client(a.pop('appname'), url=a.pop('appurl'), **a)
+    create = mocker.patch('krs.state.create_apps', side_effect=create_apps)
+    await snapshot.import_realm(filename, rest_client=dest)
+    create.assert_called_once()
+
+    def clients(kc):
+        return {c['clientId']: {k: v for k, v in c.items() if k != 'id'} for c in kc.clients.values()}
+    assert clients(dest) == clients(src)
+
+
+@pytest.mark.asyncio
+async def test_import_existing_users(tmp_path):
+    src = make_realm()
+    filename = str(tmp_path / 'realm.ndjson.gz')
+    await snapshot.export_realm(filename, rest_client=src)
+
+    dest = FakeKeycloak()
+    dest.add_client('app1', roles=['read', 'write'], url='http://app1')
+    dest.add_group('/posix')
+    dest.add_user({'username': 'user1', 'firstName': 'F', 'lastName': 'L'})
+    await snapshot.import_realm(filename, rest_client=dest)
+    assert dump(dest)[2] == dump(src)[2]
+
+
+@pytest.mark.asyncio
+async def test_import_resume(tmp_path, mocker):
+    src = make_realm(50)
+    filename = str(tmp_path / 'realm.ndjson.gz')
+    checkpoint = str(tmp_path / 'realm.ckpt')
+    await snapshot.export_realm(filename, rest_client=src)
+
+    dest = FakeKeycloak()
+    dest.add_client('app1', roles=['read', 'write'], url='http://app1')
+    orig = dest._request
+    calls = []
+
+    def fail(method, path, args):
+        if path == '/partialImport':
+            calls.append(args['users'][0]['username'])
+            if len(calls) == 3:
+                raise Exception('connection lost')
+        return orig(method, path, args)
+    dest._request = fail
+
+    with pytest.raises(Exception):
+        await snapshot.import_realm(filename, checkpoint=checkpoint, batch_size=10, concurrency=1, rest_client=dest)
+    with open(checkpoint) as f:
+        assert json.load(f) == {'phases': ['app', 'group'], 'users': 20, 'existing': {}}
+
+    await snapshot.import_realm(filename, checkpoint=checkpoint, batch_size=10, concurrency=1, rest_client=dest)
+    assert calls == ['user0', 'user10', 'user20', 'user20', 'user30', 'user40']
+    assert dump(dest) == dump(src)
+
+
+def test_group_attrs():
+    ret = state.desired_groups({'group_attrs': {'/a/b': {'x': ['1', '2']}}})
+    assert ret == {'/a': None, '/a/b': {'x': ['1', '2']}}
+    current = {'groups': {'/a': {}, '/a/b': {'attributes': {'x': ['1', '2']}}}, 'apps': {}, 'mappings': {}}
+    plan = state.plan_state({'group_attrs': {'/a/b': {'x': ['1', '2']}}}, current, update_attrs=True)
+    assert state.format_plan(plan) == 'no changes'
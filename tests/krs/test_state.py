@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from krs import state
+
+
+class FakeKeycloak:
+    """Fake rest client with groups, clients, roles, and group role mappings."""
+    def __init__(self):
+        self.groups = {}
+        self.clients = {'c1': {'id': 'c1', 'clientId': 'app1', 'roles': ['read']}}
+        self.mappings = {}
+        self.writes = []
+        self.reads = []
+        self.count = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def request(self, method, path, args=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(.001)
+            if method == 'GET':
+                self.reads.append(path)
+            else:
+                self.writes.append((method, path))
+            return self._request(method, path, args)
+        finally:
+            self.running -= 1
+
+    def _add_group(self, parent, args):
+        self.count += 1
+        gid = f'g{self.count}'
+        path = (self.groups[parent]['path'] if parent else '') + '/' + args['name']
+        assert path not in [g['path'] for g in self.groups.values()]
+        self.groups[gid] = {'id': gid, 'name': args['name'], 'path': path, 'parent': parent,
+                            'attributes': {k: [str(v[0]).lower() if isinstance(v[0], bool) else v[0]]
+                                           for k, v in args.get('attributes', {}).items()}}
+
+    def _request(self, method, path, args):
+        parts = path.split('/')
+        if path.startswith('/groups?'):
+            def tree(parent):
+                return [dict(g, subGroups=tree(gid)) for gid, g in self.groups.items() if g['parent'] == parent]
+            return tree(None)
+        if path == '/groups' and method == 'POST':
+            return self._add_group(None, args)
+        if path.endswith('/children') and method == 'POST':
+            assert parts[2] in self.groups
+            return self._add_group(parts[2], args)
+        if len(parts) == 3 and parts[1] == 'groups' and method == 'PUT':
+            self.groups[parts[2]]['attributes'] = args['attributes']
+            return
+        if path.endswith('/role-mappings') and method == 'GET':
+            return {'clientMappings': {
+                self.clients[cid]['clientId']: {'id': cid, 'mappings': [{'name': r} for r in roles]}
+                for cid, roles in self.mappings.get(parts[2], {}).items()}}
+        if '/role-mappings/clients/' in path and method == 'POST':
+            self.mappings.setdefault(parts[2], {}).setdefault(parts[5], set()).update(r['name'] for r in args)
+            return
+        if path == '/clients':
+            return [{'id': cid, 'clientId': c['clientId']} for cid, c in self.clients.items()]
+        if path.endswith('/roles'):
+            if method == 'POST':
+                self.clients[parts[2]]['roles'].append(args['name'])
+                return
+            return [{'id': r, 'name': r} for r in self.clients[parts[2]]['roles']]
+        raise Exception(f'unexpected {method} {path}')
+
+
+INST = {'name': 'Test', 'cite': 'Test Univ', 'abbreviation': 'T', 'is_US': True, 'region': 'North America',
+        'authorlist': True, 'has_mou': True, '_ldap_o': 'test'}
+
+STATE = {
+    'groups': {'institutions': {'IceCube': {}}, 'posix': {}, 'a': {'b': {'c': {}}}},
+    'institutions': {'IceCube': {'Test': INST, 'Other': dict(INST, authorlists={'x': 'X'})}},
+    'apps': {'app1': {'appurl': 'http://app1', 'roles': ['read', 'write']}},
+    'role_mappings': {'app1': {'write': ['/a/b/c', '/posix']}},
+}
+
+
+def test_desired_groups():
+    ret = state.desired_groups(STATE)
+    assert ret['/institutions/IceCube/Test'] == ret['/institutions/IceCube/Test/_admin']
+    assert '_ldap_o' not in ret['/institutions/IceCube/Test']
+    assert ret['/institutions/IceCube/Test/authorlist'] is None
+    assert ret['/institutions/IceCube/Other/authorlist-x'] == {'cite': 'X'}
+    assert '/institutions/IceCube/Other/authorlist' not in ret
+    assert '/institutions' in state.desired_groups({'institutions': {'IceCube': {'Test': INST}}})
+
+
+@pytest.mark.asyncio
+async def test_apply_state():
+    rc = FakeKeycloak()
+    plan = await state.apply_state(STATE, concurrency=4, rest_client=rc)
+    assert len(plan['create_groups']) == 12
+    assert plan['create_roles'] == {'app1': ['write']}
+    assert plan['add_mappings'] == [('app1', 'write', '/a/b/c'), ('app1', 'write', '/posix')]
+    assert rc.max_running <= 4
+
+    paths = {g['path']: g for g in rc.groups.values()}
+    assert paths['/institutions/IceCube/Test']['attributes']['cite'] == ['Test Univ']
+    assert rc.mappings[paths['/posix']['id']] == {'c1': {'write'}}
+
+    # an up-to-date realm is one read pass and no writes
+    rc.reads, rc.writes = [], []
+    plan = await state.apply_state(STATE, rest_client=rc)
+    assert state.format_plan(plan) == 'no changes'
+    assert rc.writes == []
+    assert len(rc.reads) == 5
+
+
+@pytest.mark.asyncio
+async def test_apply_state_update():
+    rc = FakeKeycloak()
+    await state.apply_state(STATE, rest_client=rc)
+    inst = dict(INST, cite='New Cite')
+    new_state = dict(STATE, institutions={'IceCube': {'Test': inst}})
+
+    # existing groups are left alone by default
+    rc.writes = []
+    plan = await state.apply_state(new_state, rest_client=rc)
+    assert state.format_plan(plan) == 'no changes'
+    assert rc.writes == []
+
+    plan = await state.apply_state(new_state, dryrun=True, update_attrs=True, rest_client=rc)
+    assert plan['update_groups'] == {
+        '/institutions/IceCube/Test': {'cite': 'New Cite'},
+        '/institutions/IceCube/Test/_admin': {'cite': 'New Cite'},
+    }
+    assert rc.writes == []
+
+    await state.apply_state(new_state, update_attrs=True, rest_client=rc)
+    assert len(rc.writes) == 2
+    paths = {g['path']: g for g in rc.groups.values()}
+    assert paths['/institutions/IceCube/Test']['attributes']['cite'] == ['New Cite']
+    assert paths['/institutions/IceCube/Test']['attributes']['name'] == ['Test']
+
+
+@pytest.mark.asyncio
+async def test_apply_state_new_app(mocker):
+    rc = FakeKeycloak()
+
+    async def create_apps(apps, concurrency, rest_client):
+        assert apps == [{'appname': 'app2', 'appurl': 'http://app2', 'roles': ['admin']}]
+        rc.clients['c2'] = {'id': 'c2', 'clientId': 'app2', 'roles': ['admin']}
+    create = mocker.patch('krs.state.create_apps', side_effect=create_apps)
+
+    new_state = {'apps': {'app2': {'appurl': 'http://app2', 'roles': ['admin']}},
+                 'role_mappings': {'app2': {'admin': ['/admins']}}, 'groups': {'admins': {}}}
+    await state.apply_state(new_state, rest_client=rc)
+    create.assert_called_once()
+    assert list(rc.mappings.values()) == [{'c2': {'admin'}}]
+
+    with pytest.raises(Exception):
+        await state.apply_state({'role_mappings': {'app2': {'bad': ['/admins']}}}, rest_client=rc)
+    with pytest.raises(Exception):
+        await state.apply_state({'role_mappings': {'app2': {'admin': ['/missing']}}}, rest_client=rc)
+
+
+def test_same_attr_empty():
+    current = {'groups': {'/a': {'attributes': {'x': ['1']}}}, 'apps': {}, 'mappings': {}}
+    plan = state.plan_state({'group_attrs': {'/a': {'x': ['1'], 'empty': []}}}, current, update_attrs=True)
+    assert state.format_plan(plan) == 'no changes'
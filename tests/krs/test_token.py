@@ -0,0 +1,119 @@
+import json
+import time
+from unittest.mock import MagicMock
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from krs.token import TokenVerifier
+
+
+def make_key(kid):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+    jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+    return key, jwk
+
+
+@pytest.fixture
+def openid(mocker):
+    state = {'keys': [make_key('k1')]}
+
+    def get(url):
+        ret = MagicMock()
+        if url.endswith('/.well-known/openid-configuration'):
+            ret.json.return_value = {'jwks_uri': 'http://kc/certs', 'token_endpoint': 'http://kc/token'}
+        elif url == 'http://kc/certs':
+            ret.json.return_value = {'keys': [jwk for _, jwk in state['keys']]}
+        else:
+            raise Exception(f'unexpected url {url}')
+        return ret
+    state['get'] = mocker.patch('requests.get', side_effect=get)
+
+    def token(kid='k1', exp=3600, **claims):
+        key = {jwk['kid']: k for k, jwk in state['keys']}[kid]
+        claims.update({'sub': 'user', 'exp': int(time.time()) + exp})
+        return jwt.encode(claims, key, algorithm='RS256', headers={'kid': kid})
+    state['token'] = token
+    return state
+
+
+def test_verify(openid):
+    v = TokenVerifier('http://kc/auth/realms/test')
+    assert v.verify(openid['token'](foo='bar'))['foo'] == 'bar'
+    assert v.provider_info()['token_endpoint'] == 'http://kc/token'
+    assert openid['get'].call_count == 2
+
+    # keys are cached
+    v.verify(openid['token']())
+    assert openid['get'].call_count == 2
+
+
+def test_verify_cached(openid, mocker):
+    v = TokenVerifier('http://kc/auth/realms/test')
+    token = openid['token']()
+    decode = mocker.spy(jwt, 'decode')
+    for _ in range(5):
+        assert v.verify(token)['sub'] == 'user'
+    assert decode.call_count == 1
+
+
+def test_verify_invalid(openid):
+    v = TokenVerifier('http://kc/auth/realms/test')
+    with pytest.raises(jwt.ExpiredSignatureError):
+        v.verify(openid['token'](exp=-10))
+
+    token = openid['token']()
+    head, payload, sig = token.split('.')
+    with pytest.raises(jwt.InvalidTokenError):
+        v.verify('.'.join([head, payload, sig[::-1]]))
+
+    v = TokenVerifier('http://kc/auth/realms/test', audience='myapp')
+    with pytest.raises(jwt.InvalidAudienceError):
+        v.verify(openid['token'](aud='other'))
+    assert v.verify(openid['token'](aud='myapp'))['aud'] == 'myapp'
+
+
+def test_key_rotation(openid):
+    v = TokenVerifier('http://kc/auth/realms/test', min_refresh_interval=0)
+    v.verify(openid['token']())
+    assert openid['get'].call_count == 2
+
+    openid['keys'].append(make_key('k2'))
+    v.verify(openid['token']('k2'))
+    assert openid['get'].call_count == 4
+
+    with pytest.raises(jwt.InvalidTokenError):
+        v.verify(jwt.encode({'exp': int(time.time()) + 60}, make_key('k3')[0], algorithm='RS256', headers={'kid': 'k3'}))
+
+
+def test_unknown_kid(openid):
+    v = TokenVerifier('http://kc/auth/realms/test')
+    token = jwt.encode({'exp': int(time.time()) + 60}, make_key('unknown')[0], algorithm='RS256',
+                       headers={'kid': 'unknown'})
+    with pytest.raises(jwt.InvalidTokenError, match='key unknown not found'):
+        v.verify(token)
+
+
+def test_key_refresh_limit(openid):
+    v = TokenVerifier('http://kc/auth/realms/test', min_refresh_interval=60)
+    v.verify(openid['token']())
+    openid['keys'].append(make_key('k2'))
+    with pytest.raises(jwt.InvalidTokenError):
+        v.verify(openid['token']('k2'))
+    assert openid['get'].call_count == 2
+
+
+def test_key_ttl(openid):
+    v = TokenVerifier('http://kc/auth/realms/test', key_ttl=0)
+    v.verify(openid['token'](n=1))
+    v.verify(openid['token'](n=2))
+    assert openid['get'].call_count == 4
+
+
+def test_verify_returns_copy(openid):
+    v = TokenVerifier('http://kc/auth/realms/test')
+    token = openid['token'](foo='bar')
+    v.verify(token)['foo'] = 'changed'
+    assert v.verify(token)['foo'] == 'bar'